@@ -0,0 +1,220 @@
+"""Micro-benchmarks of the backend on a synthetic wiki and leaderboard.
+
+The data is generated into a MemoryStore, the backend reads it through a LatencyStore so every
+storage call can be slowed down like a network round trip and is counted. Every benchmark records
+its wall time and the storage calls of one run, the results are written to a json file that can be
+diffed between commits.
+
+Typical Usage:
+python benchmarks/bench_backend.py --pages 10000 --users 1000000 --latency 0.002 --output results.json
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# importing flaskr creates the app backend, it must not need the cloud storage
+os.environ.setdefault("WIKI_STORAGE", "memory")
+
+from collections import Counter
+import argparse
+import asyncio
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+
+from flaskr.backend import (Backend, manifest_entry, pokemon_image_path, MANIFEST_PATH, POKEDEX_PATH,
+                            RANKS_LIST_PATH, SEARCH_INDEX_PATH, WIKI_BUCKET, MAX_ID)
+from flaskr.async_backend import AsyncBackend
+from flaskr.blob_store import StorageClient, MemoryStore, LatencyStore
+from flaskr.trigram_index import TrigramIndex
+
+TYPES = ["Fire", "Water", "Grass", "Electric", "Psychic", "Rock", "Ghost", "Dragon"]
+REGIONS = ["Kanto", "Johto", "Hoenn", "Sinnoh"]
+NATURES = ["Brave", "Quirky", "Naive", "Bashful", "Calm", "Timid"]
+SYLLABLES = ["pi", "ka", "chu", "char", "man", "der", "mud", "kip", "bla", "zi", "ken", "ab", "ra", "mew", "zu", "bat"]
+IMAGE_BYTES = 32 * 1024
+
+
+def page_name(rng, i):
+    return "".join(rng.choice(SYLLABLES) for _ in range(3)) + str(i)
+
+
+def seed_wiki(client, pages, rng):
+    """ Writes the page manifest, the search index, the pokedex and the pokemon images of a synthetic wiki."""
+    bucket = client.get_bucket(WIKI_BUCKET)
+    manifest = []
+    search_index = TrigramIndex()
+    for i in range(pages):
+        name = page_name(rng, i)
+        pokemon_data = {
+            "name": name.capitalize(),
+            "type": rng.choice(TYPES),
+            "region": rng.choice(REGIONS),
+            "nature": rng.choice(NATURES),
+            "level": str(rng.randint(1, 100)),
+            "image-name": f"{name}.png",
+            "desc": " ".join(rng.choice(SYLLABLES) + rng.choice(SYLLABLES) for _ in range(20)),
+        }
+        manifest.append(manifest_entry("pages/" + name, pokemon_data))
+        search_index.add("pages/" + name, pokemon_data)
+    bucket.blob(MANIFEST_PATH).upload_from_string(json.dumps({"pages": manifest}), content_type="application/json")
+    bucket.blob(SEARCH_INDEX_PATH).upload_from_string(json.dumps(search_index.to_dict()), content_type="application/json")
+
+    pokedex = [{"id": id, "name": {"english": f"Pokemon{id}"}, "type": [rng.choice(TYPES)]} for id in range(1, MAX_ID + 1)]
+    bucket.blob(POKEDEX_PATH).upload_from_string(json.dumps(pokedex), content_type="application/json")
+    for id in range(1, MAX_ID + 1):
+        bucket.blob(pokemon_image_path(id)).upload_from_string(rng.randbytes(IMAGE_BYTES), content_type="image/png")
+
+
+def seed_leaderboard(client, users, rng):
+    """ Writes a leaderboard of synthetic users, best ranked user first.
+    Returns:
+        The leaderboard list.
+    """
+    points = sorted((rng.randrange(0, 100000, 50) for _ in range(users)), reverse=True)
+    leaderboard = [{"name": f"user{i}", "points": p, "rank": i + 1} for i, p in enumerate(points)]
+    bucket = client.get_bucket(WIKI_BUCKET)
+    bucket.blob(RANKS_LIST_PATH).upload_from_string(json.dumps({"ranks_list": leaderboard}), content_type="application/json")
+    return leaderboard
+
+
+def measure(store, run, repeat, setup=None):
+    """ Times a benchmark and counts its storage calls.
+    Args:
+        store: The LatencyStore the backend reads through.
+        run: Function that runs the benchmark once, it gets the value returned by setup.
+        repeat: Number of runs.
+        setup: Function called with the run number before every run, it is not timed.
+    Returns:
+        Dictionary with the wall times in milliseconds and the storage calls of one run.
+    """
+    walls = []
+    calls = Counter()
+    for i in range(repeat):
+        value = setup(i) if setup else None
+        before = Counter(store.calls)
+        start = time.perf_counter()
+        run(value)
+        walls.append((time.perf_counter() - start) * 1000)
+        calls.update(Counter(store.calls) - before)
+    return {
+        "runs": repeat,
+        "wall_ms": {
+            "min": round(min(walls), 3),
+            "median": round(statistics.median(walls), 3),
+            "mean": round(statistics.mean(walls), 3),
+            "max": round(max(walls), 3),
+        },
+        "storage_calls": {operation: round(count / repeat, 2) for operation, count in sorted(calls.items())},
+    }
+
+
+def run_benchmarks(pages, users, latency, repeat, seed):
+    """ Generates the data and runs every benchmark.
+    Returns:
+        Dictionary with the results of every benchmark by name.
+    """
+    rng = random.Random(seed)
+    memory = MemoryStore()
+    seed_client = StorageClient(memory)
+    seed_wiki(seed_client, pages, rng)
+    leaderboard = seed_leaderboard(seed_client, users, rng)
+
+    store = LatencyStore(memory, latency=latency)
+    client = StorageClient(store)
+    results = {}
+
+    def fresh_backend(i=None, **kwargs):
+        return Backend(client=client, **kwargs)
+
+    # pages
+    search = lambda backend: backend.get_pages_using_filter_and_search(None, "Fire", "Kanto", None, "LowestToHighest")
+    results["get_pages_using_filter_and_search[cold]"] = measure(store, search, repeat, fresh_backend)
+    backend = fresh_backend()
+    search(backend)
+    results["get_pages_using_filter_and_search[warm]"] = measure(store, lambda _: search(backend), repeat)
+    results["get_pages_using_search[warm]"] = measure(store, lambda _: backend.get_pages_using_search("char"), repeat)
+    results["get_pages_using_search[warm, long query]"] = measure(
+        store, lambda _: backend.get_pages_using_search("kachumud"), repeat)
+    results["suggest_pages[warm]"] = measure(store, lambda _: backend.suggest_pages("kach", 10), repeat)
+
+    # leaderboard
+    ranked_backend = fresh_backend(derive_ranks=True)
+    ranked_backend.get_ranking()
+    movers = [rng.randrange(users) for _ in range(repeat)]
+    results["update_points[derived ranks]"] = measure(
+        store, lambda i: ranked_backend.update_points(f"user{movers[i]}", 100000 + i * 50), repeat, lambda i: i)
+
+    # the reads of the leaderboard route, one after the other and at the same time
+    def leaderboard_reads(i):
+        ranked_backend.get_top_users(15)
+        ranked_backend.get_game_user(f"user{movers[i]}")
+    results["leaderboard route reads[sequential]"] = measure(store, leaderboard_reads, repeat, lambda i: i)
+    async_backend = AsyncBackend(ranked_backend)
+
+    async def gathered_reads(i):
+        await asyncio.gather(async_backend.get_top_users(15), async_backend.get_game_user(f"user{movers[i]}"))
+    results["leaderboard route reads[async gather]"] = measure(
+        store, lambda i: asyncio.run(gathered_reads(i)), repeat, lambda i: i)
+    async_backend.shutdown()
+
+    def sort_once(i):
+        user = dict(leaderboard[movers[i]], points=100000 + i * 50)
+        backend.sort_leaderboard(leaderboard, user, False)
+        backend.dirty_ranks.clear()
+    results["sort_leaderboard"] = measure(store, sort_once, repeat, lambda i: i)
+
+    # game
+    ids = [rng.randint(1, MAX_ID) for _ in range(repeat)]
+    results["get_pokemon_data[cold]"] = measure(store, lambda backend: backend.get_pokemon_data(ids[0]), repeat, fresh_backend)
+    backend.get_pokemon_data(ids[0])
+    results["get_pokemon_data[warm]"] = measure(store, lambda i: backend.get_pokemon_data(ids[i]), repeat, lambda i: i)
+    image = lambda backend, i: backend.get_image(pokemon_image_path(ids[i]))
+    results["get_image[cold]"] = measure(store, lambda value: image(*value), repeat, lambda i: (fresh_backend(), i))
+    image(backend, 0)
+    results["get_image[warm]"] = measure(store, lambda i: image(backend, 0), repeat, lambda i: i)
+
+    return results
+
+
+def git_commit():
+    """ Returns the commit the benchmarks ran on, or None outside of a git checkout."""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=1000, help="number of wiki pages, e.g. 1000, 10000 or 100000")
+    parser.add_argument("--users", type=int, default=10000, help="number of game users, e.g. 10000 or 1000000")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every storage call waits")
+    parser.add_argument("--repeat", type=int, default=20, help="runs of every benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data")
+    parser.add_argument("--output", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_results.json"),
+                        help="json file the results are written to, benchmarks/benchmark_results.json by default")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.pages, args.users, args.latency, args.repeat, args.seed)
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "config": {"pages": args.pages, "users": args.users, "latency": args.latency, "repeat": args.repeat, "seed": args.seed},
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    for name, result in results.items():
+        calls = ", ".join(f"{operation}={count:g}" for operation, count in result["storage_calls"].items()) or "none"
+        print(f"{name:45} median {result['wall_ms']['median']:10.3f} ms   storage calls: {calls}")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,8 @@ from flaskr import pages
 
 from flask import Flask
 
+import click
+
 from .pages import login_manager
 
 import logging
@@ -35,4 +37,21 @@ def create_app(test_config=None):
     # and additional endpoints.
 
     pages.make_endpoints(app)
+
+    @app.cli.command('rebuild-manifest')
+    def rebuild_manifest():
+        '''Regenerates the page manifest and the search index from the raw page blobs.'''
+        manifest, generation = pages.backend.rebuild_manifest()
+        pages.backend.refresh_page_index()
+        click.echo(f'Rebuilt the page manifest with {len(manifest)} pages.')
+        search_index, generation = pages.backend.rebuild_search_index()
+        pages.backend.refresh_search_index()
+        click.echo(f'Rebuilt the search index with {len(search_index["pages"])} pages.')
+
+    @app.cli.command('migrate-game-records')
+    def migrate_game_records():
+        '''Saves a game record for every game user that has none, ranks are derived from the leaderboard.'''
+        count = pages.backend.migrate_game_records()
+        click.echo(f'Saved the game record of {count} game users.')
+
     return app
@@ -0,0 +1,84 @@
+"""This module contains the asyncio interface of the backend used by the async views.
+
+The backend and the storage client are blocking, so AsyncBackend runs every backend call on a
+thread pool shared by all requests, which bounds the storage calls made at the same time. Any
+backend method can be awaited through it, and the reads a view needs can be started together
+with asyncio.gather so the view waits for the slowest read instead of the sum of all of them.
+The game reads that are made of independent reads (the game record and the leaderboard) fan
+them out the same way.
+
+Every call runs in a copy of the context of the caller, so the storage operations it makes are
+still recorded under the route of the request.
+
+Typical Usage:
+async_backend = AsyncBackend(backend)
+leaderboard, user = await asyncio.gather(async_backend.get_top_users(15), async_backend.get_game_user('javier'))
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import functools
+
+
+class AsyncBackend:
+
+    def __init__(self, backend, max_workers=16, executor=None):
+        """
+        Args:
+            backend: The Backend the calls are made on.
+            max_workers: Maximum number of backend calls running at the same time.
+            executor: Dependency injection for the executor the calls run on.
+        """
+        self.backend = backend
+        self.executor = executor if executor is not None else ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="async-backend")
+
+    def __getattr__(self, name):
+        # backend methods become coroutine functions, e.g. await async_backend.get_top_users(15)
+        attribute = getattr(self.backend, name)
+        if not callable(attribute):
+            return attribute
+
+        async def call(*args, **kwargs):
+            return await self.run(attribute, *args, **kwargs)
+        call.__name__ = name
+        return call
+
+    async def run(self, function, *args, **kwargs):
+        """ Runs a blocking function on the shared executor and waits for its result."""
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, functools.partial(context.run, function, *args, **kwargs))
+
+    async def get_game(self, username):
+        '''Gets the game record of a user together with its game json object, reading both at the same time.
+        Args:
+            username: Username of the user.
+        Returns:
+            Tuple with the GameRecord and the game json object with the rank of the user.
+        '''
+        if self.backend.derive_ranks:
+            # the rank comes from the leaderboard, which does not depend on the record
+            record, ranking = await asyncio.gather(self.run(self.backend.get_game_record, username),
+                                                   self.run(self.backend.get_ranking))
+            return record, record.user(ranking.rank(username))
+        record, user = await asyncio.gather(self.run(self.backend.get_game_record, username),
+                                            self.run(self.backend.get_game_user, username))
+        return record, user
+
+    async def get_game_user(self, username):
+        '''Gets the game json object of a user, reading the game record and the leaderboard at the same time.
+        Args:
+            username: Username of the user.
+        Returns:
+            JSON object containing user username, points and rank.
+        '''
+        if self.backend.derive_ranks:
+            record, user = await self.get_game(username)
+            return user
+        return await self.run(self.backend.get_game_user, username)
+
+    def shutdown(self):
+        """ Waits for the running calls and stops the executor."""
+        self.executor.shutdown(wait=True)
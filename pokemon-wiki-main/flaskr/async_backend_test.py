@@ -0,0 +1,90 @@
+from flaskr.async_backend import AsyncBackend
+from flaskr.backend import Backend
+from flaskr.blob_store import StorageClient, MemoryStore
+from flaskr.game_record import GameRecord
+from flaskr.metrics import Metrics
+from flaskr.seen import SeenSet
+from unittest.mock import MagicMock
+import asyncio
+import contextvars
+import threading
+import pytest
+
+
+@pytest.fixture
+def backend():
+    backend = MagicMock()
+    backend.derive_ranks = True
+    return backend
+
+
+def meet(barrier, value):
+    '''Returns a function that returns value once every party of the barrier is running.'''
+    def call(*args):
+        barrier.wait()
+        return value
+    return call
+
+
+def test_backend_methods_are_awaitable(backend):
+    backend.get_top_users.return_value = ["ash"]
+    async_backend = AsyncBackend(backend, max_workers=2)
+    assert asyncio.run(async_backend.get_top_users(15)) == ["ash"]
+    backend.get_top_users.assert_called_once_with(15)
+    assert async_backend.derive_ranks == True
+
+
+def test_calls_run_at_the_same_time(backend):
+    barrier = threading.Barrier(2, timeout=2)
+    backend.get_top_users.side_effect = meet(barrier, ["ash"])
+    backend.get_leaderboard.side_effect = meet(barrier, ["misty"])
+    async_backend = AsyncBackend(backend, max_workers=2)
+
+    async def both():
+        return await asyncio.gather(async_backend.get_top_users(15), async_backend.get_leaderboard())
+    assert asyncio.run(both()) == [["ash"], ["misty"]]
+
+
+def test_get_game_reads_record_and_ranking_together(backend):
+    record = GameRecord("ash", SeenSet(386, [25]), 300, 1)
+    ranking = MagicMock()
+    ranking.rank.return_value = 4
+    barrier = threading.Barrier(2, timeout=2)
+    backend.get_game_record.side_effect = meet(barrier, record)
+    backend.get_ranking.side_effect = meet(barrier, ranking)
+    async_backend = AsyncBackend(backend, max_workers=2)
+    assert asyncio.run(async_backend.get_game("ash")) == (record, {"name": "ash", "points": 300, "rank": 4})
+    assert asyncio.run(async_backend.get_game_user("ash")) == {"name": "ash", "points": 300, "rank": 4}
+
+
+def test_get_game_with_stored_ranks(backend):
+    backend.derive_ranks = False
+    record = GameRecord("ash", SeenSet(386), 0)
+    backend.get_game_record.return_value = record
+    backend.get_game_user.return_value = {"name": "ash", "points": 0, "rank": 2}
+    async_backend = AsyncBackend(backend, max_workers=2)
+    assert asyncio.run(async_backend.get_game("ash")) == (record, {"name": "ash", "points": 0, "rank": 2})
+    assert asyncio.run(async_backend.get_game_user("ash")) == {"name": "ash", "points": 0, "rank": 2}
+
+
+def test_calls_see_the_context_of_the_caller(backend):
+    request = contextvars.ContextVar("request")
+    backend.get_categories.side_effect = lambda: request.get()
+    async_backend = AsyncBackend(backend, max_workers=1)
+
+    async def read():
+        request.set("/pages")
+        return await async_backend.get_categories()
+    assert asyncio.run(read()) == "/pages"
+
+
+def test_storage_operations_recorded_under_the_request():
+    metrics = Metrics()
+    backend = Backend(StorageClient(MemoryStore()), derive_ranks=True, metrics=metrics)
+    backend.sign_up("ash", "pikachu")
+    async_backend = AsyncBackend(backend, max_workers=2)
+
+    metrics.start_request("/leaderboard", "GET")
+    asyncio.run(async_backend.get_game_user("ash"))
+    timings = metrics.end_request()
+    assert timings.storage["get_blob"][0] >= 2
@@ -13,32 +13,187 @@ image = get_image('pokemon/charmander')
 """
 
 from google.cloud import storage
+from google.api_core.exceptions import PreconditionFailed
 import base64
 import hashlib
 from flask import json, render_template, flash, redirect, url_for
 from .user import User
+from .page_index import PageIndex
+from .trigram_index import TrigramIndex
+from .pokedex import Pokedex
+from .image_cache import ImageCache
+from .leaderboard import RankedLeaderboard
+from .metrics import InstrumentedClient
+from .user_cache import UserCache
+from .blob_cache import CachePolicy
+from .seen import SeenSet, SEEN_CONTENT_TYPE
+from .game_record import GameRecord
 from secrets import randbelow
+import threading
+import logging
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
 
 MAX_ID = 386
+WIKI_BUCKET = 'wiki-content-techx'
+USERS_BUCKET = 'users-passwords-techx'
+MANIFEST_PATH = 'filtering/pages_manifest.json'
+MANIFEST_FIELDS = ("name", "type", "region", "nature", "level", "image-name")
+SEARCH_INDEX_PATH = 'filtering/search_index.json'
+RANKS_LIST_PATH = 'user_game_ranking/ranks_list.json'
+GAME_USERS_PREFIX = 'user_game_ranking/game_users/'
+GAME_RECORDS_PREFIX = 'user_game_ranking/records/'
+WRITE_RETRIES = 5  # attempts of a conditional write before giving up to the writes that beat it
+POKEDEX_PATH = 'master_pokedex/pokedex.json'
+POKEBALL_PATH = 'master_pokedex/images/pokeball.png'
+CATEGORIES_PATH = 'filtering/categories.json'
+SEEN_PREFIX = 'user_game_ranking/seen/'
+IMAGE_PREFIXES = ('images/', 'authors/', 'master_pokedex/images/')  # folders the image route may serve
+# content types an uploaded image may have, with the bytes its file starts with
+IMAGE_SIGNATURES = {
+    "image/png": (b"\x89PNG\r\n\x1a\n",),
+    "image/jpeg": (b"\xff\xd8\xff",),
+    "image/gif": (b"GIF87a", b"GIF89a"),
+    "image/webp": (b"RIFF",),  # followed by the size and WEBP, checked in image_type
+}
+IMAGE_TYPES = tuple(IMAGE_SIGNATURES)
+# how long the json blobs read through a BlobCache are cached, pages and categories rarely change while
+# the game records are written by every guess, so they are revalidated more often and never served stale.
+# The leaderboard and game_users blobs are not cached, they are written back without a generation check
+# so a stale copy would undo the writes of other servers.
+JSON_CACHE_POLICIES = {
+    'pages/': CachePolicy(ttl=60, stale_while_revalidate=600, max_entries=10000),
+    CATEGORIES_PATH: CachePolicy(ttl=300, stale_while_revalidate=3600, max_entries=1),
+    GAME_RECORDS_PREFIX: CachePolicy(ttl=5, max_entries=10000),
+}
+
+
+def manifest_entry(page_name, pokemon_data):
+    """ Creates the manifest entry of a page, which holds the page name and the fields used for listing and filtering.
+    Args:
+        page_name: The blob name of the page (e.g. 'pages/charmander').
+        pokemon_data: A dictionary with all data associated with the page.
+    Returns:
+        entry: Dictionary with the page name and its manifest fields.
+    """
+    entry = {field: pokemon_data.get(field) for field in MANIFEST_FIELDS}
+    entry["page"] = page_name
+    return entry
+
+
+def pokemon_image_path(id):
+    """ Returns the name of the image blob of a pokemon.
+    Args:
+        id: Pokedex id of the pokemon.
+    Returns:
+        The blob name of the pokemon image (e.g. 'master_pokedex/images/025.png').
+    """
+    return "master_pokedex/images/" + "{:03d}".format(id) + ".png"
+
+
+def image_type(header):
+    """ Returns the content type of an image from the first bytes of its file.
+    Args:
+        header: At least the first 12 bytes of the file.
+    Returns:
+        One of IMAGE_TYPES, or None if the file is not an image of an allowed type.
+    """
+    for content_type, signatures in IMAGE_SIGNATURES.items():
+        if header.startswith(signatures):
+            if content_type == "image/webp" and header[8:12] != b"WEBP":
+                continue
+            return content_type
+    return None
+
 
 class Backend:
 
     def __init__(self,
-                 client=storage.Client(),
+                 client=None,
                  hashfunc=hashlib,
                  base64func=base64,
-                 json=json):
+                 json=json,
+                 fetch_workers=8,
+                 pokedex_ttl=300,
+                 image_cache_bytes=16 * 1024 * 1024,
+                 flush_workers=8,
+                 derive_ranks=False,
+                 metrics=None,
+                 user_cache_ttl=300,
+                 blob_cache=None):
         """
         Args:
-            client: Dependency injection for mocking the cloud storage client.
+            client: The cloud storage client, or a StorageClient from blob_store. The google cloud storage
+                client is created when none is given.
             hashfunc: Dependency injection for mocking the hashlib module.
             base64func: Dependency injection for mocking the base64 module.
             json: Dependency injection for mocking the json module.
+            fetch_workers: Maximum number of page blobs downloaded at the same time when scanning the pages.
+            pokedex_ttl: Seconds between checks for a new version of the pokedex blob.
+            image_cache_bytes: Total size in bytes of the images kept in memory.
+            flush_workers: Maximum number of queued rank updates written at the same time.
+            derive_ranks: Compute ranks from the leaderboard instead of storing them in every game_users blob,
+                the points of a user are then only kept in its game record.
+            metrics: Metrics that every storage operation is counted and timed in, or None to not record them.
+            user_cache_ttl: Seconds a loaded user is used before its password blob is read again.
+            blob_cache: BlobCache the json blobs (pages, categories and game data) are read through,
+                or None to download them every time.
         """
-        self.client = client
+        self.client = client if client is not None else storage.Client()
+        if metrics is not None:
+            self.client = InstrumentedClient(self.client, metrics)
+        self.metrics = metrics
         self.hashfunc = hashfunc
         self.base64func = base64func
         self.json = json
+        self.fetch_workers = fetch_workers
+        self._buckets = {}  # bucket name -> bucket handle, resolved once per process
+        self.bucket_lookups = 0
+        self.page_index = PageIndex()
+        self.page_index_lock = threading.Lock()
+        self.search_index = TrigramIndex()
+        self.search_index_lock = threading.Lock()
+        self.pokedex = None
+        self.pokedex_ttl = pokedex_ttl
+        self.pokedex_checked = 0
+        self.pokedex_lock = threading.Lock()
+        self.image_cache = ImageCache(image_cache_bytes)
+        self.flush_workers = flush_workers
+        self.dirty_ranks = {}  # username -> last queued game_users/user state
+        self.dirty_ranks_lock = threading.Lock()
+        self.derive_ranks = derive_ranks
+        self.ranking = None
+        self.ranking_generation = None
+        self.ranking_lock = threading.RLock()
+        self.user_cache = UserCache(user_cache_ttl)
+        self.blob_cache = blob_cache
+
+    def get_bucket(self, name):
+        """ Returns the handle for a bucket, only asking the storage client for it the first time.
+        Args:
+            name: The name of the bucket (WIKI_BUCKET or USERS_BUCKET).
+        Returns:
+            bucket: The cached bucket handle.
+        """
+        bucket = self._buckets.get(name)
+        if bucket is None:
+            bucket = self.client.get_bucket(name)
+            self.bucket_lookups += 1
+            self._buckets[name] = bucket
+        return bucket
+
+    def refresh_buckets(self):
+        """ Drops every cached bucket handle so the next call resolves them again.
+        Returns:
+            The number of bucket lookups made since the last refresh.
+        """
+        lookups = self.bucket_lookups
+        self._buckets = {}
+        self.bucket_lookups = 0
+        return lookups
 
     def get_wiki_page(self, name):
         """ Retrieves user generated page from cloud storage and returns it.
@@ -47,37 +202,105 @@ class Backend:
         Returns:
             content: The user generated page data.
         """
-        bucket = self.client.get_bucket('wiki-content-techx')
-        blob = bucket.get_blob(f'pages/{name}')
+        bucket = self.get_bucket(WIKI_BUCKET)
 
-        # reading json object blob and returning its contents
-        with blob.open('r') as f:
-            content = f.read()
-        return content
+        def read_page(blob):
+            # reading json object blob and returning its contents
+            with blob.open('r') as f:
+                return f.read()
 
-    def get_all_page_names(self):
-        """ Retrieves the names of all user generated pages and returns a list containing them.
+        return self.read_cached(bucket, f'pages/{name}', read_page)
+
+    def read_cached(self, bucket, name, load, copy=None):
+        """ Reads a json blob through the blob cache, or straight from the storage when there is no cache.
+        Args:
+            bucket: The bucket of the blob.
+            name: The name of the blob.
+            load: Function that downloads and parses the blob returned by get_blob, which is None if it does not exist.
+            copy: Function that copies the parsed object, for objects the caller may change.
         Returns:
-            page_names: List that contains all user generated page names as strings.
+            The parsed object.
         """
-        bucket = self.client.get_bucket('wiki-content-techx')
-        blobs = bucket.list_blobs(prefix='pages/')
-        page_names = []
-
-        # adding every blob to page_names except the first blob since it's just the folder name
-        for index, blob in enumerate(blobs):
-            if index == 0:
+        if self.blob_cache is None:
+            return load(bucket.get_blob(name))
+        value = self.blob_cache.get(bucket, name, load)
+        # the cached object is shared by every read, callers that change it get their own copy
+        return copy(value) if copy is not None and value is not None else value
+
+    def forget_cached(self, name):
+        """ Drops a blob from the blob cache after writing it."""
+        if self.blob_cache is not None:
+            self.blob_cache.invalidate(name)
+
+    def write_if_unchanged(self, name, update, conflict=None):
+        """ Reads, changes and writes a json blob of the wiki bucket, the write only goes through if
+            nobody else wrote the blob since it was read, otherwise it is read and changed again.
+        Args:
+            name: The name of the blob.
+            update: Function that reads and changes the blob, returning a tuple with the json string to
+                write and the generation it was read at (0 if it does not exist yet), or None to write nothing.
+                It is called again after every conflict.
+            conflict: Function called after a conflict, to forget the state read before it.
+        Returns:
+            The generation of the written blob, or None if update wrote nothing.
+        Raises:
+            PreconditionFailed: Every attempt was beaten by another write.
+        """
+        bucket = self.get_bucket(WIKI_BUCKET)
+
+        for attempt in range(WRITE_RETRIES):
+            update_result = update()
+            if update_result is None:
+                return None
+            data, generation = update_result
+
+            blob = bucket.blob(name)
+            try:
+                blob.upload_from_string(data=data,
+                                        content_type="application/json",
+                                        if_generation_match=generation)
+            except PreconditionFailed:
+                # somebody else wrote the blob first, read it again and retry
+                self.forget_cached(name)
+                if conflict is not None:
+                    conflict()
+                if attempt == WRITE_RETRIES - 1:
+                    raise
                 continue
-            page_names.append(blob.name)
-        return page_names
+            self.forget_cached(name)
+            return blob.generation
+
+    def get_all_page_names(self, limit=None, cursor=None):
+        """ Retrieves the names of all user generated pages and returns a list containing them.
+        Args:
+            limit: Maximum number of page names returned, or None for all of them.
+            cursor: The next_cursor or prev_cursor of a previous page of names, or None for the first page.
+        Returns:
+            page_names: List that contains all user generated page names as strings, or a ResultPage
+            with one page of names and the cursors of its neighbours when a limit is given.
+        """
+        return self.search_pages(None, None, None, None, None, limit, cursor)
 
     def upload(self, file, pokemon_data):
         """ Uploads image data and user generated page data to the cloud storage.
+            The image must be one of IMAGE_TYPES, and its bytes must match the content type it was sent with.
         Args:
             file: The image file uploaded by the user.
             pokemon_data: A dictionary with all data associated with user generated page.
+        Returns:
+            True if the page was created, False if a page with the same name already exists.
+        Raises:
+            ValueError: The file is not an image of an allowed type, nothing is written.
+            Exception: The manifest or the search index could not be updated, the page is deleted again.
         """
-        bucket = self.client.get_bucket('wiki-content-techx')
+        # the image is served from the wiki origin, so it is only stored with a type it really has
+        content_type = image_type(file.read(12))
+        file.seek(0)
+        declared_type = (file.content_type or "").split(";")[0].strip().lower()
+        if content_type is None or content_type != declared_type:
+            raise ValueError("The image must be a PNG, JPEG, GIF or WEBP file.")
+
+        bucket = self.get_bucket(WIKI_BUCKET)
 
         path = 'pages/' + pokemon_data["name"].lower()
         blob = bucket.get_blob(path)
@@ -85,94 +308,151 @@ class Backend:
         if not blob:
             # uploading user image of pokemon to the images blob
             images = bucket.blob(f'images/{file.filename}')
-            images.upload_from_file(file)
+            images.upload_from_file(file, content_type=content_type)
 
             # adding image name to pokemon dictionary
             pokemon_data["image-name"] = file.filename
 
             # adding image type (jpg, png, etc) to pokemon dictionary
-            pokemon_data["image-type"] = file.content_type
+            pokemon_data["image-type"] = content_type
 
             # converting pokemon dictionary to json object
             json_obj = self.json.dumps(pokemon_data)
 
-            # uploading a json object to the new pages blob
+            # uploading a json object to the new pages blob, unless another upload created it meanwhile
             blob = bucket.blob(path)
-            blob.upload_from_string(data=json_obj,
-                                    content_type="application/json")
+            try:
+                blob.upload_from_string(data=json_obj,
+                                        content_type="application/json",
+                                        if_generation_match=0)
+            except PreconditionFailed:
+                return False
+            self.forget_cached(path)
+
+            # adding the page to the manifest, the search index and their in-memory indexes without reading the pages again
+            try:
+                old_generation, new_generation = self.update_manifest(path, pokemon_data)
+                self.add_to_index("page_index", self.page_index_lock, old_generation, new_generation, path, pokemon_data)
+
+                old_generation, new_generation = self.update_search_index(path, pokemon_data)
+                self.add_to_index("search_index", self.search_index_lock, old_generation, new_generation, path, pokemon_data)
+            except Exception:
+                # a page missing from the manifest would never be listed or searched, so the upload is undone
+                self.delete_written_blobs([blob])
+                self.forget_cached(path)
+                self.unindex_page(path)
+                raise
 
             return True
 
         return False
 
+    def unindex_page(self, page_name):
+        """ Takes a page out of the manifest and the search index after a failed upload.
+            The in-memory indexes are dropped, so the next search reads the blobs again.
+            Blobs that cannot be changed are logged, `flask rebuild-manifest` repairs them.
+        Args:
+            page_name: The blob name of the page (e.g. 'pages/charmander').
+        """
+        for update in (self.update_manifest, self.update_search_index):
+            try:
+                update(page_name, None)
+            except Exception as e:
+                logger.error("Could not remove %s from an index after a failed upload: %s", page_name, e)
+        self.refresh_page_index()
+        self.refresh_search_index()
+
     def sign_up(self, username, password):
         """ Uploads user account information to the cloud storage if account doesn't already exist.
             Creates a hashed password from user password and uploads new password to cloud storage.
+            The password blob is only created if it does not exist yet, which claims the username even
+            against concurrent sign ups. The game blobs of the user are then written at the same time,
+            replacing any left behind, if one of them fails everything written for the account is deleted again.
         Args:
             username: The username that the user inputs.
             password: The password that the user inputs.
+        Returns:
+            True if the account was created, False if an account with that username already exists.
         """
-        bucket = self.client.get_bucket('users-passwords-techx')
-
-        game_users_bucket = self.client.get_bucket('wiki-content-techx')
-        path = f'user_game_ranking/game_users/{username}'
-
-        # if an account with that username already exists we shouldn't be creating a new one
-        if bucket.get_blob(username):
-            return False
+        bucket = self.get_bucket(USERS_BUCKET)
+        game_users_bucket = self.get_bucket(WIKI_BUCKET)
+
+        # salting the password with username and a secret word
+        salt = f"{username}jmepokemon{password}"
+        # generating hashed password after the salting
+        hashed_password = self.hashfunc.blake2b(salt.encode()).hexdigest()
+
+        if self.derive_ranks:
+            # the seen pokemon and the points are kept together in the game record
+            record = GameRecord(username, SeenSet(MAX_ID))
+            writes = [(game_users_bucket.blob(GAME_RECORDS_PREFIX + username),
+                       record.encode(self.json, self.base64func), "application/json")]
         else:
-            blob = bucket.blob(username)
-
-            # salting the password with username and a secret word
-            salt = f"{username}jmepokemon{password}"
-            # generating hashed password after the salting
-            hashed_password = self.hashfunc.blake2b(salt.encode()).hexdigest()
-
-            # writing hashed password to the new user blob we created
-            with blob.open('w') as f:
-                f.write(hashed_password)
-
-            # Adds new user to the ranking blob
-            game_blob = game_users_bucket.blob(path)
+            # the ranking blob and the seen blob, empty because a new user has not encountered any pokemon yet
             json_obj = {"name": username, "points": 0, "rank": None}
-            json_str = self.json.dumps(json_obj)
-            game_blob.upload_from_string(data=json_str,
-                                         content_type="application/json")
+            writes = [(game_users_bucket.blob(GAME_USERS_PREFIX + username), self.json.dumps(json_obj), "application/json"),
+                      (game_users_bucket.blob(f'user_game_ranking/seen/{username}'), SeenSet(MAX_ID).encode(), SEEN_CONTENT_TYPE)]
 
-            # Adds new user to the seen blob
-            seen_path = f'user_game_ranking/seen/{username}'
-            seen_blob = game_users_bucket.blob(seen_path)
-            seen_json = {} # empty because a new user has not encountered any yet
-            seen_str = self.json.dumps(seen_json)
-            seen_blob.upload_from_string(data=seen_str,content_type="application/json")
-
-            return True
+        # if an account with that username already exists we shouldn't be creating a new one
+        blob = bucket.blob(username)
+        try:
+            blob.upload_from_string(data=hashed_password, content_type="text/plain", if_generation_match=0)
+        except PreconditionFailed:
+            return False
+        # the username may be cached as an account that does not exist
+        self.invalidate_user(username)
+
+        # the username is claimed by the password blob, game blobs left behind by a deleted account are overwritten
+        def write(game_blob, data, content_type):
+            game_blob.upload_from_string(data=data, content_type=content_type)
+            self.forget_cached(game_blob.name)
+
+        # every write runs in a copy of the request context, so its storage calls are counted for the request
+        with ThreadPoolExecutor(max_workers=len(writes)) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, write, *args) for args in writes]
+
+        errors = [future.exception() for future in futures if future.exception()]
+        if errors:
+            written = [blob] + [game_blob for (game_blob, data, content_type), future in zip(writes, futures)
+                                if not future.exception()]
+            self.delete_written_blobs(written)
+            self.invalidate_user(username)
+            raise errors[0]
+        return True
+
+    def delete_written_blobs(self, blobs):
+        """ Deletes blobs written by a failed operation, unless somebody else wrote them since.
+            Blobs that cannot be deleted are logged and left behind.
+        Args:
+            blobs: The blobs, with the generation they were written at.
+        """
+        for blob in blobs:
+            try:
+                blob.delete(if_generation_match=blob.generation)
+            except Exception as e:
+                logger.error("Could not delete %s after a failed write: %s", blob.name, e)
 
     def sign_in(self, username, password):
         """ Checks whether specific account information exists in the cloud storage.
             Creates a hashed password from user password and compares it with the hashed 
             password associated with the username if it exists.
+            A cached user is only trusted when the password matches, otherwise the user is read again
+            in case the account was created or changed on another server.
         Args:
             username: The username that the user inputs.
             password: The password that the user inputs.
         """
-        bucket = self.client.get_bucket('users-passwords-techx')
-        blob = bucket.get_blob(username)
-
-        if blob:
-            # salting the password with username and a secret word
-            salt = f"{username}jmepokemon{password}"
-            # generating hashed password after the salting
-            hashed_password = self.hashfunc.blake2b(salt.encode()).hexdigest()
+        # salting the password with username and a secret word
+        salt = f"{username}jmepokemon{password}"
+        # generating hashed password after the salting
+        hashed_password = self.hashfunc.blake2b(salt.encode()).hexdigest()
 
-            # reading hashed password from the username
-            with blob.open('r') as f:
-                content = f.read()
-            # checking whether the hashed password matches the password given
-            if content == hashed_password:
-                return True
+        found, user = self.user_cache.get(username)
+        if not found or user is None or user.password != hashed_password:
+            user = self.read_user(username)
 
-        return False
+        # checking whether the hashed password matches the password given
+        return user is not None and user.password == hashed_password
 
     def get_image(self, blob_name):
         """ Retrieves image data from cloud storage and converts it to base64.
@@ -181,188 +461,445 @@ class Backend:
         Returns:
             image: Image data converted to base64 for front-end use.
         """
-        bucket = self.client.get_bucket('wiki-content-techx')
-        blob = bucket.get_blob(blob_name)
-        with blob.open('rb') as f:
-            content = f.read()
+        content = self.get_image_bytes(blob_name)
         image = self.base64func.b64encode(content).decode("utf-8")
         return image
 
+    def get_image_bytes(self, blob_name, blob=None):
+        """ Retrieves the raw bytes of an image, using the image cache when the blob did not change.
+        Args:
+            blob_name: Name of the image blob.
+            blob: The image blob if its metadata was already retrieved.
+        Returns:
+            content: The image bytes.
+        """
+        if blob is None:
+            bucket = self.get_bucket(WIKI_BUCKET)
+            blob = bucket.get_blob(blob_name)
+
+        content = self.image_cache.get(blob_name, blob.generation)
+        if content is None:
+            content = blob.download_as_bytes()
+            self.image_cache.put(blob_name, blob.generation, content)
+        return content
+
+    def get_image_blob(self, blob_name):
+        """ Retrieves the metadata of an image blob without downloading the image.
+        Args:
+            blob_name: Name of the image blob, it must be inside one of the IMAGE_PREFIXES folders.
+        Returns:
+            blob: The image blob, or None if it does not exist or is not an image folder.
+        """
+        if not blob_name.startswith(IMAGE_PREFIXES):
+            return None
+        bucket = self.get_bucket(WIKI_BUCKET)
+        return bucket.get_blob(blob_name)
+
     def get_user(self, username):
         """ Creates User object containing username and hashed password retreived from cloud storage.
+            The user is read from the user cache, the password blob is only read once per user_cache_ttl.
         Args:
             username: The username that the user inputs.
         Returns:
             User(username, password): User object for account related use.
         """
-        bucket = self.client.get_bucket('users-passwords-techx')
+        found, user = self.user_cache.get(username)
+        if found:
+            return user
+        return self.read_user(username)
+
+    def read_user(self, username):
+        """ Reads the password blob of a user and caches the user.
+        Args:
+            username: The username of the user.
+        Returns:
+            The User, or None if the account does not exist.
+        """
+        bucket = self.get_bucket(USERS_BUCKET)
         blob = bucket.get_blob(username)
 
+        user = None
         if blob:
             with blob.open('r') as f:
                 password = f.read()
-            return User(username, password)
-        else:
-            return None
+            user = User(username, password)
+        self.user_cache.put(username, user)
+        return user
+
+    def invalidate_user(self, username):
+        """ Forgets the cached user of a username, used when its account is created or its password changes.
+        Args:
+            username: The username of the user.
+        """
+        self.user_cache.invalidate(username)
 
 #------------------------------------ Search Filter ------------------------------------#
-    def get_pages_using_filter_and_search(self, name, type, region, nature, sorting):
+    def get_pages_using_filter_and_search(self, name, type, region, nature, sorting, limit=None, cursor=None):
         """ Retrieves all pages that match filter options selected by the user.
         Args:
             name: The name of the wiki page we are looking for.
             type: The type of the pokemon we are looking for.
             region: The region of the pokemon we are looking for.
             nature: The nature of the pokemon we are looking for.
-            sorting: The sorting metric that the user selected.                         
+            sorting: The sorting metric that the user selected.
+            limit: Maximum number of page names returned, or None for all of them.
+            cursor: The next_cursor or prev_cursor of a previous page of results, or None for the first page.
         Returns:
-            page_names: The names of all pages that match filter criteria selected by user.
+            page_names: The names of all pages that match filter criteria selected by user, or a ResultPage
+            with one page of them when a limit is given.
         """
-        bucket = self.client.get_bucket('wiki-content-techx')
-        blobs = bucket.list_blobs(prefix='pages/')
-        page_content = []
-        page_names = []
+        return self.search_pages(name, type, region, nature, sorting, limit, cursor)
 
-        for index, blob in enumerate(blobs):
-            if index == 0:
-                continue
+    def search_pages(self, name, type, region, nature, sorting, limit, cursor):
+        """ Finds the pages that match the search and the filters in the in-memory indexes,
+            the storage is only read when an index has to be loaded again.
+        Args:
+            name: Text to look for in the pokemon names and descriptions, or None.
+            type: The type of the pokemon, or None.
+            region: The region of the pokemon, or None.
+            nature: The nature of the pokemon, or None.
+            sorting: "LowestToHighest", "HighestToLowest" or None to list the pages by page name.
+            limit: Maximum number of page names returned, or None for all of them.
+            cursor: The next_cursor or prev_cursor of a previous page of results, or None for the first page.
+        Returns:
+            page_names: The names of the matching pages, or a ResultPage with one page of them when a limit is given.
+        """
+        index = self.get_page_index()
+        # the name is looked up in the names and descriptions of the search index
+        within = None
+        if name:
+            search_index = self.get_search_index()
+            with self.search_index_lock:
+                within = search_index.search(name)
+        # uploads change the indexes in place, so they are only read while holding their locks
+        with self.page_index_lock:
+            if limit is None:
+                return index.search(None, type, region, nature, sorting, within)
+            return index.search_page(None, type, region, nature, sorting, limit, cursor, within)
+
+    def suggest_pages(self, prefix, limit):
+        """ Finds the pages whose pokemon name starts with a prefix, for type-ahead in the search box.
+            The suggestions come from the in-memory page index and the storage is only read to load
+            it the first time. Uploads of this instance are added to it right away, uploads of other
+            instances once a listing or search finds a new manifest generation.
+        Args:
+            prefix: The start of the pokemon name.
+            limit: Maximum number of suggestions.
+        Returns:
+            List of up to limit (lowercased pokemon name, page name) pairs in alphabetical order.
+        """
+        index = self.page_index
+        if not index.loaded:
+            index = self.get_page_index()
+        with self.page_index_lock:
+            return index.suggest(prefix, limit)
+
+    def get_page_index(self):
+        """ Returns the in-memory index of all user generated pages.
+            Only the manifest metadata is read when the index is up to date, the manifest itself
+            is downloaded again only when another upload changed its generation.
+            A changed manifest is loaded into a new index that is swapped in, uploads of this
+            instance add their page to the current index in place, so it is read holding page_index_lock.
+        Returns:
+            page_index: The PageIndex with every user generated page.
+        """
+        def build(pages):
+            index = PageIndex()
+            for entry in pages:
+                index.add(entry["page"], entry)
+            return index
+
+        return self.load_index("page_index", self.page_index_lock, MANIFEST_PATH,
+                               self.read_manifest, self.rebuild_manifest, build)
+
+    def refresh_page_index(self):
+        """ Drops the in-memory page index so the next filter reads the manifest again."""
+        with self.page_index_lock:
+            self.page_index = PageIndex()
+
+    def load_index(self, attribute, lock, name, read, rebuild, build):
+        """ Returns an in-memory index of the pages, loading it again if its blob changed.
+            A new index is built and swapped in, so readers never see a half loaded index.
+        Args:
+            attribute: The backend attribute holding the index, "page_index" or "search_index".
+            lock: The lock of the index.
+            name: The name of the blob the index is loaded from.
+            read: Function that reads the blob.
+            rebuild: Function that creates the blob from the pages, used when it does not exist.
+            build: Function that makes the index from what read returned.
+        Returns:
+            The up to date index.
+        """
+        bucket = self.get_bucket(WIKI_BUCKET)
+        blob = bucket.get_blob(name)
+        generation = blob.generation if blob else 0
+
+        index = getattr(self, attribute)
+        if index.loaded and index.generation == generation:
+            return index
+
+        with lock:
+            index = getattr(self, attribute)
+            if index.loaded and index.generation == generation:
+                # another request loaded the same blob while we waited
+                return index
+            if blob:
+                data = read(blob)
+            else:
+                data, generation = rebuild(only_if_missing=True)
+
+            index = build(data)
+            index.generation = generation
+            index.loaded = True
+            setattr(self, attribute, index)
+
+        return index
+
+    def add_to_index(self, attribute, lock, old_generation, new_generation, page_name, pokemon_data):
+        """ Adds an uploaded page to an in-memory index if the index is the version the upload changed.
+            The page is added in place while holding the lock of the index, which readers hold as well.
+        Args:
+            attribute: The backend attribute holding the index, "page_index" or "search_index".
+            lock: The lock of the index.
+            old_generation: The generation of the index blob the upload changed.
+            new_generation: The generation of the index blob the upload wrote.
+            page_name: The blob name of the page.
+            pokemon_data: A dictionary with the data of the page.
+        """
+        with lock:
+            index = getattr(self, attribute)
+            if index.loaded and index.generation == old_generation:
+                index.add(page_name, pokemon_data)
+                index.generation = new_generation
+
+    def update_index_blob(self, name, read, change, rebuild):
+        """ Changes a blob made from the pages (the manifest or the search index) with a conditional write.
+        Args:
+            name: The name of the blob.
+            read: Function that reads the blob.
+            change: Function that returns the changed json object from what read returned.
+            rebuild: Function that creates the blob from the pages, used when it does not exist.
+        Returns:
+            Tuple with the generation that was changed (None if the blob was rebuilt) and the new generation.
+        """
+        bucket = self.get_bucket(WIKI_BUCKET)
+        old_generation = None
+
+        def update():
+            nonlocal old_generation
+            old_blob = bucket.get_blob(name)
+            if not old_blob:
+                return None
+            old_generation = old_blob.generation
+            return self.json.dumps(change(read(old_blob))), old_blob.generation
+
+        new_generation = self.write_if_unchanged(name, update)
+        if new_generation is None:
+            # the page blob is already written, so rebuilding includes it
+            data, generation = rebuild(only_if_missing=True)
+            return None, generation
+        return old_generation, new_generation
+
+    def create_index_blob(self, name, json_obj, value, read, only_if_missing):
+        """ Writes a blob made from the pages (the manifest or the search index).
+        Args:
+            name: The name of the blob.
+            json_obj: The json object written.
+            value: What read returns for the written blob.
+            read: Function that reads the blob.
+            only_if_missing: Only write the blob if it does not exist yet.
+        Returns:
+            Tuple with value, or what read returned if another instance created the blob first, and the blob generation.
+        """
+        bucket = self.get_bucket(WIKI_BUCKET)
+        blob = bucket.blob(name)
+        try:
+            blob.upload_from_string(data=self.json.dumps(json_obj),
+                                    content_type="application/json",
+                                    if_generation_match=0 if only_if_missing else None)
+        except PreconditionFailed:
+            # another instance created the blob in the meantime
+            blob = bucket.get_blob(name)
+            return read(blob), blob.generation
+        return value, blob.generation
+
+    def read_manifest(self, blob):
+        """ Reads the entries of the page manifest.
+        Args:
+            blob: The manifest blob.
+        Returns:
+            pages: List of manifest entries, one per user generated page.
+        """
+        json_str = blob.download_as_string()
+        return self.json.loads(json_str)["pages"]
+
+    def update_manifest(self, page_name, pokemon_data):
+        """ Adds, replaces or removes a page in the page manifest.
+            The manifest is only written if nobody else changed it since we read it,
+            otherwise it is read again and the change is retried.
+        Args:
+            page_name: The blob name of the page (e.g. 'pages/charmander').
+            pokemon_data: A dictionary with all data associated with the page, None to remove the page.
+        Returns:
+            Tuple with the manifest generation that was updated and the new generation.
+        """
+        def change(pages):
+            pages = [page for page in pages if page["page"] != page_name]
+            if pokemon_data is not None:
+                pages.append(manifest_entry(page_name, pokemon_data))
+            return {"pages": pages}
+
+        return self.update_index_blob(MANIFEST_PATH, self.read_manifest, change, self.rebuild_manifest)
+
+    def scan_pages(self):
+        """ Reads every user generated page blob, downloading up to fetch_workers pages at the same time.
+        Returns:
+            List of tuples with the page name and the page data, in listing order.
+        """
+        bucket = self.get_bucket(WIKI_BUCKET)
+        # skipping the folder placeholder
+        blobs = [blob for blob in bucket.list_blobs(prefix='pages/') if not blob.name.endswith('/')]
+
+        def read_page(blob):
             with blob.open('r') as f:
                 content = f.read()
-            pokemon_data = self.json.loads(content)
-            if (name == None or name.lower() in pokemon_data["name"].lower()) and (type == None or pokemon_data["type"] == type) and (region == None or pokemon_data["region"] == region) and (nature == None or pokemon_data["nature"] == nature):
-                page_names.append(blob.name)
-                if sorting:
-                    level = int(pokemon_data["level"])
-                    page_content.append([level, blob.name])
-                                        
-        if sorting:
-            return self.get_pages_using_sorting(page_content, sorting)
-
-        return page_names
+            return blob.name, self.json.loads(content)
 
+        # the futures keep the listing order no matter which download finishes first
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, read_page, blob) for blob in blobs]
+            return [future.result() for future in futures]
 
-    def get_pages_using_sorting(self, pages_content, sorting):
-        """ This function sorts the page names that meet the filter criteria by level.
+    def rebuild_manifest(self, only_if_missing=False):
+        """ Regenerates the page manifest from the raw page blobs.
         Args:
-            pages_content: List of tuples containing page names and there respective level.
-            sorting: The sorting metric that the user selected.                       
+            only_if_missing: Only write the manifest if it does not exist yet.
         Returns:
-            page_names: The names of the pages in the order determined by the sorting metric.
+            Tuple with the manifest entries and the manifest generation.
         """
-        bucket = self.client.get_bucket('wiki-content-techx')
-        
-        if sorting == "LowestToHighest":
-            pages_content.sort()
-        if sorting == "HighestToLowest":
-            pages_content.sort(reverse = True)
+        pages = [manifest_entry(page_name, pokemon_data) for page_name, pokemon_data in self.scan_pages()]
+        return self.create_index_blob(MANIFEST_PATH, {"pages": pages}, pages, self.read_manifest, only_if_missing)
 
-        page_names = []
 
-        for level, name in pages_content:
-            page_names.append(name)
+    def get_search_index(self):
+        """ Returns the in-memory trigram index of the names and descriptions of all user generated pages.
+            Like the page index, the index blob is downloaded again only when its generation changed,
+            and the index is read holding search_index_lock.
+        Returns:
+            search_index: The TrigramIndex with every user generated page.
+        """
+        def build(data):
+            index = TrigramIndex()
+            index.load_dict(data)
+            return index
 
-        return page_names
-        
+        return self.load_index("search_index", self.search_index_lock, SEARCH_INDEX_PATH,
+                               self.read_search_index, self.rebuild_search_index, build)
+
+    def refresh_search_index(self):
+        """ Drops the in-memory search index so the next search reads the index blob again."""
+        with self.search_index_lock:
+            self.search_index = TrigramIndex()
+
+    def read_search_index(self, blob):
+        """ Reads the trigram index blob.
+        Args:
+            blob: The search index blob.
+        Returns:
+            The index dictionary, as made by TrigramIndex.to_dict.
+        """
+        json_str = blob.download_as_string()
+        return self.json.loads(json_str)
+
+    def update_search_index(self, page_name, pokemon_data):
+        """ Adds, replaces or removes a page in the search index blob.
+            Like the manifest, the index is only written if nobody else changed it since we read it.
+        Args:
+            page_name: The blob name of the page (e.g. 'pages/charmander').
+            pokemon_data: A dictionary with all data associated with the page, None to remove the page.
+        Returns:
+            Tuple with the index generation that was updated and the new generation.
+        """
+        def change(data):
+            index = TrigramIndex()
+            index.load_dict(data)
+            if pokemon_data is None:
+                index.remove(page_name)
+            else:
+                index.add(page_name, pokemon_data)
+            return index.to_dict()
+
+        return self.update_index_blob(SEARCH_INDEX_PATH, self.read_search_index, change, self.rebuild_search_index)
+
+    def rebuild_search_index(self, only_if_missing=False):
+        """ Regenerates the search index blob from the raw page blobs.
+        Args:
+            only_if_missing: Only write the index if it does not exist yet.
+        Returns:
+            Tuple with the index dictionary and the index generation.
+        """
+        index = TrigramIndex()
+        for page_name, pokemon_data in self.scan_pages():
+            index.add(page_name, pokemon_data)
+        data = index.to_dict()
+        return self.create_index_blob(SEARCH_INDEX_PATH, data, data, self.read_search_index, only_if_missing)
 
-    def get_pages_using_search(self, name):
+    def get_pages_using_search(self, name, limit=None, cursor=None):
         '''Gets all the pages that match the given name.
         Args:
             name: Name or part of the name of a wiki page.
+            limit: Maximum number of page names returned, or None for all of them.
+            cursor: The next_cursor or prev_cursor of a previous page of results, or None for the first page.
         Rturns:
-            page_names: The name of the pages that match the given name.
+            page_names: The name of the pages that match the given name, or a ResultPage with one page
+            of them when a limit is given.
         '''
-        bucket = self.client.get_bucket('wiki-content-techx')
-        blobs = bucket.list_blobs(prefix='pages/')
-        page_names = []
-
-        for index, blob in enumerate(blobs):
-            if index == 0:
-                continue
-            with blob.open('r') as f:
-                content = f.read()
-            content = self.json.loads(content)
-            if name in content["name"].lower():
-                page_names.append(blob.name)
-
-        return page_names
+        return self.search_pages(name, None, None, None, None, limit, cursor)
 
 #------------------------------------ Game ------------------------------------#
-    def get_seen_pokemon(self, username): 
+    def get_pokedex(self):
         """
-        Gets a json object that stores the pokemon that the user has seen so far
+        Returns the in-memory pokedex, loading it the first time.
+        At most once every pokedex_ttl seconds the blob generation is checked and the
+        pokedex is loaded again if the blob was replaced.
         """
-        game_users_bucket = self.client.get_bucket('wiki-content-techx')
-        path = f'user_game_ranking/seen/{username}'
-        blob = game_users_bucket.get_blob(path)
-        # turn data into json
-        json_str = blob.download_as_string()
-        json_obj = self.json.loads(json_str)
-
-        return json_obj
-    
-    def update_seen_pokemon(self,username,new_list):
-        """
-        takes a json object to overwrite the old blob
-        """
-        bucket = self.client.get_bucket("wiki-content-techx")
-        seen_path = f"user_game_ranking/seen/{username}"
-        blob = bucket.blob(seen_path)
-        new_seen = self.json.dumps(new_list)
-
-        # if the lenght of the json object is greater than the number of pokemon,
-        # then we set the json object to an empty state
-        if len(new_seen) > MAX_ID:
-            new_seen = json.dumps({})
-        # upload blob
-        blob.upload_from_string(data=new_seen, content_type="application/json")
-
-    def get_pokemon_image(self,id):
-        """
-        Gets a pokemon image using the pokemon's unique id
-        """
-        image_id = "{:03d}".format(id)
-        bucket = self.client.get_bucket("wiki-content-techx")
-        image_path = "master_pokedex/images/" + image_id + ".png"
-        # Get from bucket
-        pokemon_image_blob = bucket.get_blob(image_path)
-        # Read contents into base64
-        with pokemon_image_blob.open('rb') as f:
-            content = f.read()
-        pokemon_image = self.base64func.b64encode(content).decode("utf-8")
-        return pokemon_image
-
-    def get_pokeball(self):
-        """
-        Returns the pokeball image
-        """
-        bucket = self.client.get_bucket("wiki-content-techx")
-        image_path = "master_pokedex/images/pokeball.png"
-        pokeball_blob = bucket.get_blob(image_path)
-        # Read contents into base64
-        with pokeball_blob.open('rb') as f:
-            content = f.read()
-        pokeball_image = self.base64func.b64encode(content).decode("utf-8")
-        return pokeball_image
+        now = time.monotonic()
+        if self.pokedex is not None and now - self.pokedex_checked < self.pokedex_ttl:
+            return self.pokedex
+
+        with self.pokedex_lock:
+            if self.pokedex is None or now - self.pokedex_checked >= self.pokedex_ttl:
+                bucket = self.get_bucket(WIKI_BUCKET)
+                pokedex_blob = bucket.get_blob(POKEDEX_PATH)
+                if self.pokedex is None or self.pokedex.generation != pokedex_blob.generation:
+                    poke_str = pokedex_blob.download_as_string()
+                    self.pokedex = Pokedex(self.json.loads(poke_str), pokedex_blob.generation)
+                self.pokedex_checked = now
+        return self.pokedex
 
     def get_pokemon_data(self,id):
         """
         Returns a json obj with the pokemon data for that particular id
         """
-        bucket = self.client.get_bucket("wiki-content-techx")
-        data_path = "master_pokedex/pokedex.json"
-        pokedex_blob = bucket.get_blob(data_path)
-        poke_str = pokedex_blob.download_as_string()
-        pokedex_json = self.json.loads(poke_str)
-        pokemon_json = pokedex_json[id-1]
-        return pokemon_json
+        return self.get_pokedex().get(id)
+
+    def get_pokemon_id(self, name):
+        """
+        Returns the id of the pokemon with that english name, or None if there is no such pokemon
+        """
+        return self.get_pokedex().get_id(name)
 
 #------------------------------------ Leaderboard ------------------------------------#
     def get_categories(self):
-        bucket = self.client.get_bucket("wiki-content-techx")
-        blob = bucket.get_blob("filtering/categories.json")
-        with blob.open() as f:
-            content = f.read()
-        categories = json.loads(content)
-        return categories
+        bucket = self.get_bucket(WIKI_BUCKET)
+
+        def read_categories(blob):
+            with blob.open() as f:
+                content = f.read()
+            return json.loads(content)
+
+        # the categories are only read by the templates, so they are not copied
+        return self.read_cached(bucket, CATEGORIES_PATH, read_categories)
     
     def get_game_user(self, username):
         '''Gets game data for a specific user.
@@ -371,14 +908,19 @@ class Backend:
         Returns:
             JSON object containing user username, points and rank.
         '''
-        game_users_bucket = self.client.get_bucket('wiki-content-techx')
-        path = f'user_game_ranking/game_users/{username}'
+        if self.derive_ranks:
+            # the points come from the game record and the rank from the position in the leaderboard
+            return self.get_game_record(username).user(self.get_ranking().rank(username))
 
-        blob = game_users_bucket.get_blob(path)
-        json_str = blob.download_as_string()
-        json_obj = self.json.loads(json_str)
+        game_users_bucket = self.get_bucket(WIKI_BUCKET)
+        path = GAME_USERS_PREFIX + username
+
+        def read_game_user(blob):
+            json_str = blob.download_as_string()
+            return self.json.loads(json_str)
 
-        return json_obj
+        # not cached, update_points writes back what it reads
+        return self.read_cached(game_users_bucket, path, read_game_user)
     
     def update_points(self, username, new_score):
         """Updates the game stats of the user.
@@ -386,28 +928,153 @@ class Backend:
         Args:
             username: Username of the current user playing.
             new_score: New amount of points gained or lost by playing the game.
+        Returns:
+            The game json object of the user with its new rank.
         """
+        if self.derive_ranks:
+            # only the leaderboard knows the rank, the game record just keeps the points
+            def set_points(record):
+                record.points = new_score
+            record = self.update_game_record(username, set_points)
+            return self.update_leaderboard({"name": username, "points": record.points})
+
         user = self.get_game_user(username)
         user["points"] = new_score
         new_user = self.update_leaderboard(user)
 
-        bucket = self.client.get_bucket("wiki-content-techx")
-        path = "user_game_ranking/game_users/" + username
-        blob = bucket.blob(path)
-        json_data = self.json.dumps(new_user)
-        # upload new data
-        blob.upload_from_string(data=json_data,content_type="application/json")
+        # upload new data together with the ranks of the users it moved
+        self.queue_user_rank(new_user)
+        self.flush_user_ranks()
+        return new_user
     
+    def get_game_record(self, username):
+        '''Gets the game record with the seen pokemon and the points of a user.
+        Users that never saved a game record get one from their old seen and game_users blobs.
+        Args:
+            username: Username of the user.
+        Returns:
+            GameRecord of the user, with the generation of its blob or None if it was never saved.
+        '''
+        bucket = self.get_bucket(WIKI_BUCKET)
+
+        def read_record(blob):
+            if blob is None:
+                return None
+            return GameRecord.decode(blob.download_as_bytes(), blob.generation, MAX_ID, self.json, self.base64func)
+
+        record = self.read_cached(bucket, GAME_RECORDS_PREFIX + username, read_record, GameRecord.copy)
+        if record:
+            return record
+
+        seen = SeenSet(MAX_ID)
+        seen_blob = bucket.get_blob(SEEN_PREFIX + username)
+        if seen_blob:
+            seen = SeenSet.decode(seen_blob.download_as_bytes(), MAX_ID, self.json)
+        points = 0
+        game_blob = bucket.get_blob(GAME_USERS_PREFIX + username)
+        if game_blob:
+            points = self.json.loads(game_blob.download_as_string())["points"]
+        return GameRecord(username, seen, points)
+
+    def update_game_record(self, username, change, record=None):
+        '''Changes the game record of a user and saves it, only if nobody else saved it since it was read.
+        When somebody did, the record is read again and the change is applied to it again.
+        Args:
+            username: Username of the user.
+            change: Function that changes a GameRecord in place, it may be called more than once.
+            record: The record as it was last read, to skip reading it again.
+        Returns:
+            The saved GameRecord.
+        '''
+        def update():
+            nonlocal record
+            if record is None:
+                record = self.get_game_record(username)
+            change(record)
+            # generation 0 only lets the write through if the record does not exist yet
+            return record.encode(self.json, self.base64func), 0 if record.generation is None else record.generation
+
+        def conflict():
+            nonlocal record
+            record = None
+
+        generation = self.write_if_unchanged(GAME_RECORDS_PREFIX + username, update, conflict)
+        record.generation = generation
+        return record
+
+    def get_game(self, username):
+        '''Gets the game record of a user together with its game json object.
+        Args:
+            username: Username of the user.
+        Returns:
+            Tuple with the GameRecord and the game json object with the rank of the user.
+        '''
+        record = self.get_game_record(username)
+        if self.derive_ranks:
+            return record, record.user(self.get_ranking().rank(username))
+        return record, self.get_game_user(username)
+
+    def update_game(self, username, change, record=None):
+        '''Changes and saves the game record of a user, then moves the user to its new place on the leaderboard.
+        Args:
+            username: Username of the user.
+            change: Function that changes a GameRecord in place, it may be called more than once.
+            record: The record as it was last read, to skip reading it again.
+        Returns:
+            Tuple with the saved GameRecord and the game json object with the new rank of the user.
+        '''
+        record = self.update_game_record(username, change, record)
+        if self.derive_ranks:
+            return record, self.update_leaderboard({"name": username, "points": record.points})
+        return record, self.update_points(username, record.points)
+
     def get_leaderboard(self):
         '''Gets the leaderboard list containing all users that have played the game.
         Returns:
             List of JSON objects with each user's game information.
         '''
-        bucket = self.client.get_bucket("wiki-content-techx")
-        blob = bucket.get_blob("user_game_ranking/ranks_list.json")
-        json_str = blob.download_as_string()
-        json_obj = self.json.loads(json_str)
-        return json_obj["ranks_list"]
+        if self.derive_ranks:
+            return self.get_ranking().to_list()
+
+        bucket = self.get_bucket(WIKI_BUCKET)
+
+        def read_leaderboard(blob):
+            json_str = blob.download_as_string()
+            return self.json.loads(json_str)["ranks_list"]
+
+        # not cached, update_leaderboard writes back what it reads
+        return self.read_cached(bucket, RANKS_LIST_PATH, read_leaderboard)
+
+    def get_top_users(self, count):
+        '''Gets the best ranked users of the leaderboard.
+        Args:
+            count: Number of users to return.
+        Returns:
+            List of JSON objects with the game information of the best ranked users.
+        '''
+        if self.derive_ranks:
+            return self.get_ranking().top(count)
+        return self.get_leaderboard()[:count]
+
+    def get_ranking(self):
+        '''Gets the in-memory ranked view of the leaderboard.
+        Only the metadata of ranks_list.json is read when the view is up to date.
+        Returns:
+            RankedLeaderboard with every user that has played the game.
+        '''
+        bucket = self.get_bucket(WIKI_BUCKET)
+        blob = bucket.get_blob(RANKS_LIST_PATH)
+        with self.ranking_lock:
+            if blob is None:
+                # nobody has played yet, generation 0 lets the first update create the leaderboard
+                self.ranking = RankedLeaderboard()
+                self.ranking_generation = 0
+            elif self.ranking is None or self.ranking_generation != blob.generation:
+                json_str = blob.download_as_string()
+                json_obj = self.json.loads(json_str)
+                self.ranking = RankedLeaderboard(json_obj["ranks_list"])
+                self.ranking_generation = blob.generation
+            return self.ranking
 
     def update_leaderboard(self, updated_user):
         '''Updates the leaderboard by sorting the users by points and ranks.
@@ -416,6 +1083,9 @@ class Backend:
         Returns:
             Updated user with new rank assigned.
         '''
+        if self.derive_ranks:
+            return self.update_ranking(updated_user)
+
         leaderboard = self.get_leaderboard()
 
         # If user is not on the leaderboard
@@ -436,122 +1106,139 @@ class Backend:
             leaderboard = new_info[0]
             updated_user = new_info[1]
 
-        bucket = self.client.get_bucket("wiki-content-techx")
-        blob = bucket.blob("user_game_ranking/ranks_list.json")
+        bucket = self.get_bucket(WIKI_BUCKET)
+        blob = bucket.blob(RANKS_LIST_PATH)
         json_obj = {"ranks_list": leaderboard}
         new_data = self.json.dumps(json_obj)
         
         blob.upload_from_string(data=new_data, content_type="application/json")
+        self.forget_cached(RANKS_LIST_PATH)
         
         # Updated user
         return updated_user
 
+    def update_ranking(self, updated_user):
+        '''Updates the in-memory ranked view with the new points of a user and saves the leaderboard.
+        This is the only write a score update needs, however many places the user moves. The leaderboard
+        is only written if nobody else saved it since it was read, otherwise it is read again and the update retried.
+        Args:
+            updated_user: Current user with new points gained or lost from playing the game.
+        Returns:
+            Updated user with its rank derived from the leaderboard.
+        '''
+        def update():
+            ranking = self.get_ranking()
+            ranking.update(updated_user["name"], updated_user["points"])
+            return self.json.dumps({"ranks_list": ranking.to_list()}), self.ranking_generation
+
+        with self.ranking_lock:
+            try:
+                generation = self.write_if_unchanged(RANKS_LIST_PATH, update)
+            except Exception:
+                # the saved leaderboard did not change or somebody else saved it first, read it again next time
+                self.ranking = None
+                raise
+            self.ranking_generation = generation
+
+            return {"name": updated_user["name"], "points": updated_user["points"], "rank": self.ranking.rank(updated_user["name"])}
+
     def sort_leaderboard(self, leaderboard, user, is_new_user):
         '''Sorts the leaderboard by points and ranks.
-        If the user lost points it would move down the user to the right position in the leaderboard if necessary.
-        If the user gained points it would move up the user to the right position in the leaderboard if necessary.
+        The user is moved straight to its new rank in a RankedLeaderboard, ties keep the order
+        the leaderboard has always used. Users that moved one place because of it get their new rank saved.
         Args:
             leaderboard: Leaderboard list with all user game stats.
             user: Current user being moved up or down on rank.
+            is_new_user: Whether the user was just appended to the leaderboard.
         Returns:
             Tuple with the updated leaderboard and current user with updated rank.
         '''
-        user_index = user["rank"] - 1
-        old_user = leaderboard[user_index]
-        user_points = user["points"]
-
-        def sort_up(user_index, user_points):
-            # User to compare
-            other_user_index = user_index - 1
-            other_user = leaderboard[other_user_index]
-            other_user_points = other_user.get("points")
-
-            # User did not rank up
-            if user_points <= other_user_points or user_index == 0:
-                leaderboard[user_index] = user
-                return leaderboard, user
-
-            # User ranked up        
-            while other_user_index >= 0 and user_points > other_user_points:
-
-                # Update ranks and leaderboard with new ranks
-                user["rank"] = user['rank'] - 1
-                other_user["rank"] = other_user["rank"] + 1 
-                
-                # Update other user rank to game_users bucket
-                self.update_user_rank(other_user)
-
-                leaderboard[other_user_index] = other_user
-                leaderboard[user_index] = user
-
-                # Update leaderboard list
-                leaderboard[other_user_index], leaderboard[user_index] = leaderboard[user_index], leaderboard[other_user_index]
-
-                # Updates index
-                user_index -= 1
-                other_user_index -= 1
-
-                if other_user_index >= 0:
-                    # Get new other user
-                    other_user = leaderboard[other_user_index]
-                    other_user_points = other_user["points"]
-            
-            return leaderboard, user
-            
-        def sort_down(user_index, user_points):
-            
-            # Checks if the current user is on the last index of the list, if not it assigns another user to be compared
-            other_user_index = user_index + 1 if user_index < len(leaderboard) - 1 else None
-            other_user = leaderboard[other_user_index] if other_user_index else None
-            other_user_points = other_user.get("points") if other_user_index else None
-
-            # Current user is in the last spot or did not rank down
-            if other_user_index is None or user_points >= other_user_points:
-                leaderboard[user_index] = user
-                return leaderboard, user
-            
-            while (other_user_index <= len(leaderboard) - 1) and user_points <= other_user_points:
-            
-                # Update ranks and leaderboard with new ranks
-                user["rank"] = user['rank'] + 1
-                other_user["rank"] = other_user["rank"] - 1 
-
-                # Update other user rank to game_users bucket
-                self.update_user_rank(other_user)
-                
-                leaderboard[other_user_index] = other_user
-                leaderboard[user_index] = user
-
-                # Update leaderboard list
-                leaderboard[other_user_index], leaderboard[user_index] = leaderboard[user_index], leaderboard[other_user_index]
-
-                # Updates index
-                user_index += 1
-                other_user_index += 1
-
-                if other_user_index <= len(leaderboard) - 1:
-                    # Get new other user
-                    other_user = leaderboard[other_user_index]
-                    other_user_points = other_user["points"]
-            
-            return leaderboard, user
-
         if is_new_user:
-            return sort_up(user_index, user_points)
+            leaderboard = [other for other in leaderboard if other["name"] != user["name"]]
+        ranking = RankedLeaderboard(leaderboard)
+        old_rank, new_rank = ranking.update(user["name"], user["points"])
+        if old_rank is None:
+            old_rank = len(ranking)
 
-        if old_user["points"] < user_points:
-            return sort_up(user_index, user_points)
-        
-        return sort_down(user_index, user_points)
+        # every user between the old and the new rank moved one place
+        first, last = min(old_rank, new_rank), max(old_rank, new_rank)
+        for other_user in ranking.top(last - first + 1, start=first):
+            if other_user["name"] != user["name"]:
+                self.queue_user_rank(other_user)
+
+        user["rank"] = new_rank
+        return ranking.to_list(), user
 
     def update_user_rank(self, updated_user):
         '''Updates game_users/user bucket with new rank.
         Args:
             updated_user: User with new rank assigned
         '''
-        bucket = self.client.get_bucket("wiki-content-techx")
+        bucket = self.get_bucket(WIKI_BUCKET)
         path = "user_game_ranking/game_users/" + updated_user["name"]
         blob = bucket.blob(path)
         json_data = self.json.dumps(updated_user)
 
-        blob.upload_from_string(data=json_data,content_type="application/json")
\ No newline at end of file
+        blob.upload_from_string(data=json_data,content_type="application/json")
+        self.forget_cached(path)
+
+    def queue_user_rank(self, updated_user):
+        '''Queues a game_users/user update, only the last queued state of every user is written.
+        Args:
+            updated_user: User with new rank assigned
+        '''
+        with self.dirty_ranks_lock:
+            self.dirty_ranks[updated_user["name"]] = dict(updated_user)
+
+    def flush_user_ranks(self):
+        '''Writes every queued game_users/user update, up to flush_workers at the same time.
+        Updates that fail stay queued for the next flush unless a newer state was queued meanwhile.
+        Returns:
+            The number of users written.
+        '''
+        with self.dirty_ranks_lock:
+            dirty, self.dirty_ranks = self.dirty_ranks, {}
+        if not dirty:
+            return 0
+
+        with ThreadPoolExecutor(max_workers=min(self.flush_workers, len(dirty))) as executor:
+            futures = {name: executor.submit(contextvars.copy_context().run, self.update_user_rank, user)
+                       for name, user in dirty.items()}
+
+        failed = {name: future.exception() for name, future in futures.items() if future.exception()}
+        if failed:
+            with self.dirty_ranks_lock:
+                for name in failed:
+                    self.dirty_ranks.setdefault(name, dirty[name])
+            logger.error("Could not write the rank of %d users: %s", len(failed), next(iter(failed.values())))
+
+        return len(dirty) - len(failed)
+
+    def migrate_game_records(self):
+        '''Saves a game record for every user that only has the old seen and game_users blobs, used once when
+        switching to derived ranks, which read the points and the seen pokemon from the game record.
+        A record is only created if the user has none yet, so records saved by games in the meantime are kept.
+        Returns:
+            The number of records created.
+        '''
+        bucket = self.get_bucket(WIKI_BUCKET)
+
+        def migrate(blob):
+            username = blob.name[len(GAME_USERS_PREFIX):]
+            record = self.get_game_record(username)
+            if record.generation is not None:
+                return False
+            path = GAME_RECORDS_PREFIX + username
+            try:
+                bucket.blob(path).upload_from_string(data=record.encode(self.json, self.base64func),
+                                                     content_type="application/json",
+                                                     if_generation_match=0)
+            except PreconditionFailed:
+                # the user played in the meantime and saved its own record
+                return False
+            self.forget_cached(path)
+            return True
+
+        blobs = [blob for blob in bucket.list_blobs(prefix=GAME_USERS_PREFIX) if not blob.name.endswith('/')]
+        with ThreadPoolExecutor(max_workers=self.flush_workers) as executor:
+            return sum(executor.map(migrate, blobs))
@@ -1,5 +1,14 @@
-from flaskr.backend import Backend
+from flaskr.backend import Backend, JSON_CACHE_POLICIES, WRITE_RETRIES, image_type
+from flaskr.seen import SeenSet
+from flaskr.game_record import GameRecord
+from flaskr.trigram_index import TrigramIndex
+from flaskr.blob_store import StorageClient, MemoryStore, LatencyStore
+from flaskr.blob_cache import BlobCache
+from flaskr.metrics import Metrics, BACKGROUND_ROUTE
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core.exceptions import PreconditionFailed
 import pytest
+import time
 from unittest.mock import MagicMock, patch
 
 
@@ -35,7 +44,10 @@ def base64func():
 
 @pytest.fixture
 def imagefile():
-    return MagicMock()
+    imagefile = MagicMock()
+    imagefile.read.return_value = b"\x89PNG\r\n\x1a\n\x00\x00\x00\r"
+    imagefile.content_type = "image/png"
+    return imagefile
 
 
 @pytest.fixture
@@ -54,19 +66,32 @@ def test_get_wiki_page(client, bucket, blob, file):
     ]
 
 
-def test_get_all_page_names(client, bucket):
-    blob1 = MagicMock()
-    blob2 = MagicMock()
-    blob3 = MagicMock()
-    blob1.name = "pages/"
-    blob2.name = "pages/charmander"
-    blob3.name = "pages/squirtle"
+def test_get_all_page_names(client, bucket, blob, mockjson):
     client.get_bucket.return_value = bucket
-    bucket.list_blobs.return_value = [blob1, blob2, blob3]
-    backend = Backend(client)
+    bucket.get_blob.return_value = blob
+    mockjson.loads.return_value = {"pages": [{"page": "pages/charmander", "name": "Charmander"},
+                                             {"page": "pages/squirtle", "name": "Squirtle"}]}
+    backend = Backend(client, json=mockjson)
     assert backend.get_all_page_names() == [
         'pages/charmander', 'pages/squirtle'
     ]
+    bucket.list_blobs.assert_not_called()
+
+
+def test_get_all_page_names_paginated(client, bucket, blob, mockjson):
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.return_value = blob
+    mockjson.loads.return_value = {"pages": [{"page": "pages/charmander", "name": "Charmander"},
+                                             {"page": "pages/squirtle", "name": "Squirtle"},
+                                             {"page": "pages/abra", "name": "Abra"}]}
+    backend = Backend(client, json=mockjson)
+    # the pages are listed by name, not in the order they were added to the manifest
+    first = backend.get_all_page_names(limit=2)
+    assert first.pages == ['pages/abra', 'pages/charmander']
+    second = backend.get_all_page_names(limit=2, cursor=first.next_cursor)
+    assert second.pages == ['pages/squirtle']
+    assert second.next_cursor is None
+    assert backend.get_all_page_names(limit=2, cursor=second.prev_cursor).pages == first.pages
 
 
 def test_upload_successful(client, bucket, blob, base64func, imagefile,
@@ -81,6 +106,35 @@ def test_upload_successful(client, bucket, blob, base64func, imagefile,
     assert backend.upload(imagefile, pokemon_data) == True
     assert pokemon_data["image-name"] == "charmander.png"
     assert pokemon_data["image-type"] == "image/png"
+    blob.upload_from_file.assert_called_once_with(imagefile, content_type="image/png")
+
+
+@pytest.mark.parametrize("header, content_type", [
+    (b"<script>alert(1)</script>", "text/html"),
+    (b"<script>alert(1)</script>", "image/png"),
+    (b"\x89PNG\r\n\x1a\n\x00\x00\x00\r", "text/html"),
+    (b"\xff\xd8\xff\xe0\x00\x10JFIF\x00", "image/png"),
+    (b"<svg onload=alert(1)>", "image/svg+xml"),
+])
+def test_upload_rejects_files_that_are_not_images(client, bucket, imagefile, header, content_type):
+    client.get_bucket.return_value = bucket
+    imagefile.read.return_value = header
+    imagefile.content_type = content_type
+    backend = Backend(client)
+    with pytest.raises(ValueError):
+        backend.upload(imagefile, {"name": "Charmander"})
+    bucket.blob.assert_not_called()
+
+
+@pytest.mark.parametrize("header, content_type", [
+    (b"\x89PNG\r\n\x1a\n\x00\x00\x00\r", "image/png"),
+    (b"\xff\xd8\xff\xe0\x00\x10JFIF\x00", "image/jpeg"),
+    (b"GIF89a\x01\x00\x01\x00\x00\x00", "image/gif"),
+    (b"RIFF\x24\x00\x00\x00WEBP", "image/webp"),
+    (b"RIFF\x24\x00\x00\x00WAVE", None),
+])
+def test_image_type(header, content_type):
+    assert image_type(header) == content_type
 
 
 def test_upload_page_already_exists(client, bucket, blob, imagefile):
@@ -93,19 +147,89 @@ def test_upload_page_already_exists(client, bucket, blob, imagefile):
 
 def test_sign_up_account_already_exists(client, bucket, blob):
     client.get_bucket.return_value = bucket
-    bucket.get_blob.return_value = blob
+    bucket.blob.return_value = blob
+    blob.upload_from_string.side_effect = PreconditionFailed("account exists")
     backend = Backend(client)
     assert backend.sign_up('javier', 'pokemon123') == False
+    blob.upload_from_string.assert_called_once()
 
 
 def test_sign_up_successful(client, bucket, blob, file, hashfunc):
     client.get_bucket.return_value = bucket
-    bucket.get_blob.return_value = None
     bucket.blob.return_value = blob
     hashfunc.blake2b.return_value.hexdigest.return_value = "pokemon123"
-    blob.open.return_value.__enter__.return_value = file
     backend = Backend(client, hashfunc)
     assert backend.sign_up('newUser', 'pokemon123') == True
+    blob.upload_from_string.assert_any_call(data="pokemon123", content_type="text/plain", if_generation_match=0)
+    assert blob.upload_from_string.call_count == 3
+
+
+def test_sign_up_writes_are_recorded_under_the_request():
+    metrics = Metrics()
+    backend = Backend(StorageClient(MemoryStore()), metrics=metrics)
+    metrics.start_request("/signup", "POST")
+    assert backend.sign_up("ash", "pikachu") == True
+    timings = metrics.end_request()
+    # the password blob and the two game blobs, the game blobs are written on worker threads
+    assert timings.storage["upload_from_string"][0] == 3
+    assert not [key for key in metrics.storage if key[0] == BACKGROUND_ROUTE]
+
+
+def test_sign_up_cleans_up_after_failed_write(client, bucket, hashfunc):
+    blobs = {}
+
+    def new_blob(name):
+        blobs[name] = MagicMock()
+        blobs[name].generation = len(blobs)
+        if name.startswith("user_game_ranking/seen/"):
+            blobs[name].upload_from_string.side_effect = Exception("storage unavailable")
+        return blobs[name]
+
+    client.get_bucket.return_value = bucket
+    bucket.blob.side_effect = new_blob
+    hashfunc.blake2b.return_value.hexdigest.return_value = "pokemon123"
+    backend = Backend(client, hashfunc)
+    with pytest.raises(Exception):
+        backend.sign_up('newUser', 'pokemon123')
+    blobs["newUser"].delete.assert_called_once_with(if_generation_match=3)
+    blobs["user_game_ranking/game_users/newUser"].delete.assert_called_once_with(if_generation_match=1)
+    blobs["user_game_ranking/seen/newUser"].delete.assert_not_called()
+
+
+def test_sign_up_concurrent_duplicates():
+    backend = Backend(StorageClient(MemoryStore()), derive_ranks=True)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda i: backend.sign_up('ash', f'password{i}'), range(8)))
+    assert results.count(True) == 1
+    assert backend.get_game_record('ash').generation is not None
+
+
+def test_sign_up_overwrites_leftover_game_record():
+    backend = Backend(StorageClient(MemoryStore()), derive_ranks=True)
+    leftover = GameRecord("ash", SeenSet(386, [25]), 120)
+    backend.get_bucket("wiki-content-techx").blob("user_game_ranking/records/ash").upload_from_string(
+        leftover.encode(backend.json, backend.base64func))
+    assert backend.sign_up("ash", "pikachu") == True
+    record = backend.get_game_record("ash")
+    assert record.points == 0 and 25 not in record.seen
+
+
+def test_sign_up_with_store_failure_leaves_nothing():
+    store = MemoryStore()
+    write = store.write
+
+    def failing_write(bucket, name, *args, **kwargs):
+        if name.startswith("user_game_ranking/records/"):
+            raise Exception("storage unavailable")
+        return write(bucket, name, *args, **kwargs)
+
+    store.write = failing_write
+    backend = Backend(StorageClient(store), derive_ranks=True)
+    with pytest.raises(Exception):
+        backend.sign_up('ash', 'pokemon123')
+    assert store.list("users-passwords-techx") == []
+    store.write = write
+    assert backend.sign_up('ash', 'pokemon123') == True
 
 
 def test_sign_in_account_does_not_exist(client, bucket):
@@ -125,6 +249,56 @@ def test_sign_in_successful(client, bucket, blob, file, hashfunc):
     assert backend.sign_in('javier', 'pokemon123') == True
 
 
+def test_get_user_reads_password_blob_once(client, bucket, blob, file):
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.return_value = blob
+    blob.open.return_value.__enter__.return_value = file
+    file.read.return_value = "hashed"
+    backend = Backend(client)
+    assert backend.get_user("javier").password == "hashed"
+    assert backend.get_user("javier").password == "hashed"
+    bucket.get_blob.assert_called_once_with("javier")
+
+
+def test_sign_in_uses_cached_user(client, bucket, blob, file, hashfunc):
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.return_value = blob
+    hashfunc.blake2b.return_value.hexdigest.return_value = "pokemon123"
+    blob.open.return_value.__enter__.return_value = file
+    file.read.return_value = "pokemon123"
+    backend = Backend(client, hashfunc)
+    assert backend.sign_in('javier', 'pokemon123') == True
+    assert backend.get_user('javier').password == "pokemon123"
+    assert backend.sign_in('javier', 'pokemon123') == True
+    bucket.get_blob.assert_called_once()
+
+
+def test_sign_in_rereads_cached_user_on_wrong_password(client, bucket, blob, file, hashfunc):
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.return_value = blob
+    hashfunc.blake2b.return_value.hexdigest.return_value = "new password"
+    blob.open.return_value.__enter__.return_value = file
+    file.read.side_effect = ["old password", "new password"]
+    backend = Backend(client, hashfunc)
+    backend.get_user('javier')
+    # the password was changed on another server
+    assert backend.sign_in('javier', 'pokemon123') == True
+    assert bucket.get_blob.call_count == 2
+
+
+def test_sign_up_invalidates_cached_user(client, bucket, blob, file, hashfunc):
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.return_value = None
+    bucket.blob.return_value = blob
+    backend = Backend(client, hashfunc)
+    assert backend.get_user('newUser') == None
+    assert backend.sign_up('newUser', 'pokemon123') == True
+    bucket.get_blob.return_value = blob
+    blob.open.return_value.__enter__.return_value = file
+    file.read.return_value = "hashed"
+    assert backend.get_user('newUser').password == "hashed"
+
+
 def test_get_image(client, bucket, blob, file, hashfunc, base64func):
     client.get_bucket.return_value = bucket
     bucket.get_blob.return_value = blob
@@ -140,16 +314,47 @@ def test_get_image(client, bucket, blob, file, hashfunc, base64func):
 Unit Tests for New Backend Features
 """
 
-def test_get_pages_by_search(client, bucket, mockjson):
-    blobs = [MagicMock() for i in range(2)]
-    blobs[0].name = "pages/"
-    blobs[1].name = "pages/charmander"
-    json_obj = {"name": "charmander"}
+def search_index_blob(pages):
+    index = TrigramIndex()
+    for page, pokemon_data in pages.items():
+        index.add(page, pokemon_data)
+    blob = MagicMock()
+    blob.generation = 1
+    blob.download_as_string.return_value = index.to_dict()
+    return blob
+
+
+def test_get_pages_by_search(client, bucket, blob, json):
     client.get_bucket.return_value = bucket
-    bucket.list_blobs.return_value = iter(blobs)
-    mockjson.loads.return_value = json_obj
-    backend = backend = Backend(client, json=mockjson)
+    blob.download_as_string.return_value = {"pages": [{"page": "pages/charmander", "name": "charmander"},
+                                                      {"page": "pages/squirtle", "name": "squirtle"}]}
+    search_blob = search_index_blob({"pages/charmander": {"name": "Charmander", "desc": "A fire lizard"},
+                                     "pages/squirtle": {"name": "Squirtle", "desc": "A tiny turtle that squirts water"}})
+    bucket.get_blob.side_effect = lambda path: search_blob if path == "filtering/search_index.json" else blob
+    backend = backend = Backend(client, json=json)
     assert backend.get_pages_using_search("char") == ["pages/charmander"]
+    assert backend.get_pages_using_search("SQUIRT") == ["pages/squirtle"]
+    # descriptions are searched too
+    assert backend.get_pages_using_search("lizard") == ["pages/charmander"]
+    assert backend.get_pages_using_search("a") == ["pages/charmander", "pages/squirtle"]
+    assert backend.get_pages_using_search("dragon") == []
+    bucket.list_blobs.assert_not_called()
+    # both indexes are loaded once
+    assert blob.download_as_string.call_count == 1
+    assert search_blob.download_as_string.call_count == 1
+
+def test_suggest_pages_reads_storage_once(client, bucket, blob, json):
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.return_value = blob
+    blob.download_as_string.return_value = {"pages": [{"page": "pages/charmander", "name": "Charmander"},
+                                                      {"page": "pages/chikorita", "name": "Chikorita"},
+                                                      {"page": "pages/squirtle", "name": "Squirtle"}]}
+    backend = Backend(client, json=json)
+    assert backend.suggest_pages("ch", 10) == [("charmander", "pages/charmander"), ("chikorita", "pages/chikorita")]
+    assert backend.suggest_pages("s", 1) == [("squirtle", "pages/squirtle")]
+    # only the first suggestion loads the index
+    assert bucket.get_blob.call_count == 1
+    assert blob.download_as_string.call_count == 1
 
 def test_get_leaderboard(client, bucket, blob, mockjson):
     client.get_bucket.return_value = bucket
@@ -160,31 +365,10 @@ def test_get_leaderboard(client, bucket, blob, mockjson):
     backend = Backend(client, json=mockjson)
     assert backend.get_leaderboard() == data 
 
-def test_get_pokemon_image(client,bucket,blob,base64func,imagefile):
-    client.get_bucket.return_value = bucket
-    bucket.get_blob.return_value = blob
-    pokemon_image_blob = bucket.get_blob()
-    pokemon_image_blob.open.return_value.__enter__.return_value = imagefile
-    imagefile.read.return_value = "\x00\x01\x02\x03\x04\x05\x06\x07\x08\x09"
-    base64func.b64encode.return_value.decode.return_value = "DlqDRdKbrjQdWsQEjhVV"
-    backend = Backend(client,base64func=base64func)
-    assert backend.get_pokemon_image(3) == "DlqDRdKbrjQdWsQEjhVV"
-
-def test_get_pokeball(client,bucket,blob,base64func,imagefile):
-    client.get_bucket.return_value = bucket
-    bucket.get_blob.return_value = blob
-    pokeball_blob = bucket.get_blob()
-    pokeball_blob.open.return_value.__enter__.return_value = imagefile
-    imagefile.read.return_value = "\x11\x12\x13\x14\x15\x16\x17\x18\x19\x20"
-    base64func.b64encode.return_value.decode.return_value = "xpMlfYxxbIZKvEPCNVZx"
-    backend = Backend(client,base64func=base64func)
-    assert backend.get_pokeball() == "xpMlfYxxbIZKvEPCNVZx"
-
-
 @patch("flaskr.backend.Backend.get_game_user",
        return_value={"User": 1})
 @patch("flaskr.backend.Backend.update_leaderboard",
-       return_value=b"new leaderboard")
+       return_value={"name": "username", "points": 100, "rank": 1})
 def test_update_points(game_user,leaderboard,client,bucket,blob,mockjson):
     client.get_bucket.return_value = bucket
     bucket.blob.return_value = blob
@@ -199,27 +383,24 @@ def test_get_pokemon_data(client,bucket,blob,mockjson):
     client.get_bucket.return_value = bucket
     bucket.get_blob.return_value = blob
     blob.download_as_string.return_value = "downloaded string"
-    mockjson.loads.return_value = {1:"abra"}
-    backend = Backend(client,json=mockjson)
-    assert backend.get_pokemon_data(2) == "abra"
-
-def test_get_seen_pokemon(client,bucket,blob,mockjson):
-    client.get_bucket.return_value = bucket
-    bucket.get_blob.return_value = blob
-    blob.download_as_string.return_value = "A string"
-    mockjson.loads.return_value = {"100":"true","200":"true"}
+    mockjson.loads.return_value = [{"name": {"english": "Bulbasaur"}}, {"name": {"english": "Abra"}}]
     backend = Backend(client,json=mockjson)
-    assert backend.get_seen_pokemon("username") == {"100":"true","200":"true"}
-
+    assert backend.get_pokemon_data(2) == {"name": {"english": "Abra"}}
+    assert backend.get_pokemon_id("abra") == 2
+    blob.download_as_string.assert_called_once()
 
-def test_update_seen_pokemon(client,bucket,blob,mockjson):
+def test_get_pokemon_data_reloads_new_pokedex(client,bucket,blob,mockjson):
     client.get_bucket.return_value = bucket
     bucket.get_blob.return_value = blob
-    mockjson.dumps.return_value = {"new":"pokemon"}
-    backend = Backend(client,json=mockjson)
-    backend.update_seen_pokemon("username",{"new":"list"})
-    blob.upload_from_string.assert_called_once
-
+    blob.generation = 1
+    mockjson.loads.return_value = [{"name": {"english": "Bulbasaur"}}]
+    backend = Backend(client,json=mockjson,pokedex_ttl=0)
+    assert backend.get_pokemon_data(1) == {"name": {"english": "Bulbasaur"}}
+    backend.get_pokemon_data(1)
+    blob.download_as_string.assert_called_once()
+    blob.generation = 2
+    mockjson.loads.return_value = [{"name": {"english": "Ivysaur"}}]
+    assert backend.get_pokemon_data(1) == {"name": {"english": "Ivysaur"}}
 
 def test_get_game_user(client, bucket, blob, mockjson):
     client.get_bucket.return_value = bucket
@@ -302,6 +483,9 @@ class MockJSON:
     def loads(self, content):
         return content  
 
+    def dumps(self, content):
+        return content
+
 
 @pytest.fixture
 def json():
@@ -336,22 +520,39 @@ def page_blobs():
 def test_get_pages_using_filter_type(client, bucket, json, page_blobs):
     client.get_bucket.return_value = bucket
     bucket.list_blobs.return_value = iter(page_blobs)
+    bucket.get_blob.return_value = None
+
+    backend = Backend(client, json=json)
+    assert backend.get_pages_using_filter_and_search(None, "Fire", None, None, None) == ["pages/blaziken", "pages/charmander"]
+
+
+def test_get_pages_using_filter_paginated(client, bucket, json, page_blobs):
+    client.get_bucket.return_value = bucket
+    bucket.list_blobs.side_effect = lambda prefix: iter(page_blobs)
+    bucket.get_blob.return_value = None
 
     backend = Backend(client, json=json)
-    assert backend.get_pages_using_filter_and_search(None, "Fire", None, None, None) == ["pages/charmander", "pages/blaziken"]
+    first = backend.get_pages_using_filter_and_search(None, "Fire", None, None, "HighestToLowest", limit=1)
+    assert first.pages == ["pages/blaziken"]
+    second = backend.get_pages_using_filter_and_search(None, "Fire", None, None, "HighestToLowest", limit=1,
+                                                       cursor=first.next_cursor)
+    assert second.pages == ["pages/charmander"]
+    assert second.next_cursor is None
 
 
 def test_get_pages_using_filter_region(client, bucket, json, page_blobs):
     client.get_bucket.return_value = bucket
     bucket.list_blobs.return_value = iter(page_blobs)
+    bucket.get_blob.return_value = None
 
     backend = Backend(client, json=json)
-    assert backend.get_pages_using_filter_and_search(None, None, "Hoenn", None, None) == ["pages/mudkip", "pages/blaziken"]
+    assert backend.get_pages_using_filter_and_search(None, None, "Hoenn", None, None) == ["pages/blaziken", "pages/mudkip"]
 
 
 def test_get_pages_using_filter_nature(client, bucket, json, page_blobs):
     client.get_bucket.return_value = bucket
     bucket.list_blobs.return_value = iter(page_blobs)
+    bucket.get_blob.return_value = None
 
     backend = Backend(client, json=json)
     assert backend.get_pages_using_filter_and_search(None, None, None, "Bashful", None) == ["pages/blaziken"]
@@ -359,7 +560,9 @@ def test_get_pages_using_filter_nature(client, bucket, json, page_blobs):
 
 def test_get_pages_using_filter_name(client, bucket, json, page_blobs):
     client.get_bucket.return_value = bucket
-    bucket.list_blobs.return_value = iter(page_blobs)
+    # the manifest and the search index are both rebuilt from the pages
+    bucket.list_blobs.side_effect = lambda prefix: iter(page_blobs)
+    bucket.get_blob.return_value = None
 
     backend = Backend(client, json=json)
     assert backend.get_pages_using_filter_and_search("ch", None, None, None, None) == ["pages/charmander", "pages/chikorita"]
@@ -368,6 +571,7 @@ def test_get_pages_using_filter_name(client, bucket, json, page_blobs):
 def test_get_pages_using_sorting_lowest_to_highest(client, bucket, json, page_blobs):
     client.get_bucket.return_value = bucket
     bucket.list_blobs.return_value = iter(page_blobs)
+    bucket.get_blob.return_value = None
 
     backend = Backend(client, json=json)
     assert backend.get_pages_using_filter_and_search(None, None, None, None, "LowestToHighest") == ["pages/chikorita", "pages/mudkip", "pages/charmander", "pages/blaziken"]
@@ -376,6 +580,7 @@ def test_get_pages_using_sorting_lowest_to_highest(client, bucket, json, page_bl
 def test_get_pages_using_sorting_highest_to_lowest(client, bucket, json, page_blobs):
     client.get_bucket.return_value = bucket
     bucket.list_blobs.return_value = iter(page_blobs)
+    bucket.get_blob.return_value = None
 
     backend = Backend(client, json=json)
     assert backend.get_pages_using_filter_and_search(None, None, None, None, "HighestToLowest") == ["pages/blaziken", "pages/charmander", "pages/mudkip", "pages/chikorita"]
@@ -384,6 +589,527 @@ def test_get_pages_using_sorting_highest_to_lowest(client, bucket, json, page_bl
 def test_get_pages_using_filter_type_and_nature(client, bucket, json, page_blobs):
     client.get_bucket.return_value = bucket
     bucket.list_blobs.return_value = iter(page_blobs)
+    bucket.get_blob.return_value = None
+
+    backend = Backend(client, json=json)
+    assert backend.get_pages_using_filter_and_search(None, "Fire", None, "Bashful", None) == ["pages/blaziken"]
+
+"""
+Bucket Registry Testing
+"""
+
+def test_get_bucket_resolves_once(client, bucket, blob, file, base64func):
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.return_value = blob
+    blob.open.return_value.__enter__.return_value = file
+    backend = Backend(client, base64func=base64func)
+    backend.get_wiki_page('charmander')
+    backend.get_image('authors/logo.jpg')
+    backend.get_user('javier')
+    assert client.get_bucket.call_count == 2
+    assert backend.bucket_lookups == 2
+
+
+def test_refresh_buckets(client, bucket):
+    client.get_bucket.return_value = bucket
+    backend = Backend(client)
+    backend.get_bucket('wiki-content-techx')
+    backend.get_bucket('wiki-content-techx')
+    assert backend.refresh_buckets() == 1
+    backend.get_bucket('wiki-content-techx')
+    assert client.get_bucket.call_count == 2
+
+
+def test_get_pages_using_filter_reads_manifest_once(client, bucket, blob, json, page_blobs):
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.return_value = blob
+    blob.generation = 1
+    blob.download_as_string.return_value = {"pages": [
+        {"page": "pages/charmander", "name": "Charmander", "type": "Fire", "region": "Kanto", "nature": "Brave", "level": "15"},
+        {"page": "pages/blaziken", "name": "Blaziken", "type": "Fire", "region": "Hoenn", "nature": "Bashful", "level": "55"}]}
+
+    backend = Backend(client, json=json)
+    backend.get_pages_using_filter_and_search(None, "Fire", None, None, None)
+    assert backend.get_pages_using_filter_and_search(None, None, "Hoenn", None, None) == ["pages/blaziken"]
+    blob.download_as_string.assert_called_once()
+    bucket.list_blobs.assert_not_called()
+
+
+def test_get_pages_using_filter_reloads_changed_manifest(client, bucket, blob, json):
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.return_value = blob
+    blob.generation = 1
+    blob.download_as_string.return_value = {"pages": [
+        {"page": "pages/charmander", "name": "Charmander", "type": "Fire", "region": "Kanto", "nature": "Brave", "level": "15"}]}
+
+    backend = Backend(client, json=json)
+    old_index = backend.get_page_index()
+    assert backend.get_pages_using_filter_and_search(None, "Fire", None, None, None) == ["pages/charmander"]
+    blob.generation = 2
+    blob.download_as_string.return_value = {"pages": []}
+    assert backend.get_pages_using_filter_and_search(None, "Fire", None, None, None) == []
+    # the new manifest was loaded into a new index, a search still holding the old one is not disturbed
+    assert backend.get_page_index() is not old_index
+    assert old_index.search(None, "Fire", None, None, None) == ["pages/charmander"]
+
+
+def test_upload_updates_manifest_and_page_index(client, bucket, blob, json, imagefile):
+    manifest = MagicMock()
+    manifest.generation = 1
+    manifest.download_as_string.return_value = {"pages": [
+        {"page": "pages/charmander", "name": "Charmander", "type": "Fire", "region": "Kanto", "nature": "Brave", "level": "15"}]}
+    search_blob = search_index_blob({"pages/charmander": {"name": "Charmander", "desc": "A fire lizard"}})
+    new_search_blob = MagicMock()
+    new_search_blob.generation = 2
+    client.get_bucket.return_value = bucket
+    blobs = {"filtering/pages_manifest.json": manifest, "filtering/search_index.json": search_blob}
+    bucket.get_blob.side_effect = blobs.get
+    bucket.blob.side_effect = lambda path: new_search_blob if path == "filtering/search_index.json" else blob
+    blob.generation = 2
+    imagefile.filename = "torchic.png"
+    imagefile.content_type = "image/png"
+
+    backend = Backend(client, json=json)
+    old_page_index = backend.get_page_index()
+    old_search_index = backend.get_search_index()
+    backend.upload(imagefile, {"name": "Torchic", "type": "Fire", "region": "Hoenn", "nature": "Brave", "level": "5"})
+    blob.upload_from_string.assert_called_with(data={"pages": [
+        {"page": "pages/charmander", "name": "Charmander", "type": "Fire", "region": "Kanto", "nature": "Brave", "level": "15"},
+        {"page": "pages/torchic", "name": "Torchic", "type": "Fire", "region": "Hoenn", "nature": "Brave", "level": "5", "image-name": "torchic.png"}]},
+        content_type="application/json", if_generation_match=1)
+    manifest.generation = 2
+    # the page was added to the loaded indexes in place
+    assert backend.get_page_index() is old_page_index and "pages/torchic" in old_page_index
+    assert "pages/torchic" in old_search_index.texts
+    assert backend.get_pages_using_filter_and_search(None, "Fire", None, None, "LowestToHighest") == ["pages/torchic", "pages/charmander"]
+    # once to load the index and once to update the manifest
+    assert manifest.download_as_string.call_count == 2
+
+    written = new_search_blob.upload_from_string.call_args
+    assert written.kwargs["if_generation_match"] == 1
+    assert [page for page, text in written.kwargs["data"]["pages"]] == ["pages/charmander", "pages/torchic"]
+    search_blob.generation = 2
+    assert backend.get_pages_using_search("torch") == ["pages/torchic"]
+    assert search_blob.download_as_string.call_count == 2
+
+
+def test_upload_retries_manifest_conflict(client, bucket, blob, json, imagefile):
+    manifest = MagicMock()
+    manifest.generation = 1
+    manifest.download_as_string.return_value = {"pages": []}
+    search_blob = search_index_blob({})
+    client.get_bucket.return_value = bucket
+    blobs = {"filtering/pages_manifest.json": manifest, "filtering/search_index.json": search_blob}
+    bucket.get_blob.side_effect = blobs.get
+    bucket.blob.side_effect = lambda path: search_blob if path == "filtering/search_index.json" else blob
+    blob.upload_from_string.side_effect = [None, PreconditionFailed("conflict"), None]
+    search_blob.upload_from_string.side_effect = [PreconditionFailed("conflict"), None]
+    imagefile.filename = "torchic.png"
+
+    backend = Backend(client, json=json)
+    assert backend.upload(imagefile, {"name": "Torchic", "type": "Fire", "region": "Hoenn", "nature": "Brave", "level": "5"}) == True
+    assert blob.upload_from_string.call_count == 3
+    assert manifest.download_as_string.call_count == 2
+    assert search_blob.upload_from_string.call_count == 2
+    assert search_blob.download_as_string.call_count == 2
+
+
+def test_upload_undoes_page_when_search_index_write_fails(client, bucket, blob, json, imagefile):
+    manifest = MagicMock()
+    manifest.generation = 1
+    manifest.download_as_string.return_value = {"pages": []}
+    search_blob = search_index_blob({})
+    client.get_bucket.return_value = bucket
+    blobs = {"filtering/pages_manifest.json": manifest, "filtering/search_index.json": search_blob}
+    bucket.get_blob.side_effect = blobs.get
+    bucket.blob.side_effect = lambda path: search_blob if path == "filtering/search_index.json" else blob
+    blob.generation = 7
+    search_blob.upload_from_string.side_effect = PreconditionFailed("conflict")
+    imagefile.filename = "torchic.png"
+
+    backend = Backend(client, json=json)
+    with pytest.raises(PreconditionFailed):
+        backend.upload(imagefile, {"name": "Torchic", "type": "Fire", "region": "Hoenn", "nature": "Brave", "level": "5"})
+    # the page was added to the manifest and is taken out again, then the page blob is deleted
+    assert blob.upload_from_string.call_args_list[1].kwargs["data"] == {"pages": [
+        {"page": "pages/torchic", "name": "Torchic", "type": "Fire", "region": "Hoenn", "nature": "Brave", "level": "5", "image-name": "torchic.png"}]}
+    blob.upload_from_string.assert_called_with(data={"pages": []}, content_type="application/json", if_generation_match=1)
+    blob.delete.assert_called_once_with(if_generation_match=7)
+    assert not backend.page_index.loaded and not backend.search_index.texts
+
+
+def test_upload_page_created_meanwhile(client, bucket, blob, json, imagefile):
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.return_value = None
+    bucket.blob.return_value = blob
+    blob.upload_from_string.side_effect = PreconditionFailed("page exists")
+    backend = Backend(client, json=json)
+    assert backend.upload(imagefile, {"name": "Torchic", "type": "Fire", "region": "Hoenn", "nature": "Brave", "level": "5"}) == False
+    blob.delete.assert_not_called()
+
+
+def test_rebuild_manifest_skips_folder_placeholder(client, bucket, blob, json, page_blobs):
+    client.get_bucket.return_value = bucket
+    bucket.list_blobs.return_value = iter(page_blobs)
+    bucket.blob.return_value = blob
 
     backend = Backend(client, json=json)
-    assert backend.get_pages_using_filter_and_search(None, "Fire", None, "Bashful", None) == ["pages/blaziken"]
\ No newline at end of file
+    pages, generation = backend.rebuild_manifest()
+    assert [page["page"] for page in pages] == ["pages/charmander", "pages/chikorita", "pages/mudkip", "pages/blaziken"]
+    assert pages[0] == {"page": "pages/charmander", "name": "Charmander", "type": "Fire", "region": "Kanto",
+                        "nature": "Brave", "level": "15", "image-name": None}
+    blob.upload_from_string.assert_called_once_with(data={"pages": pages}, content_type="application/json", if_generation_match=None)
+
+
+"""
+Concurrent Page Fetching Testing
+"""
+
+def slow_page_blobs(count, latency):
+    blobs = []
+    for i in range(count):
+        blob = MagicMock()
+        blob.name = f"pages/pokemon{i}"
+        file = MagicMock()
+        file.read.return_value = {"name": f"Pokemon{i}", "type": "Fire", "region": "Kanto", "nature": "Brave", "level": str(i)}
+
+        def open(mode, file=file):
+            time.sleep(latency)
+            context = MagicMock()
+            context.__enter__.return_value = file
+            return context
+
+        blob.open.side_effect = open
+        blobs.append(blob)
+    return blobs
+
+
+def scan_time(client, bucket, json, workers, count, latency):
+    client.get_bucket.return_value = bucket
+    bucket.list_blobs.return_value = iter(slow_page_blobs(count, latency))
+    backend = Backend(client, json=json, fetch_workers=workers)
+    start = time.perf_counter()
+    pages = backend.scan_pages()
+    return time.perf_counter() - start, pages
+
+
+def test_scan_pages_keeps_listing_order(client, bucket, json):
+    elapsed, pages = scan_time(client, bucket, json, 4, 12, 0.001)
+    assert [page_name for page_name, data in pages] == [f"pages/pokemon{i}" for i in range(12)]
+
+
+def test_scan_pages_latency_scales_with_workers(client, bucket, json):
+    count, latency = 16, 0.02
+    serial, pages = scan_time(client, bucket, json, 1, count, latency)
+    parallel, pages = scan_time(client, bucket, json, 8, count, latency)
+    assert serial >= count * latency
+    # 16 pages with 8 workers take about two round-trips instead of sixteen
+    assert parallel < serial / 3
+
+
+def test_get_image_blob(client, bucket, blob):
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.return_value = blob
+    backend = Backend(client)
+    assert backend.get_image_blob("master_pokedex/images/025.png") == blob
+    bucket.get_blob.assert_called_once_with("master_pokedex/images/025.png")
+
+
+def test_get_image_blob_outside_image_folders(client, bucket):
+    client.get_bucket.return_value = bucket
+    backend = Backend(client)
+    assert backend.get_image_blob("user_game_ranking/ranks_list.json") == None
+    bucket.get_blob.assert_not_called()
+
+
+def test_get_image_uses_image_cache(client, bucket, blob):
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.return_value = blob
+    blob.generation = 1
+    blob.download_as_bytes.return_value = b"logo"
+    backend = Backend(client)
+    assert backend.get_image_bytes("authors/logo.jpg") == b"logo"
+    assert backend.get_image("authors/logo.jpg") == "bG9nbw=="
+    blob.download_as_bytes.assert_called_once()
+    blob.generation = 2
+    backend.get_image_bytes("authors/logo.jpg")
+    assert blob.download_as_bytes.call_count == 2
+    assert backend.image_cache.stats()["hits"] == 1
+
+
+"""
+Rank Write-Behind Testing
+"""
+
+def test_queue_user_rank_coalesces_updates(client, bucket, blob):
+    client.get_bucket.return_value = bucket
+    bucket.blob.return_value = blob
+    backend = Backend(client)
+    backend.queue_user_rank({"name": "name", "points": 100, "rank": 3})
+    backend.queue_user_rank({"name": "name", "points": 100, "rank": 2})
+    backend.queue_user_rank({"name": "name2", "points": 50, "rank": 4})
+    blob.upload_from_string.assert_not_called()
+    assert backend.flush_user_ranks() == 2
+    assert blob.upload_from_string.call_count == 2
+    blob.upload_from_string.assert_any_call(data='{"name": "name", "points": 100, "rank": 2}', content_type="application/json")
+    assert backend.flush_user_ranks() == 0
+
+
+def test_flush_user_ranks_keeps_failed_updates(client, bucket, blob):
+    client.get_bucket.return_value = bucket
+    bucket.blob.return_value = blob
+    blob.upload_from_string.side_effect = [Exception("storage unavailable"), None]
+    backend = Backend(client)
+    backend.queue_user_rank({"name": "name", "points": 100, "rank": 2})
+    assert backend.flush_user_ranks() == 0
+    assert backend.flush_user_ranks() == 1
+
+
+def test_sort_leaderboard_writes_each_moved_user_once(client, bucket, blob):
+    client.get_bucket.return_value = bucket
+    bucket.blob.return_value = blob
+    backend = Backend(client)
+    leaderboard = [{"name": f"user{i}", "points": 500 - i, "rank": i + 1} for i in range(500)]
+    user = {"name": "user499", "points": 1000, "rank": 500}
+    backend.sort_leaderboard(leaderboard, user, False)
+    backend.queue_user_rank(user)
+    assert backend.flush_user_ranks() == 500
+    assert blob.upload_from_string.call_count == 500
+
+
+"""
+Derived Ranks Testing
+"""
+
+@pytest.fixture
+def ranks_blob():
+    blob = MagicMock()
+    blob.generation = 1
+    blob.download_as_string.return_value = {"ranks_list": [
+        {"name": "ash", "points": 300, "rank": 1},
+        {"name": "misty", "points": 200, "rank": 2},
+        {"name": "brock", "points": 100, "rank": 3}]}
+    return blob
+
+
+@pytest.fixture
+def record_blob():
+    blob = MagicMock()
+    blob.generation = 3
+    blob.download_as_bytes.return_value = GameRecord("brock", SeenSet(386, [1, 4]), 100).encode(MockJSON())
+    return blob
+
+
+def test_get_game_user_derives_rank(client, bucket, json, ranks_blob, record_blob):
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.side_effect = lambda path: ranks_blob if path == "user_game_ranking/ranks_list.json" else record_blob
+    backend = Backend(client, json=json, derive_ranks=True)
+    assert backend.get_game_user("brock") == {"name": "brock", "points": 100, "rank": 3}
+    backend.get_game_user("brock")
+    ranks_blob.download_as_string.assert_called_once()
+
+
+def test_get_game_record(client, bucket, json, record_blob):
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.return_value = record_blob
+    backend = Backend(client, json=json)
+    record = backend.get_game_record("brock")
+    bucket.get_blob.assert_called_once_with("user_game_ranking/records/brock")
+    assert (record.name, record.seen, record.points, record.generation) == ("brock", SeenSet(386, [1, 4]), 100, 3)
+
+
+def test_get_game_record_from_old_blobs(client, bucket, json):
+    seen_blob = MagicMock()
+    seen_blob.download_as_bytes.return_value = SeenSet(386, [7]).encode()
+    game_blob = MagicMock()
+    game_blob.download_as_string.return_value = {"name": "brock", "points": 100, "rank": 3}
+    blobs = {"user_game_ranking/seen/brock": seen_blob, "user_game_ranking/game_users/brock": game_blob}
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.side_effect = blobs.get
+    backend = Backend(client, json=json)
+    record = backend.get_game_record("brock")
+    assert (record.seen, record.points, record.generation) == (SeenSet(386, [7]), 100, None)
+
+
+def test_update_game_record_creates_record(client, bucket, blob, json):
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.return_value = None
+    bucket.blob.return_value = blob
+    blob.generation = 1
+    backend = Backend(client, json=json)
+
+    def change(record):
+        record.points = 100
+
+    record = backend.update_game_record("brock", change)
+    assert (record.points, record.generation) == (100, 1)
+    blob.upload_from_string.assert_called_once_with(data=record.encode(json), content_type="application/json", if_generation_match=0)
+
+
+def test_update_game_record_retries_conflict(client, bucket, blob, json, record_blob):
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.return_value = record_blob
+    bucket.blob.return_value = blob
+    blob.upload_from_string.side_effect = [PreconditionFailed("record changed"), None]
+    blob.generation = 4
+    backend = Backend(client, json=json)
+    stale = GameRecord("brock", SeenSet(386), 0, 2)
+    changes = []
+
+    def change(record):
+        changes.append(record.generation)
+        record.seen.add(25)
+
+    record = backend.update_game_record("brock", change, stale)
+    # the change is applied again to the record that was saved by somebody else
+    assert changes == [2, 3]
+    assert (record.seen, record.points, record.generation) == (SeenSet(386, [1, 4, 25]), 100, 4)
+    assert blob.upload_from_string.call_args.kwargs["if_generation_match"] == 3
+
+
+def test_update_game_record_gives_up(client, bucket, blob, json, record_blob):
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.return_value = record_blob
+    bucket.blob.return_value = blob
+    blob.upload_from_string.side_effect = PreconditionFailed("record changed")
+    backend = Backend(client, json=json)
+    with pytest.raises(PreconditionFailed):
+        backend.update_game_record("brock", lambda record: None)
+    assert blob.upload_from_string.call_count == 5
+
+
+def test_update_game_with_derived_ranks_writes_twice(client, bucket, blob, json, ranks_blob, record_blob):
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.side_effect = lambda path: ranks_blob if path == "user_game_ranking/ranks_list.json" else record_blob
+    bucket.blob.return_value = blob
+    blob.generation = 2
+    backend = Backend(client, json=json, derive_ranks=True)
+
+    def change(record):
+        record.points = 400
+        record.seen.add(25)
+
+    record, user = backend.update_game("brock", change)
+    assert user == {"name": "brock", "points": 400, "rank": 1}
+    # one write of the game record and one write of the leaderboard, both conditional
+    assert blob.upload_from_string.call_count == 2
+    blob.upload_from_string.assert_any_call(data=record.encode(json), content_type="application/json", if_generation_match=3)
+    blob.upload_from_string.assert_any_call(data={"ranks_list": [
+        {"name": "brock", "points": 400, "rank": 1},
+        {"name": "ash", "points": 300, "rank": 2},
+        {"name": "misty", "points": 200, "rank": 3}]}, content_type="application/json", if_generation_match=1)
+    assert backend.ranking_generation == 2
+
+
+def test_update_ranking_retries_conflict(client, bucket, blob, json, ranks_blob):
+    newer_ranks_blob = MagicMock()
+    newer_ranks_blob.generation = 5
+    newer_ranks_blob.download_as_string.return_value = {"ranks_list": [
+        {"name": "gary", "points": 500, "rank": 1},
+        {"name": "ash", "points": 300, "rank": 2}]}
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.side_effect = [ranks_blob, newer_ranks_blob]
+    bucket.blob.return_value = blob
+    blob.upload_from_string.side_effect = [PreconditionFailed("leaderboard changed"), None]
+    blob.generation = 6
+    backend = Backend(client, json=json, derive_ranks=True)
+    assert backend.update_ranking({"name": "brock", "points": 400}) == {"name": "brock", "points": 400, "rank": 2}
+    # the user that was saved by somebody else is kept
+    blob.upload_from_string.assert_called_with(data={"ranks_list": [
+        {"name": "gary", "points": 500, "rank": 1},
+        {"name": "brock", "points": 400, "rank": 2},
+        {"name": "ash", "points": 300, "rank": 3}]}, content_type="application/json", if_generation_match=5)
+    assert backend.ranking_generation == 6
+
+
+def test_get_top_users_with_derived_ranks(client, bucket, json, ranks_blob):
+    client.get_bucket.return_value = bucket
+    bucket.get_blob.return_value = ranks_blob
+    backend = Backend(client, json=json, derive_ranks=True)
+    assert backend.get_top_users(2) == [{"name": "ash", "points": 300, "rank": 1}, {"name": "misty", "points": 200, "rank": 2}]
+
+
+def test_migrate_game_records():
+    backend = Backend(StorageClient(MemoryStore()), derive_ranks=True)
+    bucket = backend.get_bucket("wiki-content-techx")
+    bucket.blob("user_game_ranking/game_users/").upload_from_string("")
+    for name, points in (("ash", 300), ("misty", 200)):
+        bucket.blob("user_game_ranking/game_users/" + name).upload_from_string(
+            backend.json.dumps({"name": name, "points": points, "rank": None}))
+    bucket.blob("user_game_ranking/seen/ash").upload_from_string(SeenSet(386, [25]).encode())
+    backend.update_game_record("misty", lambda record: setattr(record, "points", 250))
+
+    assert backend.migrate_game_records() == 1
+    record = backend.get_game_record("ash")
+    assert record.generation is not None and record.points == 300 and 25 in record.seen
+    # misty already saved a record while playing, it is kept
+    assert backend.get_game_record("misty").points == 250
+    assert backend.migrate_game_records() == 0
+
+
+"""
+Json Blob Cache Testing
+"""
+
+def cached_backend(store, **kwargs):
+    return Backend(StorageClient(store), blob_cache=BlobCache(JSON_CACHE_POLICIES), **kwargs)
+
+
+def test_game_user_is_not_cached():
+    store = LatencyStore(MemoryStore(), latency=0)
+    backend = cached_backend(store)
+    backend.sign_up("ash", "pikachu")
+    backend.get_game_user("ash")
+    assert backend.get_game_user("ash") == {"name": "ash", "points": 0, "rank": None}
+    assert store.calls["read"] == 2
+
+
+def test_leaderboard_write_keeps_other_servers_users():
+    memory = MemoryStore()
+    backend = cached_backend(memory)
+    other_server = cached_backend(memory)
+    backend.get_bucket("wiki-content-techx").blob("user_game_ranking/ranks_list.json").upload_from_string('{"ranks_list": []}')
+    backend.sign_up("ash", "pikachu")
+    other_server.sign_up("misty", "staryu")
+    backend.update_points("ash", 10)
+    backend.get_leaderboard()
+    other_server.update_points("misty", 20)
+    # the leaderboard read before misty played is not written back
+    backend.update_points("ash", 30)
+    assert [(user["name"], user["points"]) for user in backend.get_leaderboard()] == [("ash", 30), ("misty", 20)]
+
+
+def test_stale_cached_game_record_is_read_again_on_conflict():
+    memory = MemoryStore()
+    backend = cached_backend(memory, derive_ranks=True)
+    other_server = Backend(StorageClient(memory), derive_ranks=True)
+    backend.sign_up("ash", "pikachu")
+    backend.get_game_record("ash")
+
+    def add_points(record):
+        record.points += 10
+    other_server.update_game_record("ash", add_points)
+    # the cached record is outdated, the write fails once and the record is read again
+    assert backend.update_game_record("ash", add_points).points == 20
+    assert backend.get_game_record("ash").points == 20
+
+
+def test_write_if_unchanged_gives_up_after_retries(client, bucket, blob):
+    client.get_bucket.return_value = bucket
+    bucket.blob.return_value = blob
+    blob.upload_from_string.side_effect = PreconditionFailed("conflict")
+    update = MagicMock(return_value=('{"points": 100}', 3))
+    conflict = MagicMock()
+
+    backend = Backend(client)
+    with pytest.raises(PreconditionFailed):
+        backend.write_if_unchanged("user_game_ranking/records/ash", update, conflict)
+    assert update.call_count == conflict.call_count == WRITE_RETRIES
+    blob.upload_from_string.assert_called_with(data='{"points": 100}', content_type="application/json", if_generation_match=3)
+
+
+def test_write_if_unchanged_nothing_to_write(client, bucket):
+    client.get_bucket.return_value = bucket
+    backend = Backend(client)
+    assert backend.write_if_unchanged("filtering/pages_manifest.json", lambda: None) == None
+    bucket.blob.assert_not_called()
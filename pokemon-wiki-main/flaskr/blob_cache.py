@@ -0,0 +1,204 @@
+"""This module contains the read-through cache of the json blobs read by the backend.
+
+The cache keeps the parsed object of a blob together with the generation of the blob it was
+parsed from. While an entry is younger than the ttl of its prefix it is used without asking the
+storage. After that the entry is revalidated with a metadata-only read of the blob, and the blob
+is only downloaded and parsed again if its generation changed.
+
+Within the stale-while-revalidate window after the ttl the old object is still returned right
+away, and the revalidation runs in the background. Entries older than that are revalidated
+before they are returned. Every prefix has its own ttl, stale-while-revalidate window, maximum
+number of entries (the least recently used are evicted first) and hit/miss counters. Blobs that
+do not match any prefix are not cached.
+
+Typical Usage:
+cache = BlobCache({'pages/': CachePolicy(ttl=60, stale_while_revalidate=300, max_entries=10000)})
+page = cache.get(bucket, 'pages/charmander', lambda blob: json.loads(blob.download_as_string()))
+cache.invalidate('pages/charmander')
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+STAT_NAMES = ("hits", "stale_hits", "revalidations", "misses", "evictions")
+
+
+class CachePolicy:
+    '''How long the blobs of a prefix are cached.'''
+
+    def __init__(self, ttl, stale_while_revalidate=0, max_entries=1000):
+        '''CachePolicy constructor.
+
+           Args:
+            ttl: Seconds an entry is used before it is revalidated.
+            stale_while_revalidate: Seconds after the ttl an entry is still used while it is revalidated in the background.
+            max_entries: Maximum number of blobs of the prefix kept.
+        '''
+        self.ttl = ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self.max_entries = max_entries
+
+
+class CacheEntry:
+    __slots__ = ("value", "generation", "checked")
+
+    def __init__(self, value, generation, checked):
+        self.value = value
+        self.generation = generation
+        self.checked = checked  # when the generation was last compared with the storage
+
+
+class CacheSection:
+    '''The entries and counters of one prefix.'''
+
+    def __init__(self, prefix, policy):
+        self.prefix = prefix
+        self.policy = policy
+        self.entries = OrderedDict()  # blob name -> CacheEntry, least recently used first
+        self.stats = dict.fromkeys(STAT_NAMES, 0)
+
+
+class BlobCache:
+
+    def __init__(self, policies, clock=time.monotonic, executor=None):
+        """
+        Args:
+            policies: Dictionary of blob name prefix -> CachePolicy, the longest matching prefix applies.
+            clock: Dependency injection for mocking the clock.
+            executor: Executor the stale entries are revalidated on, a small thread pool by default.
+        """
+        # longest prefixes first so the most specific policy is found first
+        self.sections = [CacheSection(prefix, policy)
+                         for prefix, policy in sorted(policies.items(), key=lambda item: len(item[0]), reverse=True)]
+        self.clock = clock
+        self.executor = executor
+        self.revalidating = set()  # blob names being revalidated in the background
+        self.lock = threading.Lock()
+
+    def section(self, name):
+        for section in self.sections:
+            if name.startswith(section.prefix):
+                return section
+        return None
+
+    def get(self, bucket, name, load):
+        """ Returns the parsed object of a blob, reading it from the storage only when needed.
+        Args:
+            bucket: The bucket of the blob.
+            name: The name of the blob.
+            load: Function that downloads and parses a blob returned by get_blob, it is also
+                called with None when the blob does not exist. That result is not cached.
+        Returns:
+            The object returned by load, which callers must not change, it is shared with later reads.
+        """
+        section = self.section(name)
+        if section is None:
+            return load(bucket.get_blob(name))
+
+        now = self.clock()
+        stale = revalidate = False
+        with self.lock:
+            entry = section.entries.get(name)
+            if entry is not None:
+                section.entries.move_to_end(name)
+                age = now - entry.checked
+                if age < section.policy.ttl:
+                    section.stats["hits"] += 1
+                    return entry.value
+                stale = age < section.policy.ttl + section.policy.stale_while_revalidate
+                if stale:
+                    section.stats["stale_hits"] += 1
+                    # one background revalidation per blob at a time
+                    revalidate = name not in self.revalidating
+                    self.revalidating.add(name)
+
+        if stale:
+            if revalidate:
+                self.submit(self.revalidate_in_background, bucket, name, load)
+            return entry.value
+        return self.refresh(section, bucket, name, load, entry)
+
+    def refresh(self, section, bucket, name, load, entry):
+        """ Compares the generation of an entry with the blob, downloading the blob if it changed."""
+        blob = bucket.get_blob(name)
+        now = self.clock()
+        if blob is None:
+            with self.lock:
+                section.stats["misses"] += 1
+                section.entries.pop(name, None)
+            return load(None)
+
+        if entry is not None and entry.generation == blob.generation:
+            with self.lock:
+                section.stats["revalidations"] += 1
+                entry.checked = now
+            return entry.value
+
+        value = load(blob)
+        with self.lock:
+            section.stats["misses"] += 1
+            current = section.entries.get(name)
+            # a concurrent read may already have stored a newer version of the blob
+            if current is None or current.generation is None or current.generation <= blob.generation:
+                section.entries.pop(name, None)
+                while section.entries and len(section.entries) >= section.policy.max_entries:
+                    section.entries.popitem(last=False)
+                    section.stats["evictions"] += 1
+                section.entries[name] = CacheEntry(value, blob.generation, now)
+        return value
+
+    def revalidate_in_background(self, bucket, name, load):
+        try:
+            with self.lock:
+                section = self.section(name)
+                entry = section.entries.get(name)
+            self.refresh(section, bucket, name, load, entry)
+        except Exception:
+            # the stale entry is kept, reads revalidate it themselves once it is too old
+            logger.exception("Could not revalidate the cached blob %s", name)
+        finally:
+            with self.lock:
+                self.revalidating.discard(name)
+
+    def submit(self, function, *args):
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="blob-cache")
+        self.executor.submit(function, *args)
+
+    def invalidate(self, name):
+        """ Forgets a blob, used after writing it so the next read gets the new version."""
+        section = self.section(name)
+        if section is None:
+            return
+        with self.lock:
+            section.entries.pop(name, None)
+
+    def clear(self):
+        """ Forgets every blob, the counters are kept."""
+        with self.lock:
+            for section in self.sections:
+                section.entries.clear()
+
+    def stats(self):
+        """ Returns the counters of every prefix.
+        Returns:
+            Dictionary of prefix -> dictionary with the hits, stale hits, revalidations (the blob had not
+            changed), misses (the blob was downloaded), evictions, hit rate and cached entries.
+        """
+        with self.lock:
+            stats = {}
+            for section in self.sections:
+                counters = dict(section.stats)
+                lookups = sum(counters[name] for name in ("hits", "stale_hits", "revalidations", "misses"))
+                served = counters["hits"] + counters["stale_hits"] + counters["revalidations"]
+                counters["hit_rate"] = served / lookups if lookups else 0.0
+                counters["entries"] = len(section.entries)
+                stats[section.prefix] = counters
+            return stats
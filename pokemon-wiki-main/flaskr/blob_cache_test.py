@@ -0,0 +1,189 @@
+from flaskr.blob_cache import BlobCache, CachePolicy
+from flaskr.blob_store import StorageClient, MemoryStore, LatencyStore
+import json
+import pytest
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class QueuedExecutor:
+    '''Keeps the submitted revalidations so the tests decide when they run.'''
+
+    def __init__(self):
+        self.queue = []
+
+    def submit(self, function, *args):
+        self.queue.append((function, args))
+
+    def run(self):
+        queue, self.queue = self.queue, []
+        for function, args in queue:
+            function(*args)
+
+
+@pytest.fixture
+def store():
+    return LatencyStore(MemoryStore(), latency=0)
+
+
+@pytest.fixture
+def bucket(store):
+    bucket = StorageClient(store).get_bucket("wiki")
+    bucket.blob("pages/abra").upload_from_string(json.dumps({"name": "Abra"}))
+    return bucket
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def executor():
+    return QueuedExecutor()
+
+
+@pytest.fixture
+def cache(clock, executor):
+    return BlobCache({"pages/": CachePolicy(ttl=10, stale_while_revalidate=20, max_entries=2)}, clock, executor)
+
+
+def load(blob):
+    return None if blob is None else json.loads(blob.download_as_bytes())
+
+
+def test_hit_within_ttl(cache, bucket, store, clock):
+    assert cache.get(bucket, "pages/abra", load) == {"name": "Abra"}
+    calls = store.operations
+    clock.now = 9
+    assert cache.get(bucket, "pages/abra", load) == {"name": "Abra"}
+    assert store.operations == calls
+    assert cache.stats()["pages/"]["hits"] == 1
+    assert cache.stats()["pages/"]["misses"] == 1
+
+
+def test_revalidates_with_metadata_only(cache, bucket, store, clock):
+    first = cache.get(bucket, "pages/abra", load)
+    clock.now = 100
+    assert cache.get(bucket, "pages/abra", load) is first
+    assert store.calls["read"] == 1
+    assert cache.stats()["pages/"]["revalidations"] == 1
+    # the revalidation starts a new ttl
+    clock.now = 105
+    cache.get(bucket, "pages/abra", load)
+    assert cache.stats()["pages/"]["hits"] == 1
+
+
+def test_downloads_changed_blob(cache, bucket, store, clock):
+    cache.get(bucket, "pages/abra", load)
+    bucket.blob("pages/abra").upload_from_string(json.dumps({"name": "Kadabra"}))
+    clock.now = 100
+    assert cache.get(bucket, "pages/abra", load) == {"name": "Kadabra"}
+    assert store.calls["read"] == 2
+
+
+def test_stale_while_revalidate(cache, bucket, executor, clock):
+    cache.get(bucket, "pages/abra", load)
+    bucket.blob("pages/abra").upload_from_string(json.dumps({"name": "Kadabra"}))
+    clock.now = 15
+    assert cache.get(bucket, "pages/abra", load) == {"name": "Abra"}
+    assert cache.get(bucket, "pages/abra", load) == {"name": "Abra"}
+    # a single revalidation for both stale reads
+    assert len(executor.queue) == 1
+    executor.run()
+    assert cache.get(bucket, "pages/abra", load) == {"name": "Kadabra"}
+    stats = cache.stats()["pages/"]
+    assert (stats["stale_hits"], stats["hits"], stats["misses"]) == (2, 1, 2)
+
+
+def test_too_stale_is_revalidated_first(cache, bucket, executor, clock):
+    cache.get(bucket, "pages/abra", load)
+    bucket.blob("pages/abra").upload_from_string(json.dumps({"name": "Kadabra"}))
+    clock.now = 30
+    assert cache.get(bucket, "pages/abra", load) == {"name": "Kadabra"}
+    assert executor.queue == []
+
+
+def test_failed_background_revalidation_keeps_entry(cache, bucket, executor, clock):
+    cache.get(bucket, "pages/abra", load)
+    bucket.blob("pages/abra").upload_from_string("not json")
+    clock.now = 15
+    assert cache.get(bucket, "pages/abra", load) == {"name": "Abra"}
+    executor.run()
+    assert cache.revalidating == set()
+    assert cache.get(bucket, "pages/abra", load) == {"name": "Abra"}
+    # the next stale read tries again
+    assert len(executor.queue) == 1
+
+
+def test_missing_blob_is_not_cached(cache, bucket, store):
+    assert cache.get(bucket, "pages/mew", load) is None
+    assert cache.get(bucket, "pages/mew", load) is None
+    assert store.calls["stat"] == 2
+    assert cache.stats()["pages/"]["entries"] == 0
+
+
+def test_deleted_blob_is_dropped(cache, bucket, clock):
+    cache.get(bucket, "pages/abra", load)
+    bucket.blob("pages/abra").delete()
+    clock.now = 100
+    assert cache.get(bucket, "pages/abra", load) is None
+    assert cache.stats()["pages/"]["entries"] == 0
+
+
+def test_evicts_least_recently_used(cache, bucket, store):
+    for name in ("kadabra", "alakazam"):
+        bucket.blob(f"pages/{name}").upload_from_string(json.dumps({"name": name}))
+    cache.get(bucket, "pages/abra", load)
+    cache.get(bucket, "pages/kadabra", load)
+    cache.get(bucket, "pages/abra", load)
+    cache.get(bucket, "pages/alakazam", load)
+    stats = cache.stats()["pages/"]
+    assert (stats["entries"], stats["evictions"]) == (2, 1)
+    reads = store.calls["read"]
+    cache.get(bucket, "pages/abra", load)
+    assert store.calls["read"] == reads
+    cache.get(bucket, "pages/kadabra", load)
+    assert store.calls["read"] == reads + 1
+
+
+def test_invalidate(cache, bucket, store):
+    cache.get(bucket, "pages/abra", load)
+    cache.invalidate("pages/abra")
+    cache.invalidate("other/blob")
+    cache.get(bucket, "pages/abra", load)
+    assert store.calls["read"] == 2
+
+
+def test_policies_by_longest_prefix(bucket, store, clock):
+    cache = BlobCache({"pages/": CachePolicy(ttl=10), "pages/abra": CachePolicy(ttl=0)}, clock)
+    bucket.blob("pages/mew").upload_from_string(json.dumps({"name": "Mew"}))
+    for i in range(2):
+        cache.get(bucket, "pages/abra", load)
+        cache.get(bucket, "pages/mew", load)
+    stats = cache.stats()
+    assert stats["pages/abra"]["revalidations"] == 1
+    assert stats["pages/"]["hits"] == 1
+
+
+def test_unmatched_blobs_are_not_cached(cache, bucket, store):
+    bucket.blob("users/ash").upload_from_string(json.dumps({"name": "Ash"}))
+    cache.get(bucket, "users/ash", load)
+    cache.get(bucket, "users/ash", load)
+    assert store.calls["read"] == 2
+    assert list(cache.stats()) == ["pages/"]
+
+
+def test_stats_hit_rate(cache, bucket, clock):
+    assert cache.stats()["pages/"]["hit_rate"] == 0.0
+    cache.get(bucket, "pages/abra", load)
+    cache.get(bucket, "pages/abra", load)
+    clock.now = 100
+    cache.get(bucket, "pages/abra", load)
+    assert cache.stats()["pages/"]["hit_rate"] == pytest.approx(2 / 3)
@@ -0,0 +1,489 @@
+"""This module contains storage clients that stand in for the google cloud storage client.
+
+The StorageClient, its buckets and its blobs cover the part of the cloud storage api the backend
+uses: get_blob, blob and list_blobs (with a prefix and paging) on a bucket, and open,
+upload_from_string, upload_from_file, download_as_bytes (with byte ranges), delete and the
+generation, size, md5_hash and content_type of a blob. Writes and deletes take the same
+if_generation_match preconditions and raise the same PreconditionFailed and NotFound errors.
+
+Where the blobs are kept is up to the store the client is given:
+    MemoryStore: Blobs kept in a dictionary, for tests and throwaway runs.
+    LocalStore: Blobs kept as files in a local directory, read through mmap.
+    LatencyStore: Wraps another store, waits before every operation to simulate the network and counts the operations.
+
+Typical Usage:
+client = StorageClient(LatencyStore(LocalStore('/tmp/wiki-data'), latency=0.03))
+backend = Backend(client=client)
+"""
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from collections import Counter
+import base64
+import hashlib
+import io
+import itertools
+import json
+import mimetypes
+import mmap
+import os
+import random
+import threading
+import time
+
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+TEXT_CONTENT_TYPE = "text/plain"
+META_DIR = ".meta"  # folder of every local bucket that holds the metadata of its blobs
+
+
+class BlobMeta:
+    '''The metadata a store keeps for every blob.'''
+    __slots__ = ("generation", "size", "md5_hash", "content_type")
+
+    def __init__(self, generation, size, md5_hash, content_type):
+        '''BlobMeta constructor.
+
+           Args:
+            generation: Generation of the blob, it changes every time the blob is written.
+            size: Size of the blob in bytes.
+            md5_hash: Base64 md5 digest of the blob bytes.
+            content_type: Content type of the blob.
+        '''
+        self.generation = generation
+        self.size = size
+        self.md5_hash = md5_hash
+        self.content_type = content_type
+
+
+def check_generation(name, meta, if_generation_match):
+    """ Raises PreconditionFailed if a blob does not have the expected generation.
+    Args:
+        name: Name of the blob.
+        meta: BlobMeta of the blob, or None if the blob does not exist.
+        if_generation_match: The expected generation, 0 when the blob must not exist, None to skip the check.
+    """
+    if if_generation_match is None:
+        return
+    generation = 0 if meta is None else meta.generation
+    if generation != if_generation_match:
+        raise PreconditionFailed(f"{name} has generation {generation}, expected {if_generation_match}")
+
+
+def md5_hash(data):
+    """ Returns the base64 md5 digest of some bytes, like the cloud storage reports it."""
+    return base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+
+
+class MemoryStore:
+
+    def __init__(self):
+        self.buckets = {}  # bucket name -> {blob name -> (BlobMeta, bytes)}
+        self.generations = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def stat(self, bucket, name):
+        """ Returns the BlobMeta of a blob, or None if it does not exist."""
+        entry = self.buckets.get(bucket, {}).get(name)
+        return None if entry is None else entry[0]
+
+    def read(self, bucket, name, start=None, end=None, generation=None):
+        """ Returns the bytes of a blob from start to end, both included.
+        Args:
+            bucket: Name of the bucket.
+            name: Name of the blob.
+            start: First byte to read, None to read from the beginning.
+            end: Last byte to read, None to read to the end.
+            generation: Generation that must be read, None to read the current one.
+        """
+        entry = self.buckets.get(bucket, {}).get(name)
+        if entry is None or (generation is not None and entry[0].generation != generation):
+            raise NotFound(f"{bucket}/{name} not found")
+        return byte_range(entry[1], start, end)
+
+    def write(self, bucket, name, data, content_type, if_generation_match=None):
+        """ Writes the bytes of a blob.
+        Args:
+            bucket: Name of the bucket.
+            name: Name of the blob.
+            data: The bytes of the blob.
+            content_type: Content type of the blob.
+            if_generation_match: Generation the blob must have, 0 when it must not exist yet.
+        Returns:
+            The BlobMeta of the written blob.
+        """
+        with self.lock:
+            blobs = self.buckets.setdefault(bucket, {})
+            old = blobs.get(name)
+            check_generation(name, None if old is None else old[0], if_generation_match)
+            meta = BlobMeta(next(self.generations), len(data), md5_hash(data), content_type)
+            blobs[name] = (meta, bytes(data))
+            return meta
+
+    def delete(self, bucket, name, if_generation_match=None):
+        """ Deletes a blob, raising NotFound if it does not exist."""
+        with self.lock:
+            blobs = self.buckets.get(bucket, {})
+            old = blobs.get(name)
+            if old is None:
+                raise NotFound(f"{bucket}/{name} not found")
+            check_generation(name, old[0], if_generation_match)
+            del blobs[name]
+
+    def list(self, bucket, prefix=""):
+        """ Returns the sorted names of the blobs of a bucket that start with a prefix."""
+        with self.lock:
+            names = list(self.buckets.get(bucket, {}))
+        return sorted(name for name in names if name.startswith(prefix))
+
+
+class LocalStore:
+
+    def __init__(self, root):
+        """
+        Args:
+            root: Directory with one folder per bucket, a blob is the file at its name inside the bucket folder.
+        """
+        self.root = root
+        self.lock = threading.RLock()
+
+    def path(self, bucket, name):
+        path = os.path.normpath(os.path.join(self.root, bucket, name))
+        if not path.startswith(os.path.join(os.path.normpath(self.root), bucket) + os.sep):
+            raise ValueError(f"invalid blob name {name}")
+        return path
+
+    def meta_path(self, bucket, name):
+        return self.path(bucket, os.path.join(META_DIR, name + ".json"))
+
+    def stat(self, bucket, name):
+        """ Returns the BlobMeta of a blob, or None if it does not exist.
+            Files copied into the directory by hand get their metadata the first time they are read.
+        """
+        path = self.path(bucket, name)
+        try:
+            with open(self.meta_path(bucket, name)) as f:
+                fields = json.load(f)
+            return BlobMeta(**fields)
+        except FileNotFoundError:
+            if not os.path.isfile(path):
+                return None
+        with open(path, "rb") as f:
+            data = f.read()
+        with self.lock:
+            content_type = mimetypes.guess_type(name)[0] or DEFAULT_CONTENT_TYPE
+            return self.save_meta(bucket, name, data, content_type, os.stat(path).st_mtime_ns)
+
+    def save_meta(self, bucket, name, data, content_type, generation):
+        meta = BlobMeta(generation, len(data), md5_hash(data), content_type)
+        meta_path = self.meta_path(bucket, name)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        write_file(meta_path, json.dumps({field: getattr(meta, field) for field in BlobMeta.__slots__}).encode())
+        return meta
+
+    def read(self, bucket, name, start=None, end=None, generation=None):
+        """ Returns the bytes of a blob from start to end, both included, reading only that range through mmap."""
+        meta = self.stat(bucket, name)
+        if meta is None or (generation is not None and meta.generation != generation):
+            raise NotFound(f"{bucket}/{name} not found")
+        with open(self.path(bucket, name), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return byte_range(data, start, end)
+
+    def write(self, bucket, name, data, content_type, if_generation_match=None):
+        """ Writes the bytes of a blob, the file is replaced at once so readers never see half of it."""
+        with self.lock:
+            old = self.stat(bucket, name)
+            check_generation(name, old, if_generation_match)
+            path = self.path(bucket, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_file(path, data)
+            # generations only grow, even if the clock does not move between two writes
+            generation = max(time.time_ns(), 0 if old is None else old.generation + 1)
+            return self.save_meta(bucket, name, data, content_type, generation)
+
+    def delete(self, bucket, name, if_generation_match=None):
+        """ Deletes a blob, raising NotFound if it does not exist."""
+        with self.lock:
+            old = self.stat(bucket, name)
+            if old is None:
+                raise NotFound(f"{bucket}/{name} not found")
+            check_generation(name, old, if_generation_match)
+            os.remove(self.path(bucket, name))
+            os.remove(self.meta_path(bucket, name))
+
+    def list(self, bucket, prefix=""):
+        """ Returns the sorted names of the blobs of a bucket that start with a prefix."""
+        bucket_path = os.path.join(self.root, bucket)
+        names = []
+        for folder, subfolders, files in os.walk(bucket_path):
+            if folder == bucket_path and META_DIR in subfolders:
+                subfolders.remove(META_DIR)
+            for file in files:
+                name = os.path.relpath(os.path.join(folder, file), bucket_path).replace(os.sep, "/")
+                if name.startswith(prefix) and not file.startswith(".tmp-"):
+                    names.append(name)
+        return sorted(names)
+
+
+class LatencyStore:
+
+    def __init__(self, store, latency=0.02, jitter=0.0, sleep=time.sleep, random=random.random):
+        """
+        Args:
+            store: The store that keeps the blobs.
+            latency: Seconds every operation waits before it reaches the store.
+            jitter: Extra seconds every operation may wait, picked at random.
+            sleep: Dependency injection for mocking time.sleep.
+            random: Dependency injection for mocking the random number generator.
+        """
+        self.store = store
+        self.latency = latency
+        self.jitter = jitter
+        self.sleep = sleep
+        self.random = random
+        self.calls = Counter()  # operation -> number of calls
+        self.calls_lock = threading.Lock()
+
+    @property
+    def operations(self):
+        return sum(self.calls.values())
+
+    def wait(self, operation):
+        with self.calls_lock:
+            self.calls[operation] += 1
+        if self.latency or self.jitter:
+            self.sleep(self.latency + self.jitter * self.random())
+
+    def stat(self, *args, **kwargs):
+        self.wait("stat")
+        return self.store.stat(*args, **kwargs)
+
+    def read(self, *args, **kwargs):
+        self.wait("read")
+        return self.store.read(*args, **kwargs)
+
+    def write(self, *args, **kwargs):
+        self.wait("write")
+        return self.store.write(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        self.wait("delete")
+        return self.store.delete(*args, **kwargs)
+
+    def list(self, *args, **kwargs):
+        self.wait("list")
+        return self.store.list(*args, **kwargs)
+
+
+def byte_range(data, start=None, end=None):
+    """ Returns the bytes from start to end, both included, like a ranged cloud storage download."""
+    start = 0 if start is None else start
+    end = len(data) if end is None else end + 1
+    return bytes(data[start:end])
+
+
+def write_file(path, data):
+    """ Writes a file through a temporary file, so the file is replaced at once."""
+    folder, file = os.path.split(path)
+    tmp_path = os.path.join(folder, f".tmp-{file}-{threading.get_ident()}")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class BlobWriter(io.BytesIO):
+    '''Buffer returned by Blob.open for writing, the blob is uploaded when it is closed.'''
+
+    def __init__(self, blob, content_type):
+        super().__init__()
+        self.blob = blob
+        self.content_type = content_type
+
+    def close(self):
+        if not self.closed:
+            self.blob.upload_from_string(self.getvalue(), content_type=self.content_type)
+        super().close()
+
+
+class Blob:
+
+    def __init__(self, bucket, name, meta=None):
+        """
+        Args:
+            bucket: The Bucket of the blob.
+            name: Name of the blob.
+            meta: BlobMeta of the blob if it was already read.
+        """
+        self.bucket = bucket
+        self.name = name
+        self._set_meta(meta)
+
+    def __repr__(self):
+        return f"<Blob: {self.bucket.name}, {self.name}, {self.generation}>"
+
+    def _set_meta(self, meta):
+        self.generation = None if meta is None else meta.generation
+        self.size = None if meta is None else meta.size
+        self.md5_hash = None if meta is None else meta.md5_hash
+        self.content_type = None if meta is None else meta.content_type
+
+    @property
+    def store(self):
+        return self.bucket.client.store
+
+    def exists(self):
+        return self.store.stat(self.bucket.name, self.name) is not None
+
+    def reload(self):
+        """ Reads the metadata of the blob again, raising NotFound if it does not exist."""
+        meta = self.store.stat(self.bucket.name, self.name)
+        if meta is None:
+            raise NotFound(f"{self.bucket.name}/{self.name} not found")
+        self._set_meta(meta)
+
+    def download_as_bytes(self, start=None, end=None):
+        """ Downloads the bytes of the blob from start to end, both included.
+            A blob read with get_blob downloads the generation it was read at, like the cloud storage does.
+        """
+        return self.store.read(self.bucket.name, self.name, start, end, self.generation)
+
+    def download_as_string(self, start=None, end=None):
+        return self.download_as_bytes(start, end)
+
+    def download_as_text(self, start=None, end=None, encoding="utf-8"):
+        return self.download_as_bytes(start, end).decode(encoding)
+
+    def upload_from_string(self, data, content_type=TEXT_CONTENT_TYPE, if_generation_match=None):
+        """ Uploads the blob, text is encoded as utf-8.
+        Args:
+            data: The bytes or text of the blob.
+            content_type: Content type of the blob.
+            if_generation_match: Generation the blob must have, 0 when it must not exist yet.
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        meta = self.store.write(self.bucket.name, self.name, data, content_type, if_generation_match)
+        self._set_meta(meta)
+
+    def upload_from_file(self, file_obj, content_type=None, if_generation_match=None):
+        """ Uploads the rest of an open file as the blob.
+            Like the cloud storage, the content type of the file object is ignored, without a
+            content_type the one the blob already has is kept, or application/octet-stream is used.
+        """
+        content_type = content_type or self.content_type or DEFAULT_CONTENT_TYPE
+        self.upload_from_string(file_obj.read(), content_type=content_type, if_generation_match=if_generation_match)
+
+    def delete(self, if_generation_match=None):
+        self.store.delete(self.bucket.name, self.name, if_generation_match)
+
+    def open(self, mode="r", encoding="utf-8"):
+        """ Opens the blob as a file, writes are uploaded when the file is closed.
+        Args:
+            mode: 'r', 'rt', 'rb', 'w', 'wt' or 'wb'.
+            encoding: Encoding used in text mode.
+        """
+        if mode in ("r", "rt"):
+            return io.TextIOWrapper(io.BytesIO(self.download_as_bytes()), encoding=encoding)
+        if mode == "rb":
+            return io.BytesIO(self.download_as_bytes())
+        if mode in ("w", "wt"):
+            return io.TextIOWrapper(BlobWriter(self, TEXT_CONTENT_TYPE), encoding=encoding)
+        if mode == "wb":
+            return BlobWriter(self, DEFAULT_CONTENT_TYPE)
+        raise ValueError(f"unsupported mode {mode}")
+
+
+class BlobListing:
+    '''Blobs returned by Bucket.list_blobs, next_page_token is set when there are more blobs to list.'''
+
+    def __init__(self, blobs, next_page_token):
+        self.blobs = blobs
+        self.next_page_token = next_page_token
+
+    def __iter__(self):
+        return iter(self.blobs)
+
+
+class Bucket:
+
+    def __init__(self, client, name):
+        """
+        Args:
+            client: The StorageClient of the bucket.
+            name: Name of the bucket.
+        """
+        self.client = client
+        self.name = name
+
+    def blob(self, name):
+        """ Returns a blob handle without reading anything from the store."""
+        return Blob(self, name)
+
+    def get_blob(self, name):
+        """ Returns the blob with its metadata, or None if it does not exist."""
+        meta = self.client.store.stat(self.name, name)
+        return None if meta is None else Blob(self, name, meta)
+
+    def list_blobs(self, prefix="", max_results=None, page_token=None):
+        """ Lists the blobs whose name starts with a prefix, in name order.
+        Args:
+            prefix: Prefix of the blob names.
+            max_results: Maximum number of blobs to return.
+            page_token: The next_page_token of the previous page.
+        Returns:
+            BlobListing with the blobs of the page.
+        """
+        names = self.client.store.list(self.name, prefix or "")
+        if page_token is not None:
+            names = [name for name in names if name > page_token]
+        next_page_token = None
+        if max_results is not None and len(names) > max_results:
+            names = names[:max_results]
+            next_page_token = names[-1]
+        blobs = [self.get_blob(name) for name in names]
+        return BlobListing([blob for blob in blobs if blob is not None], next_page_token)
+
+
+class StorageClient:
+
+    def __init__(self, store):
+        """
+        Args:
+            store: The MemoryStore, LocalStore or LatencyStore that keeps the blobs.
+        """
+        self.store = store
+
+    def get_bucket(self, name):
+        return Bucket(self, name)
+
+    def bucket(self, name):
+        return Bucket(self, name)
+
+
+def make_client(spec):
+    """ Creates the storage client described by a storage spec.
+    Args:
+        spec: 'gcs' for the google cloud storage, 'memory' for a MemoryStore or 'local:<directory>'
+            for a LocalStore, optionally followed by '+latency=<seconds>' to wrap it in a LatencyStore.
+    Returns:
+        A client with the cloud storage client api.
+    """
+    spec, *options = spec.split("+")
+    if spec == "gcs":
+        from google.cloud import storage
+        return storage.Client()
+
+    if spec == "memory":
+        store = MemoryStore()
+    elif spec.startswith("local:"):
+        store = LocalStore(spec[len("local:"):])
+    else:
+        raise ValueError(f"unknown storage {spec}")
+
+    for option in options:
+        key, value = option.split("=")
+        if key != "latency":
+            raise ValueError(f"unknown storage option {option}")
+        store = LatencyStore(store, latency=float(value))
+    return StorageClient(store)
@@ -0,0 +1,128 @@
+from flaskr.blob_store import StorageClient, MemoryStore, LocalStore, LatencyStore, make_client
+from flaskr.backend import Backend
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from unittest.mock import MagicMock
+import pytest
+import io
+
+
+@pytest.fixture(params=["memory", "local"])
+def client(request, tmp_path):
+    if request.param == "memory":
+        return StorageClient(MemoryStore())
+    return StorageClient(LocalStore(str(tmp_path)))
+
+
+def test_upload_and_download(client):
+    bucket = client.get_bucket("wiki")
+    bucket.blob("pages/abra").upload_from_string('{"name": "Abra"}', content_type="application/json")
+    blob = bucket.get_blob("pages/abra")
+    assert blob.download_as_bytes() == b'{"name": "Abra"}'
+    assert blob.download_as_bytes(start=2, end=5) == b'name'
+    assert (blob.size, blob.content_type, blob.md5_hash) == (16, "application/json", "KgrKIZQc6agJO7fS1IB9og==")
+    assert bucket.get_blob("pages/mew") == None
+
+
+def test_open(client):
+    bucket = client.get_bucket("users")
+    with bucket.blob("ash").open("w") as f:
+        f.write("hashed")
+    with bucket.get_blob("ash").open("r") as f:
+        assert f.read() == "hashed"
+    with bucket.get_blob("ash").open("rb") as f:
+        assert f.read(3) == b"has"
+
+
+def test_generation_preconditions(client):
+    bucket = client.get_bucket("wiki")
+    blob = bucket.blob("ranks_list.json")
+    blob.upload_from_string("[]", if_generation_match=0)
+    first = blob.generation
+    with pytest.raises(PreconditionFailed):
+        bucket.blob("ranks_list.json").upload_from_string("[1]", if_generation_match=0)
+    blob.upload_from_string("[2]", if_generation_match=first)
+    assert blob.generation > first
+    with pytest.raises(PreconditionFailed):
+        blob.upload_from_string("[3]", if_generation_match=first)
+    with pytest.raises(PreconditionFailed):
+        blob.delete(if_generation_match=first)
+    blob.delete(if_generation_match=blob.generation)
+    assert bucket.get_blob("ranks_list.json") == None
+
+
+def test_download_of_replaced_generation(client):
+    bucket = client.get_bucket("wiki")
+    bucket.blob("pokedex.json").upload_from_string("old")
+    old_blob = bucket.get_blob("pokedex.json")
+    bucket.blob("pokedex.json").upload_from_string("new")
+    with pytest.raises(NotFound):
+        old_blob.download_as_bytes()
+    assert bucket.blob("pokedex.json").download_as_bytes() == b"new"
+
+
+def test_list_blobs_with_prefix_and_pages(client):
+    bucket = client.get_bucket("wiki")
+    for name in ["pages/mew", "pages/abra", "images/abra.png", "pages/zubat"]:
+        bucket.blob(name).upload_from_string(name)
+    listing = bucket.list_blobs(prefix="pages/", max_results=2)
+    assert [blob.name for blob in listing] == ["pages/abra", "pages/mew"]
+    listing = bucket.list_blobs(prefix="pages/", max_results=2, page_token=listing.next_page_token)
+    assert [blob.name for blob in listing] == ["pages/zubat"]
+    assert listing.next_page_token == None
+
+
+def test_local_store_reads_copied_files(tmp_path):
+    (tmp_path / "wiki" / "authors").mkdir(parents=True)
+    (tmp_path / "wiki" / "authors" / "logo.jpg").write_bytes(b"jpeg")
+    bucket = StorageClient(LocalStore(str(tmp_path))).get_bucket("wiki")
+    blob = bucket.get_blob("authors/logo.jpg")
+    assert (blob.download_as_bytes(), blob.content_type) == (b"jpeg", "image/jpeg")
+    assert [blob.name for blob in bucket.list_blobs()] == ["authors/logo.jpg"]
+    with pytest.raises(ValueError):
+        bucket.get_blob("../users/ash")
+
+
+def test_latency_store():
+    sleep = MagicMock()
+    store = LatencyStore(MemoryStore(), latency=0.05, jitter=0.01, sleep=sleep, random=lambda: 0.5)
+    bucket = StorageClient(store).get_bucket("wiki")
+    bucket.blob("pages/abra").upload_from_string("abra")
+    bucket.get_blob("pages/abra").download_as_bytes()
+    assert store.operations == 3
+    assert store.calls == {"write": 1, "stat": 1, "read": 1}
+    sleep.assert_called_with(pytest.approx(0.055))
+
+
+def test_make_client(tmp_path):
+    assert isinstance(make_client("memory").store, MemoryStore)
+    client = make_client(f"local:{tmp_path}+latency=0.01")
+    assert (client.store.latency, client.store.store.root) == (0.01, str(tmp_path))
+    with pytest.raises(ValueError):
+        make_client("s3")
+
+
+def test_backend_game_record_on_memory_store():
+    backend = Backend(client=make_client("memory"), derive_ranks=True)
+
+    def add_points(record):
+        record.points += 100
+        record.seen.add(25)
+
+    record, user = backend.update_game("ash", add_points)
+    record, user = backend.update_game("ash", add_points, record)
+    assert user == {"name": "ash", "points": 200, "rank": 1}
+    assert backend.get_game_user("ash") == {"name": "ash", "points": 200, "rank": 1}
+    assert list(backend.get_game_record("ash").seen) == [25]
+
+
+def test_upload_from_file_content_type():
+    bucket = StorageClient(MemoryStore()).get_bucket("wiki")
+    file = io.BytesIO(b"png")
+    file.content_type = "image/png"
+    blob = bucket.blob("images/abra.png")
+    # the content type of the file object is not used, like the cloud storage
+    blob.upload_from_file(file)
+    assert bucket.get_blob("images/abra.png").content_type == "application/octet-stream"
+    file.seek(0)
+    blob.upload_from_file(file, content_type="image/png")
+    assert bucket.get_blob("images/abra.png").content_type == "image/png"
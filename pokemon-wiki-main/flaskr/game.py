@@ -0,0 +1,358 @@
+"""This module contains the game state kept in memory for every player.
+
+The UnseenSampler holds the pokemon ids a player has not seen yet in a pool with an
+id -> position index, so drawing a random unseen pokemon and removing a seen one are both
+O(1) no matter how many pokemon the player has already seen.
+
+A GameSession keeps the game record and rank of a player after they are read from the cloud
+storage once, so the following rounds only write to the storage. Sessions unused for longer
+than the ttl are forgotten, and only the most recently used max_sessions are kept. Every guess is saved as one
+conditional write of the game record, when another tab or server saved the record first the
+guess is applied again to the record it saved. After a guess the
+pokemon of the next round is picked right away and its image and pokedex record are loaded on a
+background worker while the player is redirected, so the next round is usually ready when it is asked for.
+
+Typical Usage:
+sessions = GameSessions(backend)
+session = sessions.get('javier')
+pokemon_id, pokemon_data = sessions.next_round(session)
+sessions.guess(session, pokemon_id, True)
+sessions.prefetch(session)
+"""
+
+from .backend import pokemon_image_path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from secrets import randbelow
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CORRECT_GUESS_POINTS = 100
+WRONG_GUESS_POINTS = 50
+
+
+def apply_guess(record, pokemon_id, correct):
+    """ Marks a pokemon as seen in a game record and updates the points, which never go below 0.
+    Args:
+        record: The GameRecord of the player.
+        pokemon_id: Id of the pokemon that was shown.
+        correct: Whether the player guessed the pokemon.
+    """
+    if correct:
+        record.points += CORRECT_GUESS_POINTS
+    else:
+        record.points = max(record.points - WRONG_GUESS_POINTS, 0)
+    record.seen.add(pokemon_id)
+
+
+class UnseenSampler:
+
+    def __init__(self, max_id, seen=(), randbelow=randbelow):
+        """
+        Args:
+            max_id: The highest pokemon id, ids go from 1 to max_id.
+            seen: Ids of the pokemon the player has already seen.
+            randbelow: Dependency injection for mocking the random number generator.
+        """
+        self.max_id = max_id
+        self.randbelow = randbelow
+        seen = set(seen)
+        self.pool = [id for id in range(1, max_id + 1) if id not in seen]
+        self.positions = {id: index for index, id in enumerate(self.pool)}
+
+    def __len__(self):
+        return len(self.pool)
+
+    def __contains__(self, id):
+        return id in self.positions
+
+    def sample(self):
+        """ Picks a random pokemon the player has not seen yet, without removing it.
+        Returns:
+            The id of an unseen pokemon, or None if the player has seen every pokemon.
+        """
+        if not self.pool:
+            return None
+        return self.pool[self.randbelow(len(self.pool))]
+
+    def discard(self, id):
+        """ Marks a pokemon as seen by swapping it with the last id of the pool and removing it.
+        Args:
+            id: Id of the pokemon the player has seen.
+        """
+        index = self.positions.pop(id, None)
+        if index is None:
+            return
+        last = self.pool.pop()
+        if last != id:
+            self.pool[index] = last
+            self.positions[last] = index
+
+    def reset(self):
+        """ Makes every pokemon unseen again."""
+        self.pool = list(range(1, self.max_id + 1))
+        self.positions = {id: index for index, id in enumerate(self.pool)}
+
+
+class GameSession:
+
+    def __init__(self, record, rank):
+        """
+        Args:
+            record: GameRecord with the seen pokemon and the points of the player.
+            rank: Rank of the player, or None if the player is not on the leaderboard.
+        """
+        self.username = record.name
+        self.record = record
+        self.rank = rank
+        self.sampler = UnseenSampler(record.seen.max_id, record.seen)
+        self.prefetched = None  # (pokemon id, future with the pokedex record) of the next round
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+    @property
+    def seen(self):
+        return self.record.seen
+
+    @property
+    def points(self):
+        return self.record.points
+
+    def user(self):
+        """ Returns the game json object of the player."""
+        return self.record.user(self.rank)
+
+    def next_pokemon(self):
+        """ Picks a pokemon the player has not seen yet.
+        Returns:
+            The id of the pokemon, or None if the player has seen every pokemon.
+        """
+        return self.sampler.sample()
+
+    def saved(self, record, rank):
+        """ Takes the record and rank that were just saved, the unseen pokemon are read again
+            if the record had to be read again because somebody else saved it first.
+        Args:
+            record: The saved GameRecord.
+            rank: The new rank of the player.
+        """
+        if record is not self.record:
+            self.sampler = UnseenSampler(record.seen.max_id, record.seen)
+        self.record = record
+        self.rank = rank
+
+
+class GameSessions:
+
+    def __init__(self, backend, ttl=30 * 60, max_sessions=10000, prefetch_workers=4, prefetch_timeout=5,
+                 clock=time.monotonic):
+        """
+        Args:
+            backend: The Backend used to load and save the game state.
+            ttl: Seconds a session may stay unused before it is forgotten and read from the storage again.
+            max_sessions: Maximum number of sessions kept, the least recently used are forgotten first.
+            prefetch_workers: Number of threads that load the next rounds in the background.
+            prefetch_timeout: Seconds to wait for a prefetched round that is still loading.
+            clock: Dependency injection for mocking the clock.
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.clock = clock
+        self.sessions = OrderedDict()  # username -> GameSession, least recently used first
+        self.lock = threading.Lock()
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix="prefetch")
+        self.prefetch_timeout = prefetch_timeout
+        self.prefetch_hits = 0
+        self.prefetch_misses = 0
+
+    def get(self, username):
+        """ Returns the game session of a player, reading the seen pokemon and game user only the first time.
+        Args:
+            username: Username of the player.
+        """
+        session = self.lookup(username)
+        if session is not None:
+            return session
+        record, user = self.backend.get_game(username)
+        return self.start(username, record, user)
+
+    def lookup(self, username):
+        """ Returns the game session of a player if it is still in memory, or None.
+        Args:
+            username: Username of the player.
+        """
+        now = self.clock()
+        with self.lock:
+            session = self.sessions.get(username)
+            if session is None:
+                return None
+            if now - session.last_used >= self.ttl:
+                del self.sessions[username]
+                return None
+            session.last_used = now
+            self.sessions.move_to_end(username)
+            return session
+
+    def start(self, username, record, user):
+        """ Creates the game session of a player from its game record and game json object.
+        Args:
+            username: Username of the player.
+            record: The GameRecord of the player.
+            user: The game json object of the player, with its rank.
+        Returns:
+            The new GameSession, or the session another request created in the meantime.
+        """
+        now = self.clock()
+        session = GameSession(record, user["rank"])
+        session.last_used = now
+
+        with self.lock:
+            # another request may have loaded the session in the meantime
+            current = self.sessions.get(username)
+            if current is not None and now - current.last_used < self.ttl:
+                current.last_used = now
+                self.sessions.move_to_end(username)
+                return current
+            self.sessions.pop(username, None)
+            self.evict(now)
+            self.sessions[username] = session
+            return session
+
+    def evict(self, now):
+        """ Forgets the expired sessions and makes room for one more session, the lock must be held.
+            The sessions are ordered by their last use, so the expired ones are the first ones.
+        """
+        while self.sessions:
+            username, session = next(iter(self.sessions.items()))
+            if len(self.sessions) < self.max_sessions and now - session.last_used < self.ttl:
+                break
+            self.sessions.popitem(last=False)
+
+    def guess(self, session, pokemon_id, correct):
+        """ Saves a guess of the player, the game record and the leaderboard are written only if
+            nobody else wrote them since they were read. If saving fails the session is dropped,
+            so the next round reads the stored state again.
+            A pokemon the player has already seen is not scored again. This is checked on the record
+            that is written, so a guess replayed on another server or tab never scores twice.
+        Args:
+            session: The GameSession of the player.
+            pokemon_id: Id of the pokemon that was shown.
+            correct: Whether the player guessed the pokemon.
+        Returns:
+            Whether the guess was scored.
+        """
+        if pokemon_id in session.seen:
+            return False
+        scored = False
+
+        def change(record):
+            nonlocal scored
+            # the record may have been saved by another server since the session read it
+            scored = pokemon_id not in record.seen
+            if scored:
+                apply_guess(record, pokemon_id, correct)
+
+        self.save(session, change, update_rank=True)
+        session.sampler.discard(pokemon_id)
+        return scored
+
+    def start_over(self, session):
+        """ Makes every pokemon unseen again and saves the game record, the points are kept.
+        Args:
+            session: The GameSession of the player.
+        """
+        def change(record):
+            record.seen.clear()
+
+        self.save(session, change, update_rank=False)
+        session.sampler.reset()
+
+    def save(self, session, change, update_rank):
+        """ Applies a change to the game record of a session and saves it.
+        Args:
+            session: The GameSession of the player.
+            change: Function that changes a GameRecord in place.
+            update_rank: Whether the points changed, so the leaderboard has to be updated.
+        """
+        try:
+            if update_rank:
+                record, user = self.backend.update_game(session.username, change, session.record)
+                rank = user["rank"]
+            else:
+                record = self.backend.update_game_record(session.username, change, session.record)
+                rank = session.rank
+        except Exception:
+            self.drop(session.username)
+            raise
+        session.saved(record, rank)
+
+    def drop(self, username):
+        """ Forgets the session of a player so it is read from the storage again."""
+        with self.lock:
+            self.sessions.pop(username, None)
+
+    def load_round(self, pokemon_id):
+        """ Reads the image and the pokedex record of a pokemon, the image is kept in the backend image cache.
+        Args:
+            pokemon_id: Id of the pokemon.
+        Returns:
+            The pokedex json object of the pokemon.
+        """
+        self.backend.get_image_bytes(pokemon_image_path(pokemon_id))
+        return self.backend.get_pokemon_data(pokemon_id)
+
+    def prefetch(self, session):
+        """ Picks the pokemon of the next round of a session and loads it on a background worker.
+        Args:
+            session: The GameSession of the player.
+        """
+        with session.lock:
+            pokemon_id = session.next_pokemon()
+            if pokemon_id is None:
+                session.prefetched = None
+                return
+            session.prefetched = (pokemon_id, self.prefetch_executor.submit(self.load_round, pokemon_id))
+
+    def next_round(self, session):
+        """ Returns the pokemon of the next round, from the prefetched round when there is one.
+            The round is loaded right away if nothing was prefetched, the prefetched pokemon was
+            seen in the meantime or loading it failed.
+        Args:
+            session: The GameSession of the player.
+        Returns:
+            Tuple with the id and the pokedex json object of the pokemon, or (None, None) if the player has seen every pokemon.
+        """
+        with session.lock:
+            prefetched, session.prefetched = session.prefetched, None
+            if prefetched is not None and prefetched[0] in session.sampler:
+                pokemon_id, future = prefetched
+            else:
+                pokemon_id, future = session.next_pokemon(), None
+
+        if future is not None:
+            try:
+                pokemon_data = future.result(timeout=self.prefetch_timeout)
+            except Exception as e:
+                logger.warning("Could not prefetch pokemon %d: %s", pokemon_id, e)
+            else:
+                with self.lock:
+                    self.prefetch_hits += 1
+                return pokemon_id, pokemon_data
+
+        with self.lock:
+            self.prefetch_misses += 1
+        if pokemon_id is None:
+            return None, None
+        return pokemon_id, self.backend.get_pokemon_data(pokemon_id)
+
+    def stats(self):
+        """ Returns the prefetch counters.
+        Returns:
+            Dictionary with the rounds served from a prefetched round and the rounds loaded on request.
+        """
+        with self.lock:
+            return {"prefetch_hits": self.prefetch_hits, "prefetch_misses": self.prefetch_misses}
@@ -0,0 +1,73 @@
+"""This module contains the game record of a player, the single blob that holds the game state of a player.
+
+The record keeps the seen pokemon and the points of a player together, so a guess is one write of
+one blob. The record remembers the generation of the blob it was read from, the backend only writes
+it back if nobody else wrote it since, which keeps two tabs or two servers from losing each other's guesses.
+The seen pokemon are stored as the base64 of the SeenSet bitset.
+
+Typical Usage:
+record = GameRecord.decode(blob.download_as_bytes(), blob.generation, MAX_ID)
+record.points += 100
+blob.upload_from_string(data=record.encode(), if_generation_match=record.generation)
+"""
+
+from .seen import SeenSet
+from flask import json
+import base64
+
+
+class GameRecord:
+
+    def __init__(self, name, seen, points=0, generation=None):
+        """
+        Args:
+            name: Username of the player.
+            seen: SeenSet with the pokemon the player has seen.
+            points: Points of the player.
+            generation: Generation of the blob the record was read from, or None if the record was never saved.
+        """
+        self.name = name
+        self.seen = seen
+        self.points = points
+        self.generation = generation
+
+    def __repr__(self):
+        return f"GameRecord({self.name!r}, {self.seen!r}, {self.points}, {self.generation})"
+
+    def copy(self):
+        """ Returns a new GameRecord with the same data, its SeenSet is copied as well."""
+        return GameRecord(self.name, self.seen.copy(), self.points, self.generation)
+
+    def user(self, rank):
+        """ Returns the game json object of the player.
+        Args:
+            rank: Rank of the player, or None if the player is not on the leaderboard.
+        """
+        return {"name": self.name, "points": self.points, "rank": rank}
+
+    def encode(self, json=json, base64func=base64):
+        """ Converts the record to its storage format.
+        Args:
+            json: Dependency injection for mocking the json module.
+            base64func: Dependency injection for mocking the base64 module.
+        Returns:
+            The json string of the record.
+        """
+        seen = base64func.b64encode(self.seen.encode()).decode("ascii")
+        return json.dumps({"name": self.name, "points": self.points, "seen": seen})
+
+    @classmethod
+    def decode(cls, data, generation, max_id, json=json, base64func=base64):
+        """ Reads a record from its storage format.
+        Args:
+            data: The stored json.
+            generation: Generation of the blob the data was read from.
+            max_id: The highest pokemon id.
+            json: Dependency injection for mocking the json module.
+            base64func: Dependency injection for mocking the base64 module.
+        Returns:
+            record: The GameRecord with the stored state.
+        """
+        json_obj = json.loads(data)
+        seen = SeenSet.decode(base64func.b64decode(json_obj["seen"]), max_id, json)
+        return cls(json_obj["name"], seen, json_obj["points"], generation)
@@ -0,0 +1,16 @@
+from flaskr.game_record import GameRecord
+from flaskr.seen import SeenSet
+from flask import json
+
+
+def test_encode_decode():
+    record = GameRecord("misty", SeenSet(386, [1, 25, 386]), 250)
+    data = record.encode()
+    assert json.loads(data) == {"name": "misty", "points": 250, "seen": "AQEAAAEAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAI="}
+    decoded = GameRecord.decode(data, 7, 386)
+    assert (decoded.name, decoded.seen, decoded.points, decoded.generation) == ("misty", SeenSet(386, [1, 25, 386]), 250, 7)
+
+
+def test_user():
+    record = GameRecord("misty", SeenSet(386), 250)
+    assert record.user(3) == {"name": "misty", "points": 250, "rank": 3}
@@ -0,0 +1,219 @@
+from flaskr.game import UnseenSampler, GameSessions, apply_guess
+from flaskr.game_record import GameRecord
+from flaskr.seen import SeenSet
+from unittest.mock import MagicMock
+import pytest
+
+
+def first(n):
+    return 0
+
+
+def test_sample_skips_seen_pokemon():
+    sampler = UnseenSampler(5, seen=[1, 2, 4])
+    assert len(sampler) == 2
+    assert {sampler.sample() for i in range(50)} <= {3, 5}
+
+
+def test_sample_never_returns_zero():
+    sampler = UnseenSampler(3)
+    assert 0 not in {sampler.sample() for i in range(50)}
+
+
+def test_discard_swaps_last_id_in():
+    sampler = UnseenSampler(4, randbelow=first)
+    sampler.discard(1)
+    assert sampler.sample() == 4
+    assert 1 not in sampler
+    assert len(sampler) == 3
+    sampler.discard(1)
+    assert len(sampler) == 3
+
+
+def test_sample_all_seen():
+    sampler = UnseenSampler(2)
+    sampler.discard(1)
+    sampler.discard(2)
+    assert sampler.sample() == None
+    sampler.reset()
+    assert len(sampler) == 2
+
+
+def save(username, change, record):
+    change(record)
+    record.generation += 1
+    return record
+
+
+@pytest.fixture
+def backend():
+    backend = MagicMock()
+    backend.get_game.side_effect = lambda username: (GameRecord(username, SeenSet(3, [1]), 30, 1), {"name": username, "points": 30, "rank": 4})
+    backend.update_game.side_effect = lambda username, change, record: (save(username, change, record), {"name": username, "points": record.points, "rank": 2})
+    backend.update_game_record.side_effect = save
+    return backend
+
+
+def test_apply_guess():
+    record = GameRecord("misty", SeenSet(3), 30)
+    apply_guess(record, 2, True)
+    assert record.points == 130
+    apply_guess(record, 3, False)
+    apply_guess(record, 1, False)
+    assert record.points == 30
+    apply_guess(record, 1, False)
+    assert record.points == 0
+    assert record.seen.is_complete()
+
+
+def test_game_sessions_load_once(backend):
+    sessions = GameSessions(backend)
+    session = sessions.get("misty")
+    assert session.user() == {"name": "misty", "points": 30, "rank": 4}
+    assert sessions.get("misty") is session
+    assert session.next_pokemon() in (2, 3)
+    backend.get_game.assert_called_once_with("misty")
+
+
+def test_game_sessions_reload_after_ttl(backend):
+    sessions = GameSessions(backend, ttl=0)
+    sessions.get("misty")
+    sessions.get("misty")
+    assert backend.get_game.call_count == 2
+
+
+def test_game_sessions_guess(backend):
+    sessions = GameSessions(backend)
+    session = sessions.get("misty")
+    sessions.guess(session, 2, True)
+    assert session.seen == SeenSet(3, [1, 2])
+    assert session.user() == {"name": "misty", "points": 130, "rank": 2}
+    assert session.record.generation == 2
+    assert session.next_pokemon() == 3
+    backend.update_game.assert_called_once()
+
+
+def test_game_sessions_guess_on_record_saved_by_another_server(backend):
+    # another tab saw pokemon 3 and saved the record first, the guess is applied to its record
+    other = GameRecord("misty", SeenSet(3, [1, 3]), 130, 7)
+    backend.update_game.side_effect = lambda username, change, record: (save(username, change, other), {"name": username, "points": other.points, "rank": 1})
+    sessions = GameSessions(backend)
+    session = sessions.get("misty")
+    sessions.guess(session, 2, False)
+    assert session.record is other
+    assert session.user() == {"name": "misty", "points": 80, "rank": 1}
+    assert session.seen.is_complete()
+    assert session.next_pokemon() == None
+
+
+def test_game_sessions_start_over(backend):
+    sessions = GameSessions(backend)
+    session = sessions.get("misty")
+    sessions.start_over(session)
+    assert len(session.seen) == 0
+    assert len(session.sampler) == 3
+    assert session.user() == {"name": "misty", "points": 30, "rank": 4}
+    backend.update_game.assert_not_called()
+
+
+def test_game_sessions_guess_failure_drops_session(backend):
+    backend.update_game.side_effect = Exception("storage unavailable")
+    sessions = GameSessions(backend)
+    session = sessions.get("misty")
+    with pytest.raises(Exception):
+        sessions.guess(session, 2, True)
+    assert sessions.get("misty") is not session
+
+
+def test_game_sessions_prefetch_hit(backend):
+    backend.get_pokemon_data.return_value = {"id": 2}
+    sessions = GameSessions(backend)
+    session = sessions.get("misty")
+    sessions.prefetch(session)
+    pokemon_id = session.prefetched[0]
+    assert sessions.next_round(session) == (pokemon_id, {"id": 2})
+    backend.get_image_bytes.assert_called_once_with(f"master_pokedex/images/{pokemon_id:03}.png")
+    assert sessions.stats() == {"prefetch_hits": 1, "prefetch_misses": 0}
+
+
+def test_game_sessions_prefetched_pokemon_already_seen(backend):
+    sessions = GameSessions(backend)
+    session = sessions.get("misty")
+    sessions.prefetch(session)
+    sessions.guess(session, session.prefetched[0], True)
+    pokemon_id, pokemon_data = sessions.next_round(session)
+    assert pokemon_id not in session.seen
+    assert sessions.stats() == {"prefetch_hits": 0, "prefetch_misses": 1}
+
+
+def test_game_sessions_prefetch_failure_falls_back(backend):
+    backend.get_image_bytes.side_effect = Exception("storage unavailable")
+    backend.get_pokemon_data.return_value = {"id": 3}
+    sessions = GameSessions(backend)
+    session = sessions.get("misty")
+    sessions.prefetch(session)
+    pokemon_id = session.prefetched[0]
+    assert sessions.next_round(session) == (pokemon_id, {"id": 3})
+    assert sessions.stats() == {"prefetch_hits": 0, "prefetch_misses": 1}
+
+
+def test_game_sessions_next_round_all_seen(backend):
+    backend.get_game.side_effect = lambda username: (GameRecord(username, SeenSet(3, [1, 2, 3])), {"name": username, "points": 0, "rank": None})
+    sessions = GameSessions(backend)
+    session = sessions.get("misty")
+    sessions.prefetch(session)
+    assert session.prefetched == None
+    assert sessions.next_round(session) == (None, None)
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_game_sessions_forget_expired_sessions(backend):
+    clock = Clock()
+    sessions = GameSessions(backend, ttl=10, clock=clock)
+    sessions.get("misty")
+    clock.now = 5
+    sessions.get("brock")
+    clock.now = 12
+    assert sessions.lookup("misty") == None
+    assert list(sessions.sessions) == ["brock"]
+    # starting a session sweeps the sessions that expired meanwhile
+    clock.now = 20
+    sessions.get("ash")
+    assert list(sessions.sessions) == ["ash"]
+
+
+def test_game_sessions_evict_least_recently_used(backend):
+    sessions = GameSessions(backend, max_sessions=2)
+    misty = sessions.get("misty")
+    sessions.get("brock")
+    assert sessions.get("misty") is misty
+    sessions.get("ash")
+    assert list(sessions.sessions) == ["misty", "ash"]
+    assert backend.get_game.call_count == 3
+
+
+def test_game_sessions_seen_pokemon_is_not_scored_again(backend):
+    sessions = GameSessions(backend)
+    session = sessions.get("misty")
+    assert sessions.guess(session, 2, True) == True
+    assert sessions.guess(session, 2, True) == False
+    assert session.points == 130
+    backend.update_game.assert_called_once()
+
+
+def test_game_sessions_guess_scored_by_another_server(backend):
+    # another server already saved the guess of pokemon 2, saving it again does not score it twice
+    other = GameRecord("misty", SeenSet(3, [1, 2]), 130, 7)
+    backend.update_game.side_effect = lambda username, change, record: (save(username, change, other), {"name": username, "points": other.points, "rank": 1})
+    sessions = GameSessions(backend)
+    session = sessions.get("misty")
+    assert sessions.guess(session, 2, True) == False
+    assert session.user() == {"name": "misty", "points": 130, "rank": 1}
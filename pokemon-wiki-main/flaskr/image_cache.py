@@ -0,0 +1,98 @@
+"""This module contains the least recently used cache of image bytes kept by the backend.
+
+The cache holds the raw bytes of image blobs up to a total byte budget. Every entry remembers
+the generation of the blob it was read from, so a replaced image is never served from the cache.
+When the budget is exceeded the least recently used images are evicted first.
+
+Typical Usage:
+cache = ImageCache(max_bytes=16 * 1024 * 1024)
+data = cache.get('authors/logo.jpg', blob.generation)
+if data is None:
+    data = blob.download_as_bytes()
+    cache.put('authors/logo.jpg', blob.generation, data)
+"""
+
+from collections import OrderedDict
+import threading
+
+
+class ImageCache:
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        """
+        Args:
+            max_bytes: Total size in bytes of the images the cache may hold.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # blob name -> (generation, bytes), least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, blob_name, generation):
+        """ Returns the cached bytes of an image if they were read from the given blob generation.
+        Args:
+            blob_name: Name of the image blob.
+            generation: Current generation of the image blob.
+        Returns:
+            The image bytes, or None if the image is not cached or the blob changed.
+        """
+        with self.lock:
+            entry = self.entries.get(blob_name)
+            if entry is None or entry[0] != generation:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(blob_name)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, blob_name, generation, data):
+        """ Caches the bytes of an image, evicting the least recently used images if needed.
+            Images larger than the whole budget are not cached.
+        Args:
+            blob_name: Name of the image blob.
+            generation: Generation of the blob the bytes were read from.
+            data: The image bytes.
+        """
+        size = len(data)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            old_entry = self.entries.pop(blob_name, None)
+            if old_entry is not None:
+                self.bytes -= len(old_entry[1])
+
+            while self.entries and self.bytes + size > self.max_bytes:
+                name, (old_generation, old_data) = self.entries.popitem(last=False)
+                self.bytes -= len(old_data)
+                self.evictions += 1
+
+            self.entries[blob_name] = (generation, data)
+            self.bytes += size
+
+    def clear(self):
+        """ Removes every image from the cache, the counters are kept."""
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """ Returns the cache counters.
+        Returns:
+            Dictionary with the hits, misses, evictions, cached images and cached bytes.
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+            }
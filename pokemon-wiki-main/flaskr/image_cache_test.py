@@ -0,0 +1,38 @@
+from flaskr.image_cache import ImageCache
+
+
+def test_get_miss_then_hit():
+    cache = ImageCache(max_bytes=100)
+    assert cache.get("authors/logo.jpg", 1) == None
+    cache.put("authors/logo.jpg", 1, b"logo")
+    assert cache.get("authors/logo.jpg", 1) == b"logo"
+    assert cache.stats() == {"hits": 1, "misses": 1, "evictions": 0, "entries": 1, "bytes": 4, "max_bytes": 100}
+
+
+def test_get_new_generation_is_a_miss():
+    cache = ImageCache(max_bytes=100)
+    cache.put("authors/logo.jpg", 1, b"logo")
+    assert cache.get("authors/logo.jpg", 2) == None
+    cache.put("authors/logo.jpg", 2, b"new logo")
+    assert cache.get("authors/logo.jpg", 2) == b"new logo"
+    assert cache.bytes == 8
+
+
+def test_evicts_least_recently_used():
+    cache = ImageCache(max_bytes=10)
+    cache.put("a", 1, b"aaaa")
+    cache.put("b", 1, b"bbbb")
+    cache.get("a", 1)
+    cache.put("c", 1, b"cccc")
+    assert cache.get("b", 1) == None
+    assert cache.get("a", 1) == b"aaaa"
+    assert cache.get("c", 1) == b"cccc"
+    assert cache.evictions == 1
+    assert cache.bytes == 8
+
+
+def test_image_larger_than_budget_is_not_cached():
+    cache = ImageCache(max_bytes=3)
+    cache.put("a", 1, b"aaaa")
+    assert len(cache) == 0
+    assert cache.bytes == 0
@@ -0,0 +1,130 @@
+"""This module contains the ranked view of the game leaderboard.
+
+Users are kept in a sorted array of (-points, tie stamp, name) keys, so updating the points of a
+user, finding the rank of a user and reading the top users are binary searches instead of moving
+the user one position at a time.
+
+Ties follow the order the leaderboard has always used: a user who gains points, joins the
+leaderboard or has to move down ends up below the users that already had the same points,
+while a user who loses points but does not have to move keeps its place above them.
+
+Typical Usage:
+ranking = RankedLeaderboard(backend.get_leaderboard())
+old_rank, new_rank = ranking.update('javier', 300)
+top_users = ranking.top(15)
+"""
+
+from bisect import bisect_left, insort
+
+
+class RankedLeaderboard:
+
+    def __init__(self, users=()):
+        """
+        Args:
+            users: Leaderboard list of user game json objects, best ranked user first.
+        """
+        self.keys = []  # sorted (-points, stamp, name) keys, best ranked user first
+        self.users = {}  # name -> key of the user
+        self.high_stamp = 0  # stamps that place a user last among the users with the same points
+        self.low_stamp = 0  # stamps that place a user first among the users with the same points
+        for user in users:
+            self.update(user["name"], user["points"])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, name):
+        return name in self.users
+
+    def _insert(self, name, points, stamp):
+        key = (-points, stamp, name)
+        insort(self.keys, key)
+        self.users[name] = key
+
+    def update(self, name, points):
+        """ Sets the points of a user, adding it to the leaderboard if it is not there yet.
+        Args:
+            name: Username of the user.
+            points: New points of the user.
+        Returns:
+            Tuple with the old rank (None for a new user) and the new rank of the user.
+        """
+        old_key = self.users.get(name)
+        if old_key is None:
+            self.high_stamp += 1
+            self._insert(name, points, self.high_stamp)
+            return None, self.rank(name)
+
+        old_rank = bisect_left(self.keys, old_key) + 1
+        old_points = -old_key[0]
+        del self.keys[old_rank - 1]
+
+        if points > old_points:
+            # moving up, the user goes below the users that already had the same points
+            self.high_stamp += 1
+            stamp = self.high_stamp
+        elif points == old_points:
+            stamp = old_key[1]
+        elif old_rank > len(self.keys) or -self.keys[old_rank - 1][0] <= points:
+            # the next user does not have more points, so the user keeps its place
+            self.low_stamp -= 1
+            stamp = self.low_stamp
+        else:
+            # moving down, the user goes below every user with at least the same points
+            self.high_stamp += 1
+            stamp = self.high_stamp
+
+        self._insert(name, points, stamp)
+        return old_rank, self.rank(name)
+
+    def remove(self, name):
+        """ Removes a user from the leaderboard if it is there.
+        Args:
+            name: Username of the user.
+        """
+        key = self.users.pop(name, None)
+        if key is not None:
+            del self.keys[bisect_left(self.keys, key)]
+
+    def rank(self, name):
+        """ Returns the rank of a user, starting at 1.
+        Args:
+            name: Username of the user.
+        Returns:
+            The rank of the user, or None if the user is not on the leaderboard.
+        """
+        key = self.users.get(name)
+        if key is None:
+            return None
+        return bisect_left(self.keys, key) + 1
+
+    def points(self, name):
+        """ Returns the points of a user, or None if the user is not on the leaderboard."""
+        key = self.users.get(name)
+        return None if key is None else -key[0]
+
+    def get(self, rank):
+        """ Returns the user game json object of the user with a rank.
+        Args:
+            rank: Rank of the user, starting at 1.
+        """
+        points, stamp, name = self.keys[rank - 1]
+        return {"name": name, "points": -points, "rank": rank}
+
+    def top(self, count, start=1):
+        """ Returns the users ranked from start to start + count - 1.
+        Args:
+            count: Number of users to return.
+            start: Rank of the first user to return.
+        Returns:
+            List of user game json objects with their ranks.
+        """
+        return [
+            {"name": name, "points": -points, "rank": rank}
+            for rank, (points, stamp, name) in enumerate(self.keys[start - 1:start - 1 + count], start=start)
+        ]
+
+    def to_list(self):
+        """ Returns the whole leaderboard as a list of user game json objects, best ranked user first."""
+        return self.top(len(self.keys))
@@ -0,0 +1,124 @@
+from flaskr.leaderboard import RankedLeaderboard
+from flaskr.backend import Backend
+from unittest.mock import MagicMock
+import copy
+import random
+import pytest
+
+
+def legacy_sort_leaderboard(leaderboard, user, is_new_user):
+    '''The swap-by-swap sort the leaderboard used before RankedLeaderboard, kept as the reference for the rank semantics.
+    Returns the sorted leaderboard, the user and the names of the users it moved.'''
+    moved = []
+    user_index = user["rank"] - 1
+    old_user = leaderboard[user_index]
+    user_points = user["points"]
+
+    def sort_up(user_index):
+        other_user_index = user_index - 1
+        other_user = leaderboard[other_user_index]
+        if user_points <= other_user["points"] or user_index == 0:
+            leaderboard[user_index] = user
+            return leaderboard, user
+        while other_user_index >= 0 and user_points > other_user["points"]:
+            user["rank"] -= 1
+            other_user["rank"] += 1
+            moved.append(other_user["name"])
+            leaderboard[other_user_index], leaderboard[user_index] = user, other_user
+            user_index -= 1
+            other_user_index -= 1
+            if other_user_index >= 0:
+                other_user = leaderboard[other_user_index]
+        return leaderboard, user
+
+    def sort_down(user_index):
+        other_user_index = user_index + 1 if user_index < len(leaderboard) - 1 else None
+        if other_user_index is None or user_points >= leaderboard[other_user_index]["points"]:
+            leaderboard[user_index] = user
+            return leaderboard, user
+        other_user = leaderboard[other_user_index]
+        while other_user_index <= len(leaderboard) - 1 and user_points <= other_user["points"]:
+            user["rank"] += 1
+            other_user["rank"] -= 1
+            moved.append(other_user["name"])
+            leaderboard[other_user_index], leaderboard[user_index] = user, other_user
+            user_index += 1
+            other_user_index += 1
+            if other_user_index <= len(leaderboard) - 1:
+                other_user = leaderboard[other_user_index]
+        return leaderboard, user
+
+    if is_new_user or old_user["points"] < user_points:
+        result = sort_up(user_index)
+    else:
+        result = sort_down(user_index)
+    return result[0], result[1], moved
+
+
+@pytest.fixture
+def ranking():
+    return RankedLeaderboard([
+        {"name": "ash", "points": 300, "rank": 1},
+        {"name": "misty", "points": 200, "rank": 2},
+        {"name": "brock", "points": 200, "rank": 3},
+        {"name": "gary", "points": 100, "rank": 4},
+    ])
+
+
+def test_keeps_stored_order(ranking):
+    assert [user["name"] for user in ranking.to_list()] == ["ash", "misty", "brock", "gary"]
+    assert ranking.rank("brock") == 3
+    assert ranking.rank("oak") == None
+
+
+def test_move_up_goes_below_ties(ranking):
+    assert ranking.update("gary", 200) == (4, 4)
+    assert ranking.update("gary", 250) == (4, 2)
+    assert ranking.top(2) == [{"name": "ash", "points": 300, "rank": 1}, {"name": "gary", "points": 250, "rank": 2}]
+
+
+def test_move_down_goes_below_ties(ranking):
+    assert ranking.update("ash", 200) == (1, 1)
+    assert ranking.update("misty", 100) == (2, 4)
+    assert [user["name"] for user in ranking.to_list()] == ["ash", "brock", "gary", "misty"]
+
+
+def test_losing_points_without_moving_keeps_place(ranking):
+    assert ranking.update("ash", 200) == (1, 1)
+    assert [user["name"] for user in ranking.to_list()] == ["ash", "misty", "brock", "gary"]
+
+
+def test_new_user_goes_below_ties(ranking):
+    assert ranking.update("oak", 200) == (None, 4)
+    assert ranking.get(4) == {"name": "oak", "points": 200, "rank": 4}
+    assert len(ranking) == 5
+
+
+def test_remove(ranking):
+    ranking.remove("misty")
+    assert ranking.rank("gary") == 3
+    assert "misty" not in ranking
+
+
+def test_matches_legacy_sort_with_ties():
+    rng = random.Random(386)
+    backend = Backend(MagicMock())
+    for size in range(1, 12):
+        for round in range(200):
+            points = sorted((rng.choice([0, 50, 100, 150]) for i in range(size)), reverse=True)
+            leaderboard = [{"name": f"user{i}", "points": p, "rank": i + 1} for i, p in enumerate(points)]
+            is_new_user = size == 1 or rng.random() < 0.2
+            if is_new_user:
+                user = {"name": "new", "points": rng.choice([0, 50, 100, 150, 200]), "rank": size + 1}
+                leaderboard.append(user)
+            else:
+                index = rng.randrange(size)
+                user = dict(leaderboard[index], points=rng.choice([0, 50, 100, 150, 200]))
+
+            expected, expected_user, moved = legacy_sort_leaderboard(copy.deepcopy(leaderboard), copy.deepcopy(user), is_new_user)
+            backend.queue_user_rank = MagicMock()
+            actual, actual_user = backend.sort_leaderboard(copy.deepcopy(leaderboard), copy.deepcopy(user), is_new_user)
+
+            assert actual == expected
+            assert actual_user == expected_user
+            assert sorted(call.args[0]["name"] for call in backend.queue_user_rank.call_args_list) == sorted(moved)
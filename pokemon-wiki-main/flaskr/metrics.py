@@ -0,0 +1,300 @@
+"""This module contains the request and storage metrics of the app.
+
+Metrics keeps, for every route, the duration of its requests and the count and duration of every
+storage operation its requests made. Storage operations are timed by wrapping the storage client
+of the backend in an InstrumentedClient, operations made outside of a request (background threads,
+the flush at exit) are recorded under the "background" route.
+
+Durations are kept as cumulative histograms and as a window of the latest samples, the window gives
+the p50, p95 and p99 of every route. Everything is rendered in the Prometheus text format, and the
+storage operations of a single request are summarised in its Server-Timing header.
+
+Typical Usage:
+metrics = Metrics()
+backend = Backend(client=client, metrics=metrics)
+metrics.start_request('/game', 'POST')
+backend.get_pokemon_data(25)
+timings = metrics.end_request()
+response.headers['Server-Timing'] = timings.server_timing()
+"""
+
+from collections import deque
+from contextlib import contextmanager
+import contextvars
+import threading
+import time
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+QUANTILES = (0.5, 0.95, 0.99)
+WINDOW = 1024  # latest samples the quantiles are computed from
+BACKGROUND_ROUTE = "background"
+
+
+class LatencyStats:
+
+    def __init__(self, buckets=BUCKETS, window=WINDOW):
+        """
+        Args:
+            buckets: Upper bounds in seconds of the histogram buckets.
+            window: Number of latest samples kept for the quantiles.
+        """
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.samples = deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.samples.append(seconds)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.bucket_counts[i] += 1
+
+    def quantile(self, q):
+        """ Returns the q quantile of the latest samples, or None if there are no samples."""
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+class RequestTimings:
+    '''Storage operations made while handling a single request.'''
+
+    def __init__(self, route, method, clock=time.perf_counter):
+        '''RequestTimings constructor.
+
+           Args:
+            route: The url rule of the request (e.g. '/pages/<pokemon>').
+            method: The http method of the request.
+            clock: Dependency injection for mocking the clock.
+        '''
+        self.route = route
+        self.method = method
+        self.clock = clock
+        self.start = clock()
+        self.duration = None
+        self.storage = {}  # operation -> [count, seconds]
+
+    def elapsed(self):
+        return self.clock() - self.start
+
+    def server_timing(self):
+        """ Returns the Server-Timing header value with the time spent in every storage operation and in total.
+            Durations are in milliseconds, e.g. 'storage-get_blob;desc="2 calls";dur=3.1, total;dur=12.4'.
+        """
+        entries = [
+            f'storage-{operation};desc="{count} calls";dur={seconds * 1000:.1f}'
+            for operation, (count, seconds) in sorted(self.storage.items())
+        ]
+        entries.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(entries)
+
+
+class Metrics:
+
+    def __init__(self, clock=time.perf_counter):
+        """
+        Args:
+            clock: Dependency injection for mocking the clock.
+        """
+        self.clock = clock
+        self.requests = {}  # (route, method) -> LatencyStats of the request durations
+        self.storage = {}  # (route, method, operation) -> LatencyStats of the operation durations
+        self.collectors = []
+        self.lock = threading.Lock()
+        self.current = contextvars.ContextVar("request_timings", default=None)
+
+    def start_request(self, route, method):
+        """ Starts timing a request, the storage operations of this context are recorded under its route.
+        Args:
+            route: The url rule of the request.
+            method: The http method of the request.
+        """
+        self.current.set(RequestTimings(route, method, self.clock))
+
+    def end_request(self):
+        """ Records the duration of the current request.
+        Returns:
+            The RequestTimings of the request, or None if no request was started.
+        """
+        timings = self.current.get()
+        if timings is None:
+            return None
+        self.current.set(None)
+        timings.duration = timings.elapsed()
+        with self.lock:
+            stats = self.requests.setdefault((timings.route, timings.method), LatencyStats())
+            stats.observe(timings.duration)
+        return timings
+
+    def current_request(self):
+        return self.current.get()
+
+    def record_storage(self, operation, seconds):
+        """ Records a storage operation under the route of the current request.
+        Args:
+            operation: Name of the storage operation (e.g. 'download_as_bytes').
+            seconds: Duration of the operation.
+        """
+        timings = self.current.get()
+        route, method = (timings.route, timings.method) if timings else (BACKGROUND_ROUTE, "")
+        with self.lock:
+            stats = self.storage.setdefault((route, method, operation), LatencyStats())
+            stats.observe(seconds)
+            if timings:
+                entry = timings.storage.setdefault(operation, [0, 0.0])
+                entry[0] += 1
+                entry[1] += seconds
+
+    @contextmanager
+    def time_storage(self, operation):
+        """ Times the storage operation run inside the with block, also when it raises."""
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record_storage(operation, self.clock() - start)
+
+    def add_collector(self, collector):
+        """ Adds a function that returns extra samples to render, as (name, type, help, value) tuples.
+            The name may end with labels, e.g. 'wiki_json_cache_hits_total{prefix="pages/"}'.
+        """
+        self.collectors.append(collector)
+
+    def render(self):
+        """ Renders every metric in the Prometheus text format."""
+        lines = []
+        with self.lock:
+            requests = sorted(self.requests.items())
+            storage = sorted(self.storage.items())
+
+            lines.append("# HELP wiki_request_duration_seconds Duration of the requests of every route.")
+            lines.append("# TYPE wiki_request_duration_seconds histogram")
+            for (route, method), stats in requests:
+                render_histogram(lines, "wiki_request_duration_seconds", f'route="{route}",method="{method}"', stats)
+            render_quantiles(lines, "wiki_request_duration_quantile_seconds",
+                             "Duration quantiles of the latest requests of every route.",
+                             [(f'route="{route}",method="{method}"', stats) for (route, method), stats in requests])
+
+            lines.append("# HELP wiki_storage_operation_seconds Duration of the storage operations made by every route.")
+            lines.append("# TYPE wiki_storage_operation_seconds histogram")
+            for (route, method, operation), stats in storage:
+                render_histogram(lines, "wiki_storage_operation_seconds",
+                                 f'route="{route}",method="{method}",operation="{operation}"', stats)
+            render_quantiles(lines, "wiki_storage_operation_quantile_seconds",
+                             "Duration quantiles of the latest storage operations made by every route.",
+                             [(f'route="{route}",method="{method}",operation="{operation}"', stats)
+                              for (route, method, operation), stats in storage])
+
+        described = set()
+        for collector in self.collectors:
+            for name, type, help, value in collector():
+                # samples of the same metric with different labels share its description
+                family = name.split("{")[0]
+                if family not in described:
+                    described.add(family)
+                    lines.append(f"# HELP {family} {help}")
+                    lines.append(f"# TYPE {family} {type}")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def render_histogram(lines, name, labels, stats):
+    for bound, count in zip(stats.buckets, stats.bucket_counts):
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {stats.count}')
+    lines.append(f"{name}_sum{{{labels}}} {stats.sum:.6f}")
+    lines.append(f"{name}_count{{{labels}}} {stats.count}")
+
+
+def render_quantiles(lines, name, help, labelled_stats):
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} gauge")
+    for labels, stats in labelled_stats:
+        for q in QUANTILES:
+            lines.append(f'{name}{{{labels},quantile="{q}"}} {stats.quantile(q):.6f}')
+
+
+class InstrumentedClient:
+    '''Wraps a storage client so every operation of its buckets and blobs is recorded in a Metrics.'''
+
+    def __init__(self, client, metrics):
+        self.client = client
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def get_bucket(self, name):
+        with self.metrics.time_storage("get_bucket"):
+            bucket = self.client.get_bucket(name)
+        return InstrumentedBucket(bucket, self.metrics)
+
+
+class InstrumentedBucket:
+
+    def __init__(self, bucket, metrics):
+        self.bucket = bucket
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.bucket, name)
+
+    def blob(self, name):
+        # only creates a handle, nothing is read from the storage
+        return InstrumentedBlob(self.bucket.blob(name), self.metrics)
+
+    def get_blob(self, name):
+        with self.metrics.time_storage("get_blob"):
+            blob = self.bucket.get_blob(name)
+        return None if blob is None else InstrumentedBlob(blob, self.metrics)
+
+    def list_blobs(self, *args, **kwargs):
+        return InstrumentedListing(self.bucket.list_blobs(*args, **kwargs), self.metrics)
+
+
+class InstrumentedListing:
+    '''The blobs returned by list_blobs, the pages are read and timed when the listing is iterated.'''
+
+    def __init__(self, listing, metrics):
+        self.listing = listing
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.listing, name)
+
+    def __iter__(self):
+        with self.metrics.time_storage("list_blobs"):
+            blobs = list(self.listing)
+        return (InstrumentedBlob(blob, self.metrics) for blob in blobs)
+
+
+def timed(operation):
+    def method(self, *args, **kwargs):
+        with self.metrics.time_storage(operation):
+            return getattr(self.blob, operation)(*args, **kwargs)
+    method.__name__ = operation
+    return method
+
+
+class InstrumentedBlob:
+
+    def __init__(self, blob, metrics):
+        self.blob = blob
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.blob, name)
+
+    exists = timed("exists")
+    reload = timed("reload")
+    open = timed("open")
+    download_as_bytes = timed("download_as_bytes")
+    download_as_string = timed("download_as_string")
+    download_as_text = timed("download_as_text")
+    upload_from_string = timed("upload_from_string")
+    upload_from_file = timed("upload_from_file")
+    delete = timed("delete")
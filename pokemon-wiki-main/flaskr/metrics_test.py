@@ -0,0 +1,116 @@
+from flaskr.metrics import Metrics, LatencyStats, InstrumentedClient
+from flaskr.blob_store import StorageClient, MemoryStore
+from unittest.mock import MagicMock
+import pytest
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def metrics(clock):
+    return Metrics(clock)
+
+
+def test_latency_stats_quantiles():
+    stats = LatencyStats(buckets=(0.01, 0.1))
+    for ms in range(1, 101):
+        stats.observe(ms / 1000)
+    assert stats.quantile(0.5) == 0.051
+    assert stats.quantile(0.99) == 0.1
+    assert stats.bucket_counts == [10, 100]
+    assert stats.count == 100
+
+
+def test_latency_stats_window():
+    stats = LatencyStats(window=2)
+    for seconds in (5, 1, 2):
+        stats.observe(seconds)
+    assert stats.quantile(0.99) == 2
+    assert stats.count == 3
+
+
+def test_storage_operations_recorded_per_request(metrics, clock):
+    storage = StorageClient(MemoryStore())
+    storage.get_bucket("wiki").blob("pages/abra").upload_from_string("abra")
+    bucket = InstrumentedClient(storage, metrics).get_bucket("wiki")
+
+    metrics.start_request("/pages/<pokemon>", "GET")
+    clock.now = 1.0
+    blob = bucket.get_blob("pages/abra")
+    assert blob.download_as_bytes() == b"abra"
+    assert blob.generation == 1
+    assert [blob.name for blob in bucket.list_blobs(prefix="pages/")] == ["pages/abra"]
+    clock.now = 1.5
+    timings = metrics.end_request()
+
+    assert timings.storage == {"get_blob": [1, 0.0], "download_as_bytes": [1, 0.0], "list_blobs": [1, 0.0]}
+    assert timings.duration == 1.5
+    assert metrics.requests[("/pages/<pokemon>", "GET")].count == 1
+    assert metrics.storage[("/pages/<pokemon>", "GET", "get_blob")].count == 1
+
+
+def test_storage_operation_outside_request(metrics):
+    client = InstrumentedClient(StorageClient(MemoryStore()), metrics)
+    client.get_bucket("wiki").blob("user_game_ranking/ranks_list.json").upload_from_string("[]")
+    assert metrics.storage[("background", "", "upload_from_string")].count == 1
+
+
+def test_failed_storage_operation_is_recorded(metrics):
+    blob = MagicMock()
+    blob.download_as_bytes.side_effect = Exception("storage unavailable")
+    bucket = MagicMock()
+    bucket.get_blob.return_value = blob
+    client = MagicMock()
+    client.get_bucket.return_value = bucket
+    with pytest.raises(Exception):
+        InstrumentedClient(client, metrics).get_bucket("wiki").get_blob("pokedex.json").download_as_bytes()
+    assert metrics.storage[("background", "", "download_as_bytes")].count == 1
+
+
+def test_server_timing(metrics, clock):
+    metrics.start_request("/game", "POST")
+    metrics.record_storage("upload_from_string", 0.004)
+    metrics.record_storage("upload_from_string", 0.002)
+    metrics.record_storage("get_blob", 0.001)
+    clock.now = 0.0125
+    assert metrics.current_request().server_timing() == (
+        'storage-get_blob;desc="1 calls";dur=1.0, '
+        'storage-upload_from_string;desc="2 calls";dur=6.0, '
+        'total;dur=12.5')
+
+
+def test_render(metrics, clock):
+    metrics.start_request("/game", "GET")
+    metrics.record_storage("get_blob", 0.002)
+    clock.now = 0.02
+    metrics.end_request()
+    metrics.add_collector(lambda: [("wiki_image_cache_hits_total", "counter", "Images served from the image cache.", 7)])
+    text = metrics.render()
+    assert 'wiki_request_duration_seconds_bucket{route="/game",method="GET",le="0.025"} 1' in text
+    assert 'wiki_request_duration_seconds_count{route="/game",method="GET"} 1' in text
+    assert 'wiki_request_duration_quantile_seconds{route="/game",method="GET",quantile="0.99"} 0.020000' in text
+    assert 'wiki_storage_operation_seconds_count{route="/game",method="GET",operation="get_blob"} 1' in text
+    assert "wiki_image_cache_hits_total 7" in text
+
+
+def test_render_labelled_collector_samples(metrics):
+    metrics.add_collector(lambda: [
+        ('wiki_json_cache_hits_total{prefix="pages/"}', "counter", "Json blobs served from the cache.", 3),
+        ('wiki_json_cache_hits_total{prefix="user_game_ranking/seen/"}', "counter", "Json blobs served from the cache.", 1),
+    ])
+    text = metrics.render()
+    assert text.count("# HELP wiki_json_cache_hits_total Json blobs served from the cache.") == 1
+    assert text.count("# TYPE wiki_json_cache_hits_total counter") == 1
+    assert 'wiki_json_cache_hits_total{prefix="pages/"} 3' in text
+    assert 'wiki_json_cache_hits_total{prefix="user_game_ranking/seen/"} 1' in text
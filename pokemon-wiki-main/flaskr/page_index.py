@@ -0,0 +1,332 @@
+"""This module contains the in-memory index of user generated pages used by the search filter.
+
+The index maps every category value (type, region and nature) to the set of page names that
+have it and keeps the (level, page name) pairs of all pages sorted, so filtering becomes a
+set intersection and sorting by level does not need to look at the page blobs again. The
+lowercased pokemon names are kept sorted as well, so the pages whose name starts with a
+prefix are a contiguous range found by bisection.
+
+Typical Usage:
+index = PageIndex()
+index.add('pages/charmander', {"name": "Charmander", "type": "Fire", "level": "15", ...})
+pages = index.search(None, 'Fire', None, None, 'LowestToHighest')
+suggestions = index.suggest('char', 10)
+
+Results can also be read one page at a time. The cursor of a page is the sort key of its first or
+last page name (the page name itself, or its (level, page name) pair when sorting by level), so a
+cursor stays valid when pages are uploaded or removed between requests. Unsorted results are listed
+by page name, like the storage lists the page blobs. A page of results is found by bisecting the
+pages in name or level order to the cursor and walking from there until enough pages match, so it
+does not cost more the further the cursor is.
+
+result = index.search_page(None, 'Fire', None, None, None, limit=50)
+more = index.search_page(None, 'Fire', None, None, None, limit=50, cursor=result.next_cursor)
+"""
+
+from bisect import insort, bisect_left, bisect_right
+import base64
+import binascii
+import json
+
+CATEGORIES = ("type", "region", "nature")
+MIN_LEVEL = 1
+MAX_LEVEL = 100
+SORTINGS = ("LowestToHighest", "HighestToLowest")
+
+
+def parse_level(value):
+    """ Returns the level of a page as an int, or None if it is missing or not a whole number."""
+    try:
+        return int(str(value).strip())
+    except ValueError:
+        return None
+
+
+class ResultPage:
+    '''One page of search results and the cursors of the pages around it.'''
+
+    def __init__(self, pages, next_cursor=None, prev_cursor=None):
+        '''ResultPage constructor.
+
+           Args:
+            pages: The page names of this page of results.
+            next_cursor: Opaque cursor of the following page, or None if this is the last page.
+            prev_cursor: Opaque cursor of the preceding page, or None if this is the first page.
+        '''
+        self.pages = pages
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.pages)
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __eq__(self, other):
+        if not isinstance(other, ResultPage):
+            return NotImplemented
+        return (self.pages, self.next_cursor, self.prev_cursor) == (other.pages, other.next_cursor, other.prev_cursor)
+
+    def __repr__(self):
+        return f"ResultPage({self.pages!r}, next_cursor={self.next_cursor!r}, prev_cursor={self.prev_cursor!r})"
+
+
+def encode_cursor(sorting, direction, key):
+    """ Encodes the position of a page of results as an url safe string.
+    Args:
+        sorting: The sorting of the results, the cursor is only valid for the same sorting.
+        direction: "after" to continue after the key, "before" to go back before it.
+        key: The sort key of the page name the cursor points at.
+    Returns:
+        The opaque cursor.
+    """
+    data = json.dumps({"s": sorting or "", "d": direction, "k": list(key)}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, sorting):
+    """ Decodes a cursor made by encode_cursor.
+    Args:
+        cursor: The opaque cursor.
+        sorting: The sorting of the results being paged.
+    Returns:
+        Tuple with the direction and the sort key, or None if the cursor is malformed or was made for another sorting.
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if data["s"] != (sorting or "") or data["d"] not in ("after", "before"):
+            return None
+        return data["d"], tuple(data["k"])
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        return None
+
+
+class PageIndex:
+
+    def __init__(self):
+        self.loaded = False
+        self.generation = None  # generation of the manifest the index was loaded from
+        self.names = {}  # page name -> lowercased pokemon name
+        self.levels = {}  # page name -> level
+        self.facets = {category: {} for category in CATEGORIES}  # category -> value -> set of page names
+        self.values = {}  # page name -> {category: value}
+        self.sorted_levels = []  # (level, page name) pairs kept in ascending order
+        self.sorted_names = []  # (lowercased pokemon name, page name) pairs kept in ascending order
+        self.listing = []  # (page name,) keys kept in ascending order, the order the storage lists the pages in
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, page_name):
+        return page_name in self.names
+
+    def add(self, page_name, pokemon_data):
+        """ Adds a page to the index, replacing it if it was already indexed.
+        Args:
+            page_name: The blob name of the page (e.g. 'pages/charmander').
+            pokemon_data: A dictionary with the data of the page.
+        """
+        if page_name in self.names:
+            self.remove(page_name)
+
+        # pages stored with a broken level are still listed, they sort as level 0
+        level = parse_level(pokemon_data.get("level"))
+        if level is None:
+            level = 0
+        name = (pokemon_data.get("name") or "").lower()
+        self.names[page_name] = name
+        self.levels[page_name] = level
+        self.values[page_name] = {}
+        for category in CATEGORIES:
+            value = pokemon_data.get(category)
+            self.values[page_name][category] = value
+            self.facets[category].setdefault(value, set()).add(page_name)
+        insort(self.sorted_levels, (level, page_name))
+        insort(self.sorted_names, (name, page_name))
+        insort(self.listing, (page_name,))
+
+    def remove(self, page_name):
+        """ Removes a page from the index if it is there.
+        Args:
+            page_name: The blob name of the page.
+        """
+        if page_name not in self.names:
+            return
+        for category, value in self.values.pop(page_name).items():
+            pages = self.facets[category][value]
+            pages.discard(page_name)
+            if not pages:
+                del self.facets[category][value]
+        level = self.levels.pop(page_name)
+        del self.sorted_levels[bisect_left(self.sorted_levels, (level, page_name))]
+        name = self.names.pop(page_name)
+        del self.sorted_names[bisect_left(self.sorted_names, (name, page_name))]
+        del self.listing[bisect_left(self.listing, (page_name,))]
+
+    def clear(self):
+        """ Empties the index so it can be loaded again."""
+        self.__init__()
+
+    def suggest(self, prefix, limit):
+        """ Finds the pages whose pokemon name starts with a prefix, ignoring case.
+        Args:
+            prefix: The start of the pokemon name.
+            limit: Maximum number of pages returned.
+        Returns:
+            List of up to limit (lowercased pokemon name, page name) pairs in alphabetical order.
+        """
+        prefix = prefix.lower()
+        start = bisect_left(self.sorted_names, (prefix,))
+        # the names with the prefix are the ones right after the insertion point of the prefix
+        suggestions = []
+        for name, page_name in self.sorted_names[start:start + limit]:
+            if not name.startswith(prefix):
+                break
+            suggestions.append((name, page_name))
+        return suggestions
+
+    def filter(self, name, type, region, nature, within=None):
+        """ Finds the pages that match every given filter.
+        Args:
+            name: Part of the pokemon name, or None.
+            type: The type of the pokemon, or None.
+            region: The region of the pokemon, or None.
+            nature: The nature of the pokemon, or None.
+            within: Set of page names the matches are restricted to (e.g. the results of a text search), or None.
+        Returns:
+            The set of matching page names.
+        """
+        selected = [(category, value) for category, value in zip(CATEGORIES, (type, region, nature)) if value is not None]
+        facet_sets = [self.facets[category].get(value, set()) for category, value in selected]
+        if within is not None:
+            facet_sets.append(within)
+        # intersecting the smallest sets first keeps the intermediate results small
+        facet_sets.sort(key=len)
+
+        if facet_sets:
+            matches = set(facet_sets[0])
+            for pages in facet_sets[1:]:
+                matches &= pages
+            # the given set may name pages that are not indexed (yet)
+            if within is not None:
+                matches &= self.names.keys()
+        else:
+            matches = set(self.names)
+
+        if name is not None:
+            name = name.lower()
+            matches = {page for page in matches if name in self.names[page]}
+
+        return matches
+
+    def search(self, name, type, region, nature, sorting, within=None):
+        """ Finds the pages that match every given filter in the requested order.
+        Args:
+            name: Part of the pokemon name, or None.
+            type: The type of the pokemon, or None.
+            region: The region of the pokemon, or None.
+            nature: The nature of the pokemon, or None.
+            sorting: "LowestToHighest", "HighestToLowest" or None to list the pages by page name.
+            within: Set of page names the matches are restricted to, or None.
+        Returns:
+            page_names: The names of the matching pages.
+        """
+        matches = self.filter(name, type, region, nature, within)
+
+        if sorting == "LowestToHighest":
+            return [page for level, page in self.sorted_levels if page in matches]
+        if sorting == "HighestToLowest":
+            return [page for level, page in reversed(self.sorted_levels) if page in matches]
+
+        return sorted(matches)
+
+    def sort_key(self, page_name, sorting):
+        """ Returns the key the page is ordered by in the results of a sorting."""
+        if sorting in SORTINGS:
+            return (self.levels[page_name], page_name)
+        return (page_name,)
+
+    def search_page(self, name, type, region, nature, sorting, limit, cursor=None, within=None):
+        """ Finds one page of the pages that match every given filter in the requested order.
+        Args:
+            name: Part of the pokemon name, or None.
+            type: The type of the pokemon, or None.
+            region: The region of the pokemon, or None.
+            nature: The nature of the pokemon, or None.
+            sorting: "LowestToHighest", "HighestToLowest" or None to list the pages by page name.
+            limit: Maximum number of page names returned.
+            cursor: A cursor of a previous ResultPage, or None (or an invalid cursor) for the first page.
+            within: Set of page names the matches are restricted to, or None.
+        Returns:
+            A ResultPage with at most limit page names.
+        """
+        keys = self.sorted_levels if sorting in SORTINGS else self.listing
+        if all(value is None for value in (name, type, region, nature, within)):
+            matches = None  # every page matches
+        else:
+            matches = self.filter(name, type, region, nature, within)
+            # walking the ordered pages finds limit matches after about limit * len(keys) / len(matches)
+            # pages, when the matches are that few sorting just them is cheaper
+            if len(matches) ** 2 < limit * len(keys):
+                keys = sorted(self.sort_key(page, sorting) for page in matches)
+                matches = None
+
+        # the results are keys in ascending order, or walked from the end for the highest levels first
+        step = -1 if sorting == "HighestToLowest" else 1
+        position = decode_cursor(cursor, sorting) if cursor else None
+        if position is not None:
+            direction, key = position
+            try:
+                after, before = bisect_right(keys, key), bisect_left(keys, key) - 1
+            except TypeError:  # a tampered key that does not compare with the sort keys
+                position = None
+            else:
+                if step == -1:
+                    after, before = before, after
+        if position is None:
+            start = 0 if step == 1 else len(keys) - 1
+            found = walk(keys, start, step, matches, limit + 1)
+            return self.result_page(sorting, found[:limit], len(found) > limit, False)
+
+        if direction == "after":
+            found = walk(keys, after, step, matches, limit + 1)
+            has_previous = bool(walk(keys, after - step, -step, matches, 1))
+            return self.result_page(sorting, found[:limit], len(found) > limit, has_previous)
+
+        found = walk(keys, before, -step, matches, limit + 1)
+        if len(found) < limit:
+            # fewer than limit results come before the cursor, so this is the first page
+            found = walk(keys, 0 if step == 1 else len(keys) - 1, step, matches, limit + 1)
+            return self.result_page(sorting, found[:limit], len(found) > limit, False)
+        has_next = bool(walk(keys, before + step, step, matches, 1))
+        return self.result_page(sorting, found[limit - 1::-1], has_next, len(found) > limit)
+
+    def result_page(self, sorting, pages, has_next, has_previous):
+        next_cursor = prev_cursor = None
+        if pages and has_next:
+            next_cursor = encode_cursor(sorting, "after", self.sort_key(pages[-1], sorting))
+        if pages and has_previous:
+            prev_cursor = encode_cursor(sorting, "before", self.sort_key(pages[0], sorting))
+        return ResultPage(pages, next_cursor, prev_cursor)
+
+
+def walk(keys, start, step, matches, count):
+    """ Collects the page names of up to count keys that match, going through keys from start one step at a time.
+    Args:
+        keys: List of sort keys, the page name is the last item of every key.
+        start: Index of the first key looked at.
+        step: 1 to walk forward, -1 to walk backward.
+        matches: Set of the page names that match, or None if every page matches.
+        count: Maximum number of page names collected.
+    Returns:
+        The matching page names in walking order.
+    """
+    pages = []
+    i = start
+    while 0 <= i < len(keys) and len(pages) < count:
+        page = keys[i][-1]
+        if matches is None or page in matches:
+            pages.append(page)
+        i += step
+    return pages
@@ -0,0 +1,162 @@
+from flaskr.page_index import PageIndex, ResultPage, encode_cursor
+import pytest
+
+
+@pytest.fixture
+def index():
+    index = PageIndex()
+    index.add("pages/charmander", {"name": "Charmander", "type": "Fire", "region": "Kanto", "nature": "Brave", "level": "15"})
+    index.add("pages/chikorita", {"name": "Chikorita", "type": "Grass", "region": "Johto", "nature": "Quirky", "level": "8"})
+    index.add("pages/mudkip", {"name": "Mudkip", "type": "Water", "region": "Hoenn", "nature": "Naive", "level": "12"})
+    index.add("pages/blaziken", {"name": "Blaziken", "type": "Fire", "region": "Hoenn", "nature": "Bashful", "level": "55"})
+    return index
+
+
+def test_filter_intersects_categories(index):
+    assert index.filter(None, "Fire", "Hoenn", None) == {"pages/blaziken"}
+    assert index.filter(None, "Fire", "Johto", None) == set()
+
+
+def test_filter_unknown_value(index):
+    assert index.filter(None, "Dragon", None, None) == set()
+
+
+def test_search_lists_by_page_name(index):
+    assert index.search(None, "Fire", None, None, None) == ["pages/blaziken", "pages/charmander"]
+    # a new page is listed in its place, not after the pages added before it
+    index.add("pages/abra", {"name": "Abra", "type": "Fire", "region": "Kanto", "nature": "Calm", "level": "16"})
+    assert index.search(None, "Fire", None, None, None) == ["pages/abra", "pages/blaziken", "pages/charmander"]
+
+
+def test_search_by_name(index):
+    assert index.search("CH", None, None, None, None) == ["pages/charmander", "pages/chikorita"]
+
+
+def test_search_sorted_by_level(index):
+    assert index.search(None, None, None, None, "LowestToHighest") == ["pages/chikorita", "pages/mudkip", "pages/charmander", "pages/blaziken"]
+    assert index.search(None, None, "Hoenn", None, "HighestToLowest") == ["pages/blaziken", "pages/mudkip"]
+
+
+def test_search_equal_levels_sorted_by_name(index):
+    index.add("pages/abra", {"name": "Abra", "type": "Psychic", "region": "Kanto", "nature": "Calm", "level": "15"})
+    assert index.search(None, None, "Kanto", None, "LowestToHighest") == ["pages/abra", "pages/charmander"]
+    assert index.search(None, None, "Kanto", None, "HighestToLowest") == ["pages/charmander", "pages/abra"]
+
+
+def test_add_replaces_page(index):
+    index.add("pages/mudkip", {"name": "Mudkip", "type": "Ground", "region": "Hoenn", "nature": "Naive", "level": "99"})
+    assert len(index) == 4
+    assert index.filter(None, "Water", None, None) == set()
+    assert index.search(None, None, None, None, "HighestToLowest")[0] == "pages/mudkip"
+    assert index.search(None, None, "Hoenn", None, None) == ["pages/blaziken", "pages/mudkip"]
+
+
+def test_remove(index):
+    index.remove("pages/charmander")
+    assert "pages/charmander" not in index
+    assert index.search(None, "Fire", None, None, "LowestToHighest") == ["pages/blaziken"]
+    assert "Kanto" not in index.facets["region"]
+
+
+def read_all_pages(index, sorting, limit, **filters):
+    pages, cursor = [], None
+    while True:
+        result = index.search_page(filters.get("name"), filters.get("type"), filters.get("region"), filters.get("nature"),
+                                   sorting, limit, cursor)
+        pages.extend(result.pages)
+        if result.next_cursor is None:
+            return pages
+        cursor = result.next_cursor
+
+
+@pytest.mark.parametrize("sorting", [None, "LowestToHighest", "HighestToLowest"])
+def test_search_page_walks_every_result(index, sorting):
+    index.add("pages/abra", {"name": "Abra", "type": "Psychic", "region": "Kanto", "nature": "Calm", "level": "15"})
+    for limit in (1, 2, 3, 5, 10):
+        assert read_all_pages(index, sorting, limit) == index.search(None, None, None, None, sorting)
+
+
+@pytest.mark.parametrize("sorting", [None, "LowestToHighest", "HighestToLowest"])
+@pytest.mark.parametrize("type", [None, "Fire", "Grass"])
+def test_search_page_walks_back_every_result(sorting, type):
+    index = PageIndex()
+    for i in range(40):
+        index.add(f"pages/p{i:02}", {"name": f"P{i}", "type": ("Fire", "Water", "Fire", "Grass")[i % 4],
+                                     "region": "Kanto", "nature": "Calm", "level": str(i * 7 % 11)})
+    results = index.search(None, type, None, None, sorting)
+    for limit in (1, 3, 4, 7):
+        result = index.search_page(None, type, None, None, sorting, limit)
+        while result.next_cursor is not None:
+            result = index.search_page(None, type, None, None, sorting, limit, result.next_cursor)
+        # going back from the last page gives every result again, the first page is always full
+        pages = result.pages
+        while result.prev_cursor is not None:
+            result = index.search_page(None, type, None, None, sorting, limit, result.prev_cursor)
+            pages = result.pages + pages
+        assert result.pages == results[:limit]
+        assert pages[-len(results):] == results
+
+
+def test_search_page_cursors(index):
+    first = index.search_page(None, None, None, None, None, 2)
+    assert first.pages == ["pages/blaziken", "pages/charmander"]
+    assert first.prev_cursor is None
+
+    second = index.search_page(None, None, None, None, None, 2, first.next_cursor)
+    assert second.pages == ["pages/chikorita", "pages/mudkip"]
+    assert second.next_cursor is None
+
+    assert index.search_page(None, None, None, None, None, 2, second.prev_cursor) == first
+
+
+def test_search_page_filtered(index):
+    result = index.search_page(None, None, "Hoenn", None, "HighestToLowest", 1)
+    assert result == ResultPage(["pages/blaziken"], result.next_cursor, None)
+    assert index.search_page(None, None, "Hoenn", None, "HighestToLowest", 1, result.next_cursor).pages == ["pages/mudkip"]
+
+
+def test_search_page_cursor_survives_changes(index):
+    first = index.search_page(None, None, None, None, "LowestToHighest", 2)
+    assert first.pages == ["pages/chikorita", "pages/mudkip"]
+    index.remove("pages/mudkip")
+    index.add("pages/abra", {"name": "Abra", "type": "Psychic", "region": "Kanto", "nature": "Calm", "level": "1"})
+    # the next page starts after the last name shown, not after the second result
+    assert index.search_page(None, None, None, None, "LowestToHighest", 2, first.next_cursor).pages == ["pages/charmander", "pages/blaziken"]
+
+
+@pytest.mark.parametrize("cursor", ["not a cursor", encode_cursor("LowestToHighest", "after", (8, "pages/chikorita")),
+                                    encode_cursor(None, "after", (3,))])
+def test_search_page_invalid_cursor_starts_over(index, cursor):
+    assert index.search_page(None, None, None, None, None, 2, cursor).pages == ["pages/blaziken", "pages/charmander"]
+
+
+def test_search_within(index):
+    within = {"pages/blaziken", "pages/mudkip", "pages/unknown"}
+    assert index.search(None, None, None, None, None, within) == ["pages/blaziken", "pages/mudkip"]
+    assert index.search(None, "Fire", None, None, None, within) == ["pages/blaziken"]
+    assert index.search(None, None, None, None, None, set()) == []
+    assert index.search_page(None, None, None, None, "LowestToHighest", 1, within=within).pages == ["pages/mudkip"]
+
+
+def test_suggest(index):
+    index.add("pages/charizard", {"name": "Charizard", "type": "Fire", "region": "Kanto", "nature": "Brave", "level": "36"})
+    assert index.suggest("CHAR", 10) == [("charizard", "pages/charizard"), ("charmander", "pages/charmander")]
+    assert index.suggest("ch", 2) == [("charizard", "pages/charizard"), ("charmander", "pages/charmander")]
+    assert index.suggest("mudkip", 10) == [("mudkip", "pages/mudkip")]
+    assert index.suggest("mudkips", 10) == []
+    assert index.suggest("zz", 10) == []
+
+
+def test_suggest_follows_changes(index):
+    index.remove("pages/chikorita")
+    index.add("pages/charmander", {"name": "Charmeleon", "type": "Fire", "region": "Kanto", "nature": "Brave", "level": "16"})
+    assert index.suggest("ch", 10) == [("charmeleon", "pages/charmander")]
+    assert len(index.sorted_names) == len(index)
+
+
+def test_add_tolerates_broken_level(index):
+    index.add("pages/abra", {"name": "Abra", "type": "Psychic", "region": "Kanto", "nature": "Calm", "level": "abc"})
+    index.add("pages/mew", {"name": "Mew", "type": "Psychic", "region": "Kanto", "nature": "Calm", "level": None})
+    assert index.search(None, "Psychic", None, None, "LowestToHighest") == ["pages/abra", "pages/mew"]
+    index.remove("pages/abra")
+    assert "pages/abra" not in index
@@ -1,5 +1,11 @@
-from flask import render_template, request, json, flash, abort, redirect, url_for
-from .backend import Backend
+from flask import render_template, request, json, jsonify, flash, abort, redirect, url_for, Response
+from flask import session as flask_session
+from .backend import Backend, POKEBALL_PATH, JSON_CACHE_POLICIES, IMAGE_TYPES, pokemon_image_path
+from .async_backend import AsyncBackend
+from .blob_cache import BlobCache
+from .blob_store import make_client
+from .page_index import parse_level, MIN_LEVEL, MAX_LEVEL
+from .metrics import Metrics
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, PasswordField, validators
 from .user import User
@@ -7,7 +13,11 @@ import flask_login
 from flask_login import LoginManager
 import base64
 import io
-from secrets import randbelow
+import asyncio
+import atexit
+import logging
+import os
+from .game import GameSessions
 '''This module takes care of rendering pages and page functions.
 
    Contains all functions in charge of rendering all pages. Calls backend 
@@ -15,11 +25,59 @@ from secrets import randbelow
    for login and signup. It logsin, signups and logs out users from session. Uploads
    pokemon wiki information to buckets. 
 '''
+logger = logging.getLogger(__name__)
+
 MAX_ID = 386
+IMAGE_MAX_AGE = 3600  # seconds browsers may use an image before revalidating it
+IMAGE_CHUNK_SIZE = 64 * 1024
+PAGE_SIZE = 50  # page names listed per page of /pages
+SUGGESTIONS = 10  # suggestions returned by /api/pages/suggest unless k asks for another number
+MAX_SUGGESTIONS = 50
 
 login_manager = LoginManager(
 )  # Lets the app and Flask-Login work together for user loading, login, etc.
-backend = Backend()
+# WIKI_STORAGE picks where the blobs are kept, e.g. 'local:/tmp/wiki-data' to run without the cloud storage
+metrics = Metrics()  # storage operations and durations of every route, served on /metrics
+backend = Backend(client=make_client(os.environ.get("WIKI_STORAGE", "gcs")), derive_ranks=True, metrics=metrics,
+                  blob_cache=BlobCache(JSON_CACHE_POLICIES))
+# rank updates still queued when the process stops are written before it exits
+atexit.register(backend.flush_user_ranks)
+
+# runs the backend calls of the async views on a thread pool shared by every request
+async_backend = AsyncBackend(backend)
+
+game_sessions = GameSessions(backend)  # seen pokemon, points and rank of every player
+
+
+def cache_metrics():
+    '''Returns the image cache, user cache, json cache and game prefetch counters as metric samples.'''
+    image_cache = backend.image_cache.stats()
+    user_cache = backend.user_cache.stats()
+    prefetch = game_sessions.stats()
+    json_cache = []
+    for prefix, stats in backend.blob_cache.stats().items():
+        labels = f'{{prefix="{prefix}"}}'
+        json_cache += [
+            (f"wiki_json_cache_hits_total{labels}", "counter", "Json blobs served from the cache without asking the storage.", stats["hits"]),
+            (f"wiki_json_cache_stale_hits_total{labels}", "counter", "Stale json blobs served while they were revalidated in the background.", stats["stale_hits"]),
+            (f"wiki_json_cache_revalidations_total{labels}", "counter", "Cached json blobs whose generation had not changed.", stats["revalidations"]),
+            (f"wiki_json_cache_misses_total{labels}", "counter", "Json blobs downloaded from the storage.", stats["misses"]),
+            (f"wiki_json_cache_evictions_total{labels}", "counter", "Json blobs evicted from a full cache.", stats["evictions"]),
+            (f"wiki_json_cache_entries{labels}", "gauge", "Json blobs held by the cache.", stats["entries"]),
+        ]
+    return json_cache + [
+        ("wiki_image_cache_hits_total", "counter", "Images served from the image cache.", image_cache["hits"]),
+        ("wiki_image_cache_misses_total", "counter", "Images downloaded from the storage.", image_cache["misses"]),
+        ("wiki_image_cache_bytes", "gauge", "Bytes held by the image cache.", image_cache["bytes"]),
+        ("wiki_user_cache_hits_total", "counter", "Users loaded from the user cache.", user_cache["hits"]),
+        ("wiki_user_cache_misses_total", "counter", "Users read from the password bucket.", user_cache["misses"]),
+        ("wiki_user_cache_hit_rate", "gauge", "Share of user loads served from the user cache.", round(user_cache["hit_rate"], 4)),
+        ("wiki_game_prefetch_hits_total", "counter", "Game rounds served from a prefetched round.", prefetch["prefetch_hits"]),
+        ("wiki_game_prefetch_misses_total", "counter", "Game rounds loaded on request.", prefetch["prefetch_misses"]),
+    ]
+
+
+metrics.add_collector(cache_metrics)
 
 @login_manager.user_loader
 def load_user(username):
@@ -34,6 +92,15 @@ def load_user(username):
     return backend.get_user(username)
 
 
+def stream_image(blob):
+    '''Yields the bytes of an image blob in chunks so large images are never fully held in memory.'''
+    with blob.open('rb') as f:
+        chunk = f.read(IMAGE_CHUNK_SIZE)
+        while chunk:
+            yield chunk
+            chunk = f.read(IMAGE_CHUNK_SIZE)
+
+
 def make_endpoints(app):
 
     class LoginForm(FlaskForm):
@@ -52,50 +119,125 @@ def make_endpoints(app):
                                  render_kw={"placeholder": "Password"})
         submit = SubmitField('Signup')
 
+    @app.before_request
+    def start_request_metrics():
+        '''Starts timing the request, storage operations made while handling it are recorded under its route.'''
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.start_request(route, request.method)
+
+    @app.after_request
+    def add_server_timing(response):
+        '''Tells the browser how long the storage operations of the request took.'''
+        timings = metrics.current_request()
+        if timings is not None:
+            response.headers["Server-Timing"] = timings.server_timing()
+        return response
+
+    # teardown functions run in reverse order, so the request is timed until the rank flush below is done
+    @app.teardown_request
+    def end_request_metrics(exception=None):
+        metrics.end_request()
+
+    @app.teardown_request
+    def flush_user_ranks(exception=None):
+        '''Writes the rank updates queued while handling the request, even if the request failed.'''
+        backend.flush_user_ranks()
+
     # Flask uses the "app.route" decorator to call methods when users
     # go to a specific route on the project's website.
     @app.route("/")
     def home():
         # TODO(Checkpoint Requirement 2 of 3): Change this to use render_template
         # to render main.html on the home page.
-        image = backend.get_image('authors/logo.jpg')
-        return render_template('main.html', image=image)
+        return render_template('main.html', image='authors/logo.jpg')
 
     # TODO(Project 1): Implement additional routes according to the project requirements.
     @app.route("/about")
     def about():
         images = [
-            backend.get_image('authors/javier.png'),
-            backend.get_image('authors/edgar.png'),
-            backend.get_image('authors/mark.png')
+            'authors/javier.png',
+            'authors/edgar.png',
+            'authors/mark.png'
         ]
         return render_template('about.html', images=images)
 
+    @app.route("/images/<path:blob_name>")
+    def image(blob_name):
+        '''Serves an image blob with caching headers.
+
+           The ETag is taken from the blob md5 (or its generation), so when the browser
+           already has the current image it gets a 304 Not Modified and the image is
+           not downloaded from the cloud storage at all.
+
+           Only the IMAGE_TYPES are shown by the browser, any other blob is sent as a
+           download so it never runs as a page of the wiki.
+        '''
+        blob = backend.get_image_blob(blob_name)
+        if not blob:
+            abort(404)
+
+        etag = blob.md5_hash or str(blob.generation)
+        inline = blob.content_type in IMAGE_TYPES
+        mimetype = blob.content_type if inline else "application/octet-stream"
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        elif blob.size > backend.image_cache.max_bytes:
+            # too big for the image cache, stream it straight from the cloud storage
+            response = Response(stream_image(blob), mimetype=mimetype)
+            response.content_length = blob.size
+        else:
+            response = Response(backend.get_image_bytes(blob_name, blob), mimetype=mimetype)
+
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = IMAGE_MAX_AGE
+        response.headers["X-Content-Type-Options"] = "nosniff"
+        if not inline:
+            response.headers["Content-Disposition"] = "attachment"
+        return response
+
     @app.route("/pages", methods=['GET', 'POST'])
     def pages():
+        '''Lists the wiki pages that match the search and filters, PAGE_SIZE names at a time.
+
+           The filters are posted by the filter form, the next and previous links carry them
+           in the query string together with the cursor of the page to show.
+        '''
         categories = backend.get_categories()
-        if request.method == "POST":     
-            if request.form["search"] or request.form["sorting"] or request.form.get("type") or request.form.get("region") or request.form.get("nature"):
-                name = request.form.get("search")                
-                type = request.form.get("type")
-                region = request.form.get("region")
-                nature = request.form.get("nature")
-                sorting = request.form.get("sorting")
-                pages = backend.get_pages_using_filter_and_search(name, type, region, nature, sorting)
-                return render_template('pages.html', pages=pages, categories=categories)   
-            else:
-                pages = backend.get_all_page_names()
-                return render_template('pages.html', pages=pages, categories=categories)            
+        values = request.form if request.method == "POST" else request.args
+        filters = {field: values.get(field) or None for field in ("search", "type", "region", "nature", "sorting")}
+        cursor = request.args.get("cursor") if request.method == "GET" else None
+        if any(filters.values()):
+            result = backend.get_pages_using_filter_and_search(filters["search"], filters["type"], filters["region"],
+                                                              filters["nature"], filters["sorting"], limit=PAGE_SIZE,
+                                                              cursor=cursor)
         else:
-            pages = backend.get_all_page_names()
-            return render_template('pages.html', pages=pages, categories=categories)
+            result = backend.get_all_page_names(limit=PAGE_SIZE, cursor=cursor)
+
+        next_url = url_for("pages", cursor=result.next_cursor, **filters) if result.next_cursor else None
+        prev_url = url_for("pages", cursor=result.prev_cursor, **filters) if result.prev_cursor else None
+        return render_template('pages.html', pages=result.pages, categories=categories, next_url=next_url,
+                               prev_url=prev_url)
+
+    @app.route("/api/pages/suggest")
+    def suggest_pages():
+        '''Returns the pages whose pokemon name starts with the q query parameter as json.
+
+           Used by the search box for type-ahead, the answer comes from the in-memory page
+           index without reading the storage. The optional k parameter sets the number of
+           suggestions, up to MAX_SUGGESTIONS.
+        '''
+        prefix = request.args.get("q", "").strip()
+        limit = min(max(request.args.get("k", SUGGESTIONS, type=int), 1), MAX_SUGGESTIONS)
+        suggestions = backend.suggest_pages(prefix, limit) if prefix else []
+        return jsonify({"query": prefix, "suggestions": [{"name": name, "page": page} for name, page in suggestions]})
 
     @app.route("/pages/<pokemon>")
     def wiki(pokemon="abra"):
         poke_string = backend.get_wiki_page(pokemon)
         # pokemon blob is returned as string, turn into json
         pokemon_data = json.loads(poke_string)
-        image = backend.get_image(f'images/{pokemon_data["image-name"]}')
+        image = f'images/{pokemon_data["image-name"]}'
         return render_template("wiki.html", image=image, pokemon=pokemon_data)
 
     @app.route('/login', methods=['GET', 'POST'])
@@ -149,9 +291,15 @@ def make_endpoints(app):
         # User validation
         if form.validate_on_submit():  # Checks if signup form is validated
 
-            register = backend.sign_up(
-                form.username.data,
-                form.password.data)  # Calls backend to create user account
+            try:
+                register = backend.sign_up(
+                    form.username.data,
+                    form.password.data)  # Calls backend to create user account
+            except Exception:
+                # nothing of the account was kept, the user can try again
+                logger.exception("Could not sign up %s", form.username.data)
+                flash('Could not create the account, please try again.')
+                return render_template('signup.html', form=form)
 
             if register:
                 flash('Succesfully created an account.')
@@ -180,6 +328,12 @@ def make_endpoints(app):
 
     @app.route("/upload", methods=["POST"])
     def upload_data():
+        # the level is sorted on by the page index, only whole numbers in the form's range are accepted
+        level = parse_level(request.form.get("level"))
+        if level is None or not MIN_LEVEL <= level <= MAX_LEVEL:
+            flash(f'The level must be a whole number from {MIN_LEVEL} to {MAX_LEVEL}.')
+            return redirect(url_for('upload'))
+
         # dictionary that holds all values from the form, except for the file
         pokemon_data = {
             "name": request.form["name"],
@@ -193,93 +347,101 @@ def make_endpoints(app):
         # json object to be uploaded
         file_to_upload = request.files['file']
 
-        # call backend upload
-        backend.upload(file_to_upload, pokemon_data)
+        # call backend upload, files that are not images are refused before anything is written
+        try:
+            backend.upload(file_to_upload, pokemon_data)
+        except ValueError as e:
+            flash(str(e))
+            return redirect(url_for('upload'))
+        except Exception:
+            # the page was deleted again, the user can try again
+            logger.exception("Could not upload %s", pokemon_data["name"])
+            flash('Could not save the page, please try again.')
+            return redirect(url_for('upload'))
 
         # render pages list
         return redirect(url_for('pages'))
 
     @app.route("/game")
     @flask_login.login_required
-    def play_game(pokemon_id=1):
-        # make sure pokemon_id has not been guessed before
-        seen = backend.get_seen_pokemon(flask_login.current_user.username)
-        pokemon_id = randbelow(MAX_ID)
-        while str(pokemon_id) in seen:
-            pokemon_id = randbelow(MAX_ID)
-
-        # check that image is not a None type
-        pokemon_img = None
-        while pokemon_img == None:
-            pokemon_img = backend.get_pokemon_image(pokemon_id)
-
-        # Get the pokemon and user data
-        pokemon_data = backend.get_pokemon_data(pokemon_id)
-        user = backend.get_game_user(flask_login.current_user.username)
-        pokeball_img = backend.get_pokeball()
+    async def play_game(pokemon_id=1):
+        # the seen pokemon, points and rank are only read from the storage the first time,
+        # the game record and the leaderboard are read at the same time
+        username = flask_login.current_user.username
+        session = game_sessions.lookup(username)
+        if session is None:
+            session = game_sessions.start(username, *await async_backend.get_game(username))
+
+        # pick a pokemon that has not been guessed before, usually loaded after the last guess
+        pokemon_id, pokemon_data = await async_backend.run(game_sessions.next_round, session)
+
+        # every pokemon was seen, the game starts over
+        if pokemon_id is None:
+            with session.lock:
+                game_sessions.start_over(session)
+                pokemon_id = session.next_pokemon()
+            flash('You have seen every pokemon, starting over!')
+            pokemon_data = await async_backend.get_pokemon_data(pokemon_id)
+
+        with session.lock:
+            user = session.user()
+
+        # the served pokemon is kept in the signed session cookie, so the guess can be checked by any server
+        flask_session["game_round"] = pokemon_id
+
+        # the images are loaded by the browser from the image route
+        pokemon_img = pokemon_image_path(pokemon_id)
+        pokeball_img = POKEBALL_PATH
         answer = pokemon_data['name']['english']
 
         # return template
-        return render_template("game.html",image=pokemon_img,data=pokemon_data,user=user,pokeball=pokeball_img,answer=answer,seen=seen)
+        return render_template("game.html",image=pokemon_img,pokemon_id=pokemon_id,user=user,pokeball=pokeball_img,answer=answer)
 
 
     @app.route("/game",methods=["POST"])
     @flask_login.login_required
     def update_user_and_refresh():
         username = flask_login.current_user.username
+        session = game_sessions.get(username)
 
-        # Get pokemon data
-        data = request.form["data"]
-        data = data.replace("\'","\"")
-        data_json = json.loads(data)
+        # Get the id of the pokemon that was shown, only the round that was served can be guessed
+        pokemon_id = int(request.form["pokemon_id"])
+        if flask_session.pop("game_round", None) != pokemon_id:
+            flash('That round is over, here is a new pokemon!')
+            return redirect(url_for("play_game"))
 
-        # Get user guess
+        # Get user guess and look it up in the pokedex, the correct answer is the same pokemon
         user_guess = request.form["user_guess"]
-        user_guess = user_guess.upper()
-
-        # set correct answer and compare to user guess
-        correct_answer = data_json["name"]["english"]
-        correct_answer = correct_answer.upper()
-
-        # modify and clean up points
-        points = int(request.form["points"])
-        if user_guess == correct_answer:
-            points = points + 100
-        elif points - 50 < 0:
-            points = 0
-        else:
-            points = int(points) - 50
-        
-        # update the seen-pokemon list
-        seen = backend.get_seen_pokemon(username)
-        seen_id = data_json['id']
-        seen_id = str(seen_id)
-        seen[seen_id] = True
-        backend.update_seen_pokemon(username,seen)
-
-        # update the user with new points and new rank
-        backend.update_points(username, points) 
+        guessed_id = backend.get_pokemon_id(user_guess)
+
+        with session.lock:
+            # update the points and the seen pokemon, saved in one write of the game record,
+            # a pokemon that was already seen is not scored again so a replayed guess earns nothing
+            scored = game_sessions.guess(session, pokemon_id, guessed_id == pokemon_id)
+        if not scored:
+            flash('That round is over, here is a new pokemon!')
+
+        # load the next round while the player is redirected
+        game_sessions.prefetch(session)
+
         return redirect(url_for("play_game"))
 
+    @app.route("/metrics")
+    def metrics_endpoint():
+        '''Serves the request and storage metrics in the Prometheus text format.'''
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
     @app.route("/leaderboard", methods=["GET"])
     @flask_login.login_required
-    def leaderboard():
+    async def leaderboard():
         '''Displays leaderboard with top 15 users and highlights the current user viewing the leaderboard.'''
-        # Get leaderboard list
-        leaderboard = backend.get_leaderboard()
-
-        length = len(leaderboard) # Length of the list
-        
-        # Current user game json data
-        curr_user = backend.get_game_user(flask_login.current_user.username)
-        
-        # If the length is greater than 15 then cut the list to have the top 15 users
-        if length > 15:
-            leaderboard = leaderboard[:15]
+        # Get the top 15 users of the leaderboard and the current user game json data at the same time
+        leaderboard, curr_user = await asyncio.gather(async_backend.get_top_users(15),
+                                                      async_backend.get_game_user(flask_login.current_user.username))
 
         # Boolean to check if user is in top 15
         user_in_top15 = False if (not curr_user["rank"] or curr_user["rank"] > 15) else True
 
-        trophy = backend.get_image(f'authors/trophy.png') # Image decoration
+        trophy = 'authors/trophy.png' # Image decoration
 
         return render_template("leaderboard.html", leaderboard=leaderboard, trophy=trophy, curr_user=curr_user, user_in_top15=user_in_top15)
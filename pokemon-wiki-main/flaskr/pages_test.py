@@ -2,7 +2,15 @@ from flaskr import create_app
 from flask import render_template, json, request
 from unittest.mock import MagicMock, patch
 import pytest
+import threading
 import base64
+import io
+from flaskr.user import User
+from flaskr.seen import SeenSet
+from flaskr.game_record import GameRecord
+from flaskr.page_index import ResultPage
+from flaskr.pages import PAGE_SIZE, SUGGESTIONS, MAX_SUGGESTIONS
+from flaskr import pages
 
 # See https://flask.palletsprojects.com/en/2.2.x/testing/
 # for more info on testing
@@ -52,37 +60,114 @@ def blob():
 def mock_rand():
     return MagicMock()
 
-@patch("flaskr.backend.Backend.get_image",
-       return_value=b"This should have been a real image!")
-def test_home_page(mock_get_wiki_page, client):
+def test_home_page(client):
 
     response = client.get("/")
     assert response.status_code == 200
     assert b"Welcome to the Pokemon Wiki" in response.data
-    assert b"This should have been a real image!" in response.data
+    assert b'src="/images/authors/logo.jpg"' in response.data
 
 
 # Tests about page, should return author's names
-@patch("flaskr.backend.Backend.get_image",
-       return_value=b"This is an image too!")
-def test_about_page(mock_get_image, client):
+def test_about_page(client):
     resp = client.get("/about")
     assert resp.status_code == 200
     assert b"Edgar Ochoa Sotelo" in resp.data
     assert b"Mark Toro" in resp.data
     assert b"Javier Garcia" in resp.data
-    assert b"This is an image too!" in resp.data
+    assert b'src="/images/authors/mark.png"' in resp.data
+
+
+@pytest.fixture
+def image_blob(blob):
+    blob.md5_hash = "XUFAKrxLKna5cZ2REBfFkg=="
+    blob.generation = 1680000000000000
+    blob.content_type = "image/png"
+    blob.size = 9
+    blob.download_as_bytes.return_value = b"png bytes"
+    blob.open.return_value.__enter__.return_value = io.BytesIO(b"png bytes")
+    return blob
+
+
+def test_image(image_blob, client):
+    with patch("flaskr.backend.Backend.get_image_blob", return_value=image_blob) as mock_get_image_blob:
+        resp = client.get("/images/authors/logo.jpg")
+    mock_get_image_blob.assert_called_once_with("authors/logo.jpg")
+    assert resp.status_code == 200
+    assert resp.data == b"png bytes"
+    assert resp.content_type == "image/png"
+    assert resp.headers["X-Content-Type-Options"] == "nosniff"
+    assert "Content-Disposition" not in resp.headers
+    assert resp.headers["ETag"] == '"XUFAKrxLKna5cZ2REBfFkg=="'
+    assert "max-age=3600" in resp.headers["Cache-Control"]
+
+
+def test_image_too_big_for_cache_is_streamed(image_blob, client):
+    image_blob.name = "images/huge.png"
+    image_blob.size = 1024 * 1024 * 1024
+    with patch("flaskr.backend.Backend.get_image_blob", return_value=image_blob):
+        resp = client.get("/images/images/huge.png")
+    assert resp.status_code == 200
+    assert resp.data == b"png bytes"
+    image_blob.download_as_bytes.assert_not_called()
+
+
+def test_image_not_modified(image_blob, client):
+    with patch("flaskr.backend.Backend.get_image_blob", return_value=image_blob):
+        resp = client.get("/images/authors/logo.jpg", headers={"If-None-Match": '"XUFAKrxLKna5cZ2REBfFkg=="'})
+    assert resp.status_code == 304
+    assert resp.data == b""
+    image_blob.open.assert_not_called()
+
+
+def test_image_sends_other_types_as_download(image_blob, client):
+    # a blob stored as html must never be shown as a page of the wiki
+    image_blob.content_type = "text/html"
+    with patch("flaskr.backend.Backend.get_image_blob", return_value=image_blob):
+        resp = client.get("/images/images/evil.png")
+    assert resp.content_type == "application/octet-stream"
+    assert resp.headers["Content-Disposition"] == "attachment"
+    assert resp.headers["X-Content-Type-Options"] == "nosniff"
+
+
+@patch("flaskr.backend.Backend.get_image_blob", return_value=None)
+def test_image_not_found(mock_get_image_blob, client):
+    resp = client.get("/images/user_game_ranking/ranks_list.json")
+    assert resp.status_code == 404
 
 
 # should return list of pages
 @patch("flaskr.backend.Backend.get_categories",return_value=b"categories")
-@patch("flaskr.backend.Backend.get_pages_using_sorting", return_value=b"sorted pages")
 @patch("flaskr.backend.Backend.get_pages_using_filter_and_search", return_value=b"sorted pages with filter and search")
-@patch("flaskr.backend.Backend.get_all_page_names", return_value=["page1","page2","page3"])
-def test_pages(mock_get_all_pages, mock_get_pages_using_filter_and_search, mock_get_pages_using_sorting, mock_get_categories,client):
+@patch("flaskr.backend.Backend.get_all_page_names", return_value=ResultPage(["page1","page2","page3"]))
+def test_pages(mock_get_all_pages, mock_get_pages_using_filter_and_search, mock_get_categories,client):
     response = client.get("/pages")
     assert response.status_code == 200
     assert b"page1" in response.data
+    mock_get_all_pages.assert_called_once_with(limit=PAGE_SIZE, cursor=None)
+    assert b"Next" not in response.data
+
+
+@patch("flaskr.backend.Backend.get_categories", return_value={})
+@patch("flaskr.backend.Backend.get_all_page_names", return_value=ResultPage(["pages/mudkip"], "next-token", "prev-token"))
+def test_pages_navigation(mock_get_all_pages, mock_get_categories, client):
+    response = client.get("/pages?cursor=some-token")
+    mock_get_all_pages.assert_called_once_with(limit=PAGE_SIZE, cursor="some-token")
+    assert b'href="/pages?cursor=next-token"' in response.data
+    assert b'href="/pages?cursor=prev-token"' in response.data
+
+
+@patch("flaskr.backend.Backend.get_categories", return_value={})
+@patch("flaskr.backend.Backend.get_pages_using_filter_and_search", return_value=ResultPage(["pages/charmander"], "next-token"))
+def test_pages_filtered_navigation_keeps_filters(mock_search, mock_get_categories, client):
+    response = client.post("/pages", data={"search": "", "sorting": "HighestToLowest", "type": "Fire"})
+    mock_search.assert_called_once_with(None, "Fire", None, None, "HighestToLowest", limit=PAGE_SIZE, cursor=None)
+    assert b"charmander" in response.data
+    assert b'href="/pages?cursor=next-token&amp;type=Fire&amp;sorting=HighestToLowest"' in response.data
+
+    mock_search.reset_mock()
+    client.get("/pages?cursor=next-token&type=Fire&sorting=HighestToLowest")
+    mock_search.assert_called_once_with(None, "Fire", None, None, "HighestToLowest", limit=PAGE_SIZE, cursor="next-token")
 
 # should return back to upload page
 def test_upload_get(client):
@@ -91,7 +176,6 @@ def test_upload_get(client):
     assert "upload" in response.location
 
 
-@patch("flaskr.backend.Backend.get_image", return_value=b"An image")
 @patch("flaskr.backend.Backend.get_wiki_page", return_value=b"{'name':'diff'}")
 @patch("flask.json.loads",
        return_value={
@@ -103,7 +187,7 @@ def test_upload_get(client):
            'image-name': '',
            'image-type': ''
        })
-def test_get_wiki_page(mockjson,mock_get_wiki_page,mock_get_image,client):
+def test_get_wiki_page(mockjson,mock_get_wiki_page,client):
     response = client.get("/pages/abra")
     assert b"abra" in response.data
     mockjson.assert_called_once_with(b"{'name':'diff'}")
@@ -183,3 +267,244 @@ def test_game_post(app, client):
         assert request.args.get("rank") == "5"
         assert request.args.get("user") == "user1"
 
+
+
+@patch("flaskr.backend.Backend.rebuild_search_index",
+       return_value=({"pages": [["pages/abra", "abra"], ["pages/mew", "mew"]], "trigrams": {}}, 1))
+@patch("flaskr.backend.Backend.rebuild_manifest",
+       return_value=([{"page": "pages/abra"}, {"page": "pages/mew"}], 1))
+def test_rebuild_manifest_command(mock_rebuild_manifest, mock_rebuild_search_index, app):
+    result = app.test_cli_runner().invoke(args=["rebuild-manifest"])
+    assert "Rebuilt the page manifest with 2 pages." in result.output
+    mock_rebuild_manifest.assert_called_once()
+
+
+@patch("flaskr.backend.Backend.rebuild_search_index",
+       return_value=({"pages": [["pages/abra", "abra"], ["pages/mew", "mew"]], "trigrams": {}}, 1))
+@patch("flaskr.backend.Backend.rebuild_manifest",
+       return_value=([{"page": "pages/abra"}, {"page": "pages/mew"}], 1))
+def test_rebuild_manifest_command_rebuilds_search_index(mock_rebuild_manifest, mock_rebuild_search_index, app):
+    pages.backend.search_index.loaded = True
+    result = app.test_cli_runner().invoke(args=["rebuild-manifest"])
+    assert "Rebuilt the search index with 2 pages." in result.output
+    mock_rebuild_search_index.assert_called_once()
+    assert not pages.backend.search_index.loaded
+
+
+def save(username, change, record):
+    change(record)
+    return record
+
+
+@patch("flaskr.backend.Backend.get_pokemon_data", return_value={"id": 7, "name": {"english": "Squirtle"}})
+@patch("flaskr.backend.Backend.get_image_bytes", return_value=b"squirtle")
+@patch("flaskr.backend.Backend.update_game", side_effect=lambda username, change, record: (save(username, change, record), record.user(1)))
+@patch("flaskr.backend.Backend.get_ranking")
+@patch("flaskr.backend.Backend.get_game_record")
+@patch("flaskr.backend.Backend.get_pokemon_id")
+@patch("flaskr.backend.Backend.get_user", return_value=User("ash", "hashed"))
+def test_game_post_correct_guess(mock_get_user, mock_get_pokemon_id, mock_get_game_record, mock_get_ranking, mock_update_game, mock_get_image_bytes, mock_get_pokemon_data, client):
+    record = GameRecord("ash", SeenSet(386), 100, 1)
+    mock_get_game_record.return_value = record
+    mock_get_ranking.return_value.rank.return_value = 2
+    with client.session_transaction() as session:
+        session["_user_id"] = "ash"
+    assert client.get("/game").status_code == 200
+    with client.session_transaction() as session:
+        pokemon_id = session["game_round"]
+    mock_get_pokemon_id.return_value = pokemon_id
+    resp = client.post("/game", data={"pokemon_id": str(pokemon_id), "user_guess": "pikachu"})
+    assert resp.status_code == 302
+    mock_get_pokemon_id.assert_called_once_with("pikachu")
+    mock_update_game.assert_called_once()
+    assert (record.seen, record.points) == (SeenSet(386, [pokemon_id]), 200)
+
+    # replaying the guess of a round that is over does not score again
+    resp = client.post("/game", data={"pokemon_id": str(pokemon_id), "user_guess": "pikachu"}, follow_redirects=True)
+    assert b"That round is over" in resp.data
+    assert (record.seen, record.points) == (SeenSet(386, [pokemon_id]), 200)
+    mock_update_game.assert_called_once()
+
+    # not even with the session cookie of the round it was served with
+    with client.session_transaction() as session:
+        next_id = session["game_round"]
+        session["game_round"] = pokemon_id
+    client.post("/game", data={"pokemon_id": str(pokemon_id), "user_guess": "pikachu"})
+    assert (record.seen, record.points) == (SeenSet(386, [pokemon_id]), 200)
+
+    # the round served by the redirect can be guessed without reading the user state again
+    with client.session_transaction() as session:
+        session["game_round"] = next_id
+    mock_get_pokemon_id.return_value = None
+    client.post("/game", data={"pokemon_id": str(next_id), "user_guess": "pikachu"})
+    assert (record.seen, record.points) == (SeenSet(386, [pokemon_id, next_id]), 150)
+    mock_get_game_record.assert_called_once()
+
+    # the round after the guess was prefetched in the background
+    resp = client.get("/game")
+    assert resp.status_code == 200
+    assert b"Squirtle" in resp.data
+    assert pages.game_sessions.stats()["prefetch_hits"] >= 1
+
+    # a server that does not have the game session in memory still scores the guess of the served round
+    with client.session_transaction() as session:
+        third_id = session["game_round"]
+    pages.game_sessions.drop("ash")
+    mock_get_pokemon_id.return_value = third_id
+    client.post("/game", data={"pokemon_id": str(third_id), "user_guess": "pikachu"})
+    assert (record.seen, record.points) == (SeenSet(386, [pokemon_id, next_id, third_id]), 250)
+
+
+@patch("flaskr.backend.Backend.get_ranking")
+@patch("flaskr.backend.Backend.get_game_record", return_value=GameRecord("gary", SeenSet(386), 50, 1))
+@patch("flaskr.backend.Backend.get_top_users", return_value=[{"name": "ash", "points": 300, "rank": 1}])
+@patch("flaskr.backend.Backend.get_user", return_value=User("gary", "hashed"))
+def test_leaderboard(mock_get_user, mock_get_top_users, mock_get_game_record, mock_get_ranking, client):
+    mock_get_ranking.return_value.rank.return_value = 16
+    with client.session_transaction() as session:
+        session["_user_id"] = "gary"
+    resp = client.get("/leaderboard")
+    assert resp.status_code == 200
+    assert b"ash" in resp.data
+    assert b"16" in resp.data
+    mock_get_top_users.assert_called_once_with(15)
+    mock_get_game_record.assert_called_once_with("gary")
+
+
+@patch("flaskr.backend.Backend.get_ranking")
+@patch("flaskr.backend.Backend.get_game_record")
+@patch("flaskr.backend.Backend.get_top_users")
+@patch("flaskr.backend.Backend.get_user", return_value=User("gary", "hashed"))
+def test_leaderboard_reads_at_the_same_time(mock_get_user, mock_get_top_users, mock_get_game_record, mock_get_ranking, client):
+    # every read waits until the three of them are running
+    barrier = threading.Barrier(3, timeout=2)
+    ranking = MagicMock()
+    ranking.rank.return_value = 16
+
+    def meet(value):
+        def call(*args):
+            barrier.wait()
+            return value
+        return call
+    mock_get_top_users.side_effect = meet([])
+    mock_get_game_record.side_effect = meet(GameRecord("gary", SeenSet(386), 50, 1))
+    mock_get_ranking.side_effect = meet(ranking)
+    with client.session_transaction() as session:
+        session["_user_id"] = "gary"
+    resp = client.get("/leaderboard")
+    assert resp.status_code == 200
+    assert b"16" in resp.data
+
+
+@patch("flaskr.backend.Backend.get_pokemon_data", return_value={"id": 1, "name": {"english": "Bulbasaur"}})
+@patch("flaskr.backend.Backend.update_game_record", side_effect=save)
+@patch("flaskr.backend.Backend.get_ranking")
+@patch("flaskr.backend.Backend.get_game_record")
+@patch("flaskr.backend.Backend.get_user", return_value=User("red", "hashed"))
+def test_game_all_pokemon_seen_starts_over(mock_get_user, mock_get_game_record, mock_get_ranking, mock_update_game_record, mock_get_pokemon_data, client):
+    record = GameRecord("red", SeenSet(386, range(1, 387)), 300, 1)
+    mock_get_game_record.return_value = record
+    mock_get_ranking.return_value.rank.return_value = None
+    with client.session_transaction() as session:
+        session["_user_id"] = "red"
+    resp = client.get("/game")
+    assert resp.status_code == 200
+    assert b"You have seen every pokemon, starting over!" in resp.data
+    mock_update_game_record.assert_called_once()
+    assert (len(record.seen), record.points) == (0, 300)
+
+
+@patch("flaskr.backend.Backend.get_image_blob", return_value=None)
+def test_metrics(mock_get_image_blob, client):
+    resp = client.get("/images/authors/missing.png")
+    assert resp.status_code == 404
+    assert "total;dur=" in resp.headers["Server-Timing"]
+
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.mimetype == "text/plain"
+    assert b'wiki_request_duration_seconds_count{route="/images/<path:blob_name>",method="GET"}' in resp.data
+    assert b"wiki_game_prefetch_hits_total" in resp.data
+    assert b"wiki_user_cache_hit_rate" in resp.data
+    assert b'wiki_json_cache_misses_total{prefix="pages/"}' in resp.data
+
+
+@patch("flaskr.backend.Backend.suggest_pages", return_value=[("charmander", "pages/charmander")])
+def test_suggest_pages(mock_suggest, client):
+    response = client.get("/api/pages/suggest?q=Char")
+    assert response.status_code == 200
+    assert response.get_json() == {"query": "Char", "suggestions": [{"name": "charmander", "page": "pages/charmander"}]}
+    mock_suggest.assert_called_once_with("Char", SUGGESTIONS)
+
+    client.get("/api/pages/suggest?q=c&k=1000")
+    mock_suggest.assert_called_with("c", MAX_SUGGESTIONS)
+
+
+@patch("flaskr.backend.Backend.suggest_pages")
+def test_suggest_pages_empty_query(mock_suggest, client):
+    response = client.get("/api/pages/suggest?q=%20")
+    assert response.get_json() == {"query": "", "suggestions": []}
+    mock_suggest.assert_not_called()
+
+
+@patch("flaskr.backend.Backend.get_categories", return_value={"types": [], "regions": [], "natures": []})
+@patch("flaskr.backend.Backend.get_user", return_value=User("ash", "hashed"))
+def test_upload_page_shows_flashed_message(mock_get_user, mock_get_categories, client):
+    with client.session_transaction() as session:
+        session["_user_id"] = "ash"
+    client.post("/upload", data={"name": "Abra", "type": "Psychic", "region": "Kanto", "nature": "Calm",
+                                 "level": "101", "desc": "Teleports", "file": (io.BytesIO(b"image"), "abra.png")})
+    resp = client.get("/upload")
+    assert b"The level must be a whole number from 1 to 100." in resp.data
+
+
+@patch("flaskr.backend.Backend.upload", return_value=True)
+@patch("flaskr.backend.Backend.get_user", return_value=User("ash", "hashed"))
+@pytest.mark.parametrize("level", ["abc", "", "12.5", "0", "101"])
+def test_upload_rejects_bad_level(mock_get_user, mock_upload, level, client):
+    with client.session_transaction() as session:
+        session["_user_id"] = "ash"
+    resp = client.post("/upload", data={"name": "Abra", "type": "Psychic", "region": "Kanto", "nature": "Calm",
+                                        "level": level, "desc": "Teleports",
+                                        "file": (io.BytesIO(b"image"), "abra.png")})
+    assert resp.status_code == 302
+    assert resp.location.endswith("/upload")
+    mock_upload.assert_not_called()
+
+
+@patch("flaskr.backend.Backend.upload", return_value=True)
+@patch("flaskr.backend.Backend.get_user", return_value=User("ash", "hashed"))
+def test_upload_accepts_level(mock_get_user, mock_upload, client):
+    with client.session_transaction() as session:
+        session["_user_id"] = "ash"
+    resp = client.post("/upload", data={"name": "Abra", "type": "Psychic", "region": "Kanto", "nature": "Calm",
+                                        "level": " 16 ", "desc": "Teleports",
+                                        "file": (io.BytesIO(b"image"), "abra.png")})
+    assert resp.location.endswith("/pages")
+    mock_upload.assert_called_once()
+
+
+@patch("flaskr.backend.Backend.upload", side_effect=ValueError("The image must be a PNG, JPEG, GIF or WEBP file."))
+@patch("flaskr.backend.Backend.get_user", return_value=User("ash", "hashed"))
+def test_upload_refuses_file_that_is_not_an_image(mock_get_user, mock_upload, client):
+    with client.session_transaction() as session:
+        session["_user_id"] = "ash"
+    resp = client.post("/upload", data={"name": "Abra", "type": "Psychic", "region": "Kanto", "nature": "Calm",
+                                        "level": "16", "desc": "Teleports",
+                                        "file": (io.BytesIO(b"<script>alert(1)</script>"), "abra.png", "text/html")})
+    assert resp.location.endswith("/upload")
+    with client.session_transaction() as session:
+        assert session["_flashes"] == [("message", "The image must be a PNG, JPEG, GIF or WEBP file.")]
+
+
+@patch("flaskr.backend.Backend.upload", side_effect=RuntimeError("manifest unavailable"))
+@patch("flaskr.backend.Backend.get_user", return_value=User("ash", "hashed"))
+def test_upload_reports_failed_save(mock_get_user, mock_upload, client):
+    with client.session_transaction() as session:
+        session["_user_id"] = "ash"
+    resp = client.post("/upload", data={"name": "Abra", "type": "Psychic", "region": "Kanto", "nature": "Calm",
+                                        "level": "16", "desc": "Teleports",
+                                        "file": (io.BytesIO(b"\x89PNG\r\n\x1a\n"), "abra.png", "image/png")})
+    assert resp.location.endswith("/upload")
+    with client.session_transaction() as session:
+        assert session["_flashes"] == [("message", "Could not save the page, please try again.")]
@@ -0,0 +1,66 @@
+"""This module contains the in-memory pokedex used by the game.
+
+The pokedex json is parsed once into a tuple of compact records indexed by pokemon id, together
+with a hash index from the english name of every pokemon to its id, so looking up a pokemon or
+checking a guess never touches the cloud storage.
+
+Typical Usage:
+pokedex = Pokedex(json.loads(pokedex_str), generation)
+data = pokedex.get(25)
+pokemon_id = pokedex.get_id('Pikachu')
+"""
+
+
+class Pokemon:
+    '''A single pokedex entry.'''
+    __slots__ = ("id", "name", "data")
+
+    def __init__(self, id, name, data):
+        '''Pokemon constructor.
+
+           Args:
+            id: Pokedex id of the pokemon, starting at 1.
+            name: English name of the pokemon.
+            data: The pokedex json object of the pokemon.
+        '''
+        self.id = id
+        self.name = name
+        self.data = data
+
+
+class Pokedex:
+
+    def __init__(self, entries, generation=None):
+        """
+        Args:
+            entries: List with the pokedex json object of every pokemon, the pokemon with id 1 first.
+            generation: Generation of the pokedex blob the entries were read from.
+        """
+        self.generation = generation
+        self.records = tuple(
+            Pokemon(id, entry["name"]["english"], entry)
+            for id, entry in enumerate(entries, start=1))
+        self.ids = {record.name.lower(): record.id for record in self.records}
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, id):
+        """ Returns the pokedex json object of a pokemon.
+        Args:
+            id: Pokedex id of the pokemon.
+        Returns:
+            The json object of the pokemon, or None if there is no pokemon with that id.
+        """
+        if 1 <= id <= len(self.records):
+            return self.records[id - 1].data
+        return None
+
+    def get_id(self, name):
+        """ Returns the id of a pokemon from its english name, ignoring case and surrounding spaces.
+        Args:
+            name: English name of the pokemon.
+        Returns:
+            The pokedex id of the pokemon, or None if no pokemon has that name.
+        """
+        return self.ids.get(name.strip().lower())
@@ -0,0 +1,28 @@
+from flaskr.pokedex import Pokedex
+import pytest
+
+
+@pytest.fixture
+def pokedex():
+    return Pokedex([
+        {"id": 1, "name": {"english": "Bulbasaur"}, "type": ["Grass", "Poison"]},
+        {"id": 2, "name": {"english": "Ivysaur"}, "type": ["Grass", "Poison"]},
+        {"id": 3, "name": {"english": "Mr. Mime"}, "type": ["Psychic"]},
+    ], generation=7)
+
+
+def test_get_by_id(pokedex):
+    assert pokedex.get(2) == {"id": 2, "name": {"english": "Ivysaur"}, "type": ["Grass", "Poison"]}
+    assert len(pokedex) == 3
+    assert pokedex.generation == 7
+
+
+def test_get_unknown_id(pokedex):
+    assert pokedex.get(0) == None
+    assert pokedex.get(4) == None
+
+
+def test_get_id_by_name(pokedex):
+    assert pokedex.get_id("Bulbasaur") == 1
+    assert pokedex.get_id("  mr. MIME ") == 3
+    assert pokedex.get_id("Pikachu") == None
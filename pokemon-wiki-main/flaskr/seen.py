@@ -0,0 +1,93 @@
+"""This module contains the set of pokemon a player has seen in the game and its storage format.
+
+The set is a bitset where bit id - 1 tells whether pokemon id was seen. It is stored as one
+version byte followed by the bits, so the 386 pokemon of the game take 50 bytes. The old json
+format ({"12": true, ...}) can still be read, it is replaced by the bitset the next time the set is written.
+
+Typical Usage:
+seen = SeenSet.decode(blob.download_as_bytes(), MAX_ID)
+seen.add(25)
+blob.upload_from_string(data=seen.encode(), content_type=SEEN_CONTENT_TYPE)
+"""
+
+from flask import json
+
+VERSION = 1
+SEEN_CONTENT_TYPE = "application/octet-stream"
+
+
+class SeenSet:
+
+    def __init__(self, max_id, ids=()):
+        """
+        Args:
+            max_id: The highest pokemon id, ids go from 1 to max_id.
+            ids: Ids of the pokemon that were seen.
+        """
+        self.max_id = max_id
+        self.bits = 0
+        for id in ids:
+            self.add(id)
+
+    def __contains__(self, id):
+        return 1 <= id <= self.max_id and bool(self.bits >> (id - 1) & 1)
+
+    def __len__(self):
+        return bin(self.bits).count("1")
+
+    def __iter__(self):
+        return (id for id in range(1, self.max_id + 1) if id in self)
+
+    def __eq__(self, other):
+        return isinstance(other, SeenSet) and (self.max_id, self.bits) == (other.max_id, other.bits)
+
+    def __repr__(self):
+        return f"SeenSet({self.max_id}, {list(self)})"
+
+    def copy(self):
+        """ Returns a new SeenSet with the same pokemon."""
+        seen = SeenSet(self.max_id)
+        seen.bits = self.bits
+        return seen
+
+    def add(self, id):
+        """ Marks a pokemon as seen, ids outside 1..max_id are ignored.
+        Args:
+            id: Id of the pokemon.
+        """
+        if 1 <= id <= self.max_id:
+            self.bits |= 1 << (id - 1)
+
+    def clear(self):
+        """ Marks every pokemon as unseen."""
+        self.bits = 0
+
+    def is_complete(self):
+        """ Returns whether every pokemon was seen."""
+        return self.bits == (1 << self.max_id) - 1
+
+    def encode(self):
+        """ Converts the set to its storage format.
+        Returns:
+            The version byte followed by the bits of the set.
+        """
+        return bytes([VERSION]) + self.bits.to_bytes((self.max_id + 7) // 8, "little")
+
+    @classmethod
+    def decode(cls, data, max_id, json=json):
+        """ Reads a set from its storage format, or from the old json format.
+        Args:
+            data: The stored bytes.
+            max_id: The highest pokemon id.
+            json: Dependency injection for mocking the json module.
+        Returns:
+            seen: The SeenSet with the stored ids.
+        """
+        seen = cls(max_id)
+        if data[:1] == bytes([VERSION]):
+            seen.bits = int.from_bytes(data[1:], "little") & ((1 << max_id) - 1)
+        elif data:
+            seen_json = json.loads(data)
+            for id in seen_json:
+                seen.add(int(id))
+        return seen
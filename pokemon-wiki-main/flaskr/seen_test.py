@@ -0,0 +1,44 @@
+from flaskr.seen import SeenSet
+import json
+
+
+def test_add_and_contains():
+    seen = SeenSet(386)
+    seen.add(1)
+    seen.add(386)
+    seen.add(0)
+    seen.add(387)
+    assert 1 in seen
+    assert 386 in seen
+    assert 2 not in seen
+    assert 0 not in seen
+    assert len(seen) == 2
+    assert list(seen) == [1, 386]
+
+
+def test_encode_is_49_bytes_of_bits():
+    data = SeenSet(386, [1, 9, 386]).encode()
+    assert len(data) == 50
+    assert data[0] == 1
+    assert data[1:3] == b"\x01\x01"
+    assert data[49] == 0x02
+
+
+def test_decode_round_trip():
+    seen = SeenSet(386, [3, 25, 150, 386])
+    assert SeenSet.decode(seen.encode(), 386) == seen
+
+
+def test_decode_old_json_format():
+    data = json.dumps({"12": True, "25": True}).encode()
+    assert list(SeenSet.decode(data, 386)) == [12, 25]
+    assert len(SeenSet.decode(b"{}", 386)) == 0
+
+
+def test_is_complete():
+    seen = SeenSet(386, range(1, 386))
+    assert not seen.is_complete()
+    seen.add(386)
+    assert seen.is_complete()
+    seen.clear()
+    assert len(seen) == 0
@@ -14,4 +14,19 @@ $(document).ready(function(){
     $('.natures-check').click(function() {
         $('.natures-check').not(this).prop('checked', false);
     });
-});
\ No newline at end of file
+});
+$(document).ready(function(){
+    $('.search-input').on('input', function() {
+        var query = $(this).val();
+        $.getJSON('/api/pages/suggest', {q: query}, function(data) {
+            // answers to older keystrokes may arrive late
+            if (data.query !== query.trim()) {
+                return;
+            }
+            var options = $('#page-suggestions').empty();
+            $.each(data.suggestions, function(i, suggestion) {
+                options.append($('<option>').attr('value', suggestion.name));
+            });
+        });
+    });
+});
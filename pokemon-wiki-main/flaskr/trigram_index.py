@@ -0,0 +1,124 @@
+"""This module contains the trigram index used to search the name and description of user generated pages.
+
+Every page is indexed by the trigrams (substrings of three characters) of its lowercased name and
+description. A substring query can only match pages that contain every trigram of the query, so
+the search intersects the posting lists of those trigrams, smallest first, and only checks the
+few candidates left against the full text. Queries shorter than a trigram check every page.
+
+The index is stored as a single json document that keeps the posting lists, so loading it does
+not need to compute the trigrams of every page again.
+
+Typical Usage:
+index = TrigramIndex()
+index.add('pages/charmander', {"name": "Charmander", "desc": "A fire lizard", ...})
+pages = index.search('lizard')
+"""
+
+N = 3
+
+
+def page_text(pokemon_data):
+    """ Returns the searchable text of a page, its lowercased name and description.
+        The parts are joined by a newline, which a search box query cannot contain, so no
+        query matches across the end of the name and the start of the description.
+    """
+    name = pokemon_data.get("name") or ""
+    desc = pokemon_data.get("desc") or ""
+    return f"{name}\n{desc}".lower()
+
+
+def trigrams(text):
+    """ Returns the set of trigrams of a text."""
+    return {text[i:i + N] for i in range(len(text) - N + 1)}
+
+
+class TrigramIndex:
+
+    def __init__(self):
+        self.loaded = False
+        self.generation = None  # generation of the index blob the index was loaded from
+        self.texts = {}  # page name -> searchable text
+        self.postings = {}  # trigram -> set of page names
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __contains__(self, page_name):
+        return page_name in self.texts
+
+    def add(self, page_name, pokemon_data):
+        """ Adds a page to the index, replacing it if it was already indexed.
+        Args:
+            page_name: The blob name of the page (e.g. 'pages/charmander').
+            pokemon_data: A dictionary with the data of the page.
+        """
+        self.add_text(page_name, page_text(pokemon_data))
+
+    def add_text(self, page_name, text):
+        if page_name in self.texts:
+            self.remove(page_name)
+        self.texts[page_name] = text
+        for trigram in trigrams(text):
+            self.postings.setdefault(trigram, set()).add(page_name)
+
+    def remove(self, page_name):
+        """ Removes a page from the index if it is there.
+        Args:
+            page_name: The blob name of the page.
+        """
+        text = self.texts.pop(page_name, None)
+        if text is None:
+            return
+        for trigram in trigrams(text):
+            pages = self.postings[trigram]
+            pages.discard(page_name)
+            if not pages:
+                del self.postings[trigram]
+
+    def clear(self):
+        """ Empties the index so it can be loaded again."""
+        self.__init__()
+
+    def search(self, query):
+        """ Finds the pages whose name or description contains the query, ignoring case.
+        Args:
+            query: The substring to look for.
+        Returns:
+            The set of matching page names.
+        """
+        query = query.lower()
+        if len(query) < N:
+            return {page for page, text in self.texts.items() if query in text}
+
+        posting_lists = []
+        for trigram in trigrams(query):
+            pages = self.postings.get(trigram)
+            if not pages:
+                return set()
+            posting_lists.append(pages)
+        # intersecting the shortest posting lists first keeps the candidates few
+        posting_lists.sort(key=len)
+        candidates = set(posting_lists[0])
+        for pages in posting_lists[1:]:
+            candidates &= pages
+            if not candidates:
+                return candidates
+
+        # every trigram matching does not mean they are next to each other in the text
+        return {page for page in candidates if query in self.texts[page]}
+
+    def to_dict(self):
+        """ Returns the index as a json serializable dictionary, pages are referenced by their number in the posting lists."""
+        pages = list(self.texts)
+        numbers = {page: i for i, page in enumerate(pages)}
+        return {
+            "pages": [[page, self.texts[page]] for page in pages],
+            "trigrams": {trigram: sorted(numbers[page] for page in posting) for trigram, posting in self.postings.items()},
+        }
+
+    def load_dict(self, data):
+        """ Replaces the content of the index with a dictionary made by to_dict."""
+        self.clear()
+        pages = [page for page, text in data["pages"]]
+        self.texts = {page: text for page, text in data["pages"]}
+        self.postings = {trigram: {pages[i] for i in numbers} for trigram, numbers in data["trigrams"].items()}
@@ -0,0 +1,70 @@
+from flaskr.trigram_index import TrigramIndex, trigrams, page_text
+import json
+import pytest
+
+
+@pytest.fixture
+def index():
+    index = TrigramIndex()
+    index.add("pages/charmander", {"name": "Charmander", "desc": "A fire lizard with a flame on its tail."})
+    index.add("pages/squirtle", {"name": "Squirtle", "desc": "A tiny turtle that squirts water."})
+    index.add("pages/mudkip", {"name": "Mudkip", "desc": "Its fin senses the water around it."})
+    return index
+
+
+def test_trigrams():
+    assert trigrams("abcd") == {"abc", "bcd"}
+    assert trigrams("ab") == set()
+
+
+def test_page_text():
+    assert page_text({"name": "Mudkip", "desc": "A Mud FISH"}) == "mudkip\na mud fish"
+    assert page_text({"name": "Mudkip"}) == "mudkip\n"
+
+
+def test_search_name_and_description(index):
+    assert index.search("char") == {"pages/charmander"}
+    assert index.search("WATER") == {"pages/squirtle", "pages/mudkip"}
+    assert index.search("turtle that") == {"pages/squirtle"}
+
+
+def test_search_verifies_candidates(index):
+    # every trigram of the query is in the text, but not next to each other
+    index.add("pages/abra", {"name": "Abra", "desc": "abcx bcdx"})
+    assert index.search("abcd") == set()
+
+
+def test_search_does_not_cross_name_and_description(index):
+    assert index.search("charmander a fire") == set()
+
+
+def test_search_short_query(index):
+    assert index.search("it") == {"pages/charmander", "pages/mudkip"}
+    assert index.search("") == {"pages/charmander", "pages/squirtle", "pages/mudkip"}
+
+
+def test_search_unknown_trigram(index):
+    assert index.search("dragon") == set()
+
+
+def test_add_replaces_page(index):
+    index.add("pages/mudkip", {"name": "Mudkip", "desc": "A mud fish."})
+    assert len(index) == 3
+    assert index.search("water") == {"pages/squirtle"}
+    assert index.search("mud fish") == {"pages/mudkip"}
+
+
+def test_remove(index):
+    index.remove("pages/squirtle")
+    assert "pages/squirtle" not in index
+    assert index.search("water") == {"pages/mudkip"}
+    assert "tur" not in index.postings
+    index.remove("pages/squirtle")
+
+
+def test_dict_round_trip(index):
+    loaded = TrigramIndex()
+    loaded.load_dict(json.loads(json.dumps(index.to_dict())))
+    assert loaded.texts == index.texts
+    assert loaded.postings == index.postings
+    assert loaded.search("fire lizard") == {"pages/charmander"}
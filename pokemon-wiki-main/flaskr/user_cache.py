@@ -0,0 +1,86 @@
+"""This module contains the cache of the users loaded by the backend.
+
+Flask-Login loads the logged in user on every request, the cache keeps every loaded User for a
+few minutes so its password blob is read at most once per ttl instead of once per page view.
+Usernames without an account are cached as well, so signing up must invalidate the username.
+When the cache is full the least recently used users are evicted first.
+
+Typical Usage:
+cache = UserCache(ttl=300)
+found, user = cache.get('javier')
+if not found:
+    user = read_user('javier')
+    cache.put('javier', user)
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class UserCache:
+
+    def __init__(self, ttl=300, max_entries=10000, clock=time.monotonic):
+        """
+        Args:
+            ttl: Seconds a loaded user is used before it is read from the storage again.
+            max_entries: Maximum number of users kept.
+            clock: Dependency injection for mocking the clock.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.entries = OrderedDict()  # username -> (loaded at, User or None), least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, username):
+        """ Returns the cached user of a username.
+        Args:
+            username: The username of the user.
+        Returns:
+            Tuple with whether the username was cached and its User, which is None if the account does not exist.
+        """
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is None or self.clock() - entry[0] >= self.ttl:
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(username)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, username, user):
+        """ Caches the user of a username, evicting the least recently used users if the cache is full.
+        Args:
+            username: The username of the user.
+            user: The User, or None if the account does not exist.
+        """
+        with self.lock:
+            self.entries.pop(username, None)
+            while self.entries and len(self.entries) >= self.max_entries:
+                self.entries.popitem(last=False)
+            self.entries[username] = (self.clock(), user)
+
+    def invalidate(self, username):
+        """ Forgets a username, its user is read from the storage the next time it is needed."""
+        with self.lock:
+            self.entries.pop(username, None)
+
+    def stats(self):
+        """ Returns the cache counters.
+        Returns:
+            Dictionary with the hits, misses, hit rate and cached users.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.entries),
+            }
@@ -0,0 +1,50 @@
+from flaskr.user_cache import UserCache
+from flaskr.user import User
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_get_and_put():
+    cache = UserCache()
+    assert cache.get("ash") == (False, None)
+    user = User("ash", "hashed")
+    cache.put("ash", user)
+    assert cache.get("ash") == (True, user)
+    cache.put("gary", None)
+    assert cache.get("gary") == (True, None)
+    assert cache.stats() == {"hits": 2, "misses": 1, "hit_rate": 2 / 3, "entries": 2}
+
+
+def test_ttl():
+    clock = FakeClock()
+    cache = UserCache(ttl=60, clock=clock)
+    cache.put("ash", User("ash", "hashed"))
+    clock.now = 59
+    assert cache.get("ash")[0] == True
+    clock.now = 60
+    assert cache.get("ash") == (False, None)
+
+
+def test_evicts_least_recently_used():
+    cache = UserCache(max_entries=2)
+    cache.put("ash", User("ash", "hashed"))
+    cache.put("misty", User("misty", "hashed"))
+    cache.get("ash")
+    cache.put("brock", User("brock", "hashed"))
+    assert len(cache) == 2
+    assert cache.get("misty") == (False, None)
+    assert cache.get("ash")[0] == True
+
+
+def test_invalidate():
+    cache = UserCache()
+    cache.put("ash", None)
+    cache.invalidate("ash")
+    cache.invalidate("misty")
+    assert cache.get("ash") == (False, None)